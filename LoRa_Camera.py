@@ -0,0 +1,89 @@
+import sensor, image, lcd, time
+from fpioa_manager import fm
+from Maix import GPIO
+from machine import SPI
+from micropython import const
+from sx127x import SX127x, PacketRing
+from dutycycle import AirtimeScheduler
+from camstream import TileEncoder, TileDecoder, CameraStreamer, downsample
+
+# Streams the camera over LoRa as 80x60 grayscale tiles (see camstream.py).
+# One Amigo sends, the other receives and shows what it rebuilt.
+
+################### config ###################
+CAMERA_ROLE = 'send' # 'send': camera -> LoRa, 'receive': LoRa -> LCD
+LORA_RST = const(22)
+LORA_CS = const(12)
+LORA_SPI_SCK = const(19)
+LORA_SPI_MOSI = const(7)
+LORA_SPI_MISO = const(9)
+LORA_SPI_NUM = SPI.SPI1
+LORA_SPI_FREQ_KHZ = const(100)
+WIDTH = const(80)
+HEIGHT = const(60)
+##############################################
+
+fm.register(LORA_RST, fm.fpioa.GPIOHS22, force=True) # RST
+fm.register(LORA_CS, fm.fpioa.GPIOHS12, force=True) # CS
+cs = GPIO(GPIO.GPIOHS12, GPIO.OUT)
+rst = GPIO(GPIO.GPIOHS22, GPIO.IN)
+spi1 = SPI(LORA_SPI_NUM, mode=SPI.MODE_MASTER, baudrate=LORA_SPI_FREQ_KHZ * 1000,
+           polarity=0, phase=0, bits=8, firstbit=SPI.MSB, sck=LORA_SPI_SCK,
+           mosi=LORA_SPI_MOSI, miso = LORA_SPI_MISO)
+
+# SF7 / 250 kHz: the fastest setting that still gets across a room or two
+lora = SX127x(spi=spi1, pin_ss=cs, shadow=True,
+              parameters={'frequency': 433E6, 'tx_power_level': 17, 'signal_bandwidth': 250E3,
+                          'spreading_factor': 7, 'coding_rate': 5, 'preamble_length': 8,
+                          'implicitHeader': False, 'sync_word': 0x12, 'enable_CRC': True})
+rst.value(0)
+time.sleep_ms(10)
+rst.value(1)
+time.sleep_ms(100)
+lora.init()
+
+lcd.init(freq=15000000)
+clock = time.clock()
+
+if CAMERA_ROLE == 'send':
+    sensor.reset()
+    sensor.set_pixformat(sensor.GRAYSCALE)
+    sensor.set_framesize(sensor.QQVGA)
+    sensor.run(1)
+    sensor.skip_frames()
+    airtime = AirtimeScheduler(lora)
+    streamer = CameraStreamer(lora, TileEncoder(WIDTH, HEIGHT),
+                              transmit=lambda packet: airtime.send(packet) == 0)
+    small = bytearray(WIDTH * HEIGHT)
+    while True:
+        clock.tick()
+        img = sensor.snapshot()
+        lcd.display(img)
+        lora.pollTx()
+        downsample(img.to_bytes(), img.width(), img.height(), small, WIDTH, HEIGHT)
+        sent = streamer.offer(small)
+        if sent:
+            stats = streamer.encoder.stats
+            print("{0:2.1f}fps {1} bytes, encode {2} us, {3} sent {4} skipped".format(
+                clock.fps(), sent, stats['lastUs'], streamer.stats['sent'], streamer.stats['skipped']))
+else:
+    decoder = TileDecoder(WIDTH, HEIGHT)
+    ring = PacketRing(4)
+    lora.onReceive(None, ring=ring)
+    lora.receive()
+    view = image.Image(size=(WIDTH, HEIGHT))
+    while True:
+        lora.pollRx()
+        slot = ring.first()
+        if slot < 0:
+            continue
+        n = decoder.decode(ring.packet(slot))
+        ring.release()
+        if n > 0:
+            frame = decoder.frame
+            for y in range(HEIGHT):
+                for x in range(WIDTH):
+                    v = frame[y * WIDTH + x]
+                    view.set_pixel(x, y, (v, v, v))
+            lcd.display(view)
+            print("frame {0}: {1} tiles, RSSI {2} SNR {3}".format(decoder.number, n, lora.packetRssi(), lora.packetSNR()))
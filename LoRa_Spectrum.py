@@ -0,0 +1,56 @@
+import image, lcd, time
+from fpioa_manager import fm
+from Maix import GPIO
+from machine import SPI
+from micropython import const
+from sx127x import SX127x
+from spectrum import SpectrumScanner, Waterfall
+
+# RSSI waterfall of a band on the LCD, one row per sweep, and the quietest
+# channels on the console every REPORT_EVERY sweeps (see spectrum.py).
+
+################### config ###################
+SCAN_START = 433.05E6
+SCAN_STOP = 434.79E6
+SCAN_STEP = 25E3
+SCAN_SAMPLES = const(8) # RSSI reads per channel
+REPORT_EVERY = const(20)
+LORA_RST = const(22)
+LORA_CS = const(12)
+LORA_SPI_SCK = const(19)
+LORA_SPI_MOSI = const(7)
+LORA_SPI_MISO = const(9)
+LORA_SPI_NUM = SPI.SPI1
+LORA_SPI_FREQ_KHZ = const(100)
+##############################################
+
+fm.register(LORA_RST, fm.fpioa.GPIOHS22, force=True) # RST
+fm.register(LORA_CS, fm.fpioa.GPIOHS12, force=True) # CS
+cs = GPIO(GPIO.GPIOHS12, GPIO.OUT)
+rst = GPIO(GPIO.GPIOHS22, GPIO.IN)
+spi1 = SPI(LORA_SPI_NUM, mode=SPI.MODE_MASTER, baudrate=LORA_SPI_FREQ_KHZ * 1000,
+           polarity=0, phase=0, bits=8, firstbit=SPI.MSB, sck=LORA_SPI_SCK,
+           mosi=LORA_SPI_MOSI, miso = LORA_SPI_MISO)
+
+# the RSSI is measured in the LoRa bandwidth: 125 kHz covers a 25 kHz step and its neighbours
+lora = SX127x(spi=spi1, pin_ss=cs, shadow=True,
+              parameters={'frequency': SCAN_START, 'tx_power_level': 2, 'signal_bandwidth': 125E3,
+                          'spreading_factor': 7, 'coding_rate': 5, 'preamble_length': 8,
+                          'implicitHeader': False, 'sync_word': 0x12, 'enable_CRC': True})
+rst.value(0)
+time.sleep_ms(10)
+rst.value(1)
+time.sleep_ms(100)
+lora.init()
+
+lcd.init(freq=15000000)
+lcd.rotation(1)
+lcd.mirror(1)
+
+scan = SpectrumScanner(lora, SCAN_START, SCAN_STOP, SCAN_STEP, SCAN_SAMPLES)
+fall = Waterfall(image, lcd, scan)
+while True:
+    scan.sweep()
+    fall.draw()
+    if scan.stats['sweeps'] % REPORT_EVERY == 0:
+        scan.report()
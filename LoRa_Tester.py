@@ -1,4 +1,4 @@
-import image, touch, gc, time
+import image, touch, gc, time, lcd
 from machine import I2C
 from board import board_info
 from fpioa_manager import fm
@@ -6,7 +6,12 @@ from Maix import GPIO
 import time
 from machine import SPI
 from micropython import const
-from sx127x import SX127x
+from sx127x import SX127x, PacketRing, GC_LOW_HEAP
+from dutycycle import AirtimeScheduler, TOO_LONG, QUEUE_FULL
+from menu_ui import MenuRenderer, HitTest, TouchInput, TOUCH_PRESS, TOUCH_MOVE
+from packetlog import PacketLogger, NO_SEQUENCE
+from pingpong import PingPong, INITIATOR, RESPONDER
+from adr import AdaptiveDataRate, CONTROLLER, NODE
 
 board_info=board_info()
 i2c = I2C(I2C.I2C3, freq=1000*1000, scl=24, sda=27) # amigo
@@ -36,6 +41,12 @@ LORA_SPI_MOSI = const(7)
 LORA_SPI_MISO = const(9)
 LORA_SPI_NUM = SPI.SPI1
 LORA_SPI_FREQ_KHZ = const(100) 
+LORA_DIO0 = None # FPIOA pin wired to the module's DIO0, None: poll the IRQ flags
+GC_THRESHOLD = const(64 * 1024) # collect only when free heap drops below this
+LOG_PATH = '/sd/packets.bin' # binary packet log, None: don't log
+LOG_FLUSH_MS = const(10000) # buffered log records are written at least this often
+RTT_COUNT = const(20) # round trips per RTT benchmark run
+ADR_MARGIN = const(10) # dB above the demodulation floor ADR keeps
 ##############################################
 
 # gpio init
@@ -48,7 +59,39 @@ rst = GPIO(GPIO.GPIOHS22, GPIO.IN)
 spi1 = SPI(LORA_SPI_NUM, mode=SPI.MODE_MASTER, baudrate=LORA_SPI_FREQ_KHZ * 1000, 
            polarity=0, phase=0, bits=8, firstbit=SPI.MSB, sck=LORA_SPI_SCK, 
            mosi=LORA_SPI_MOSI, miso = LORA_SPI_MISO)
-lora = SX127x(spi=spi1, pin_ss=cs)
+class DioPin:
+    # the IRQ interface SX127x expects, on top of a MaixPy GPIOHS
+    def __init__(self, gpio):
+        self.gpio = gpio
+    def set_handler_for_irq_on_rising_edge(self, handler):
+        self.gpio.irq(handler, GPIO.IRQ_RISING, GPIO.WAKEUP_NOT_SUPPORT)
+    def detach_irq(self):
+        self.gpio.disirq()
+
+dio0 = None
+if LORA_DIO0 is not None:
+    fm.register(LORA_DIO0, fm.fpioa.GPIOHS23, force=True) # DIO0
+    dio0 = DioPin(GPIO(GPIO.GPIOHS23, GPIO.IN, GPIO.PULL_DOWN))
+
+lora = SX127x(spi=spi1, pin_ss=cs, shadow=True, pin_RxDone=dio0)
+lora.setMemoryPolicy(GC_LOW_HEAP, threshold=GC_THRESHOLD)
+rxRing = PacketRing(4)
+airtime = AirtimeScheduler(lora)
+# ping/pong benchmark: the RTT tile starts a run, and we always echo the other side's pings
+transmit = lambda payload: airtime.send(payload) == 0
+rttBench = PingPong(lora, INITIATOR, transmit=transmit)
+rttEcho = PingPong(lora, RESPONDER, transmit=transmit)
+packetLog = None
+if LOG_PATH is not None:
+    try:
+        packetLog = PacketLogger(LOG_PATH)
+    except Exception as e:
+        # no SD card
+        print("No packet log: {0}".format(e))
+
+def collectIfLow():
+    if gc.mem_free() < GC_THRESHOLD:
+        gc.collect()
 
 def Version():
     global message
@@ -63,13 +106,84 @@ def Version():
 
 def PING():
     global pingCounter, message
-    payload = 'PING #{0}'.format(pingCounter)
-    print("Sending packet: {}".format(payload))
-    message = "Sent "+payload
-    lora.print(payload)
-    pingCounter += 1
+    text = 'PING #{0}'.format(pingCounter)
+    payload = text.encode()  # airtime goes by bytes
+    # non-blocking: the main loop keeps polling touch while the packet is on air
+    wait = airtime.send(payload, onPingSent)
+    if wait == TOO_LONG:
+        print("Duty cycle: {0} bytes never fit the band's budget".format(len(payload)))
+        message = "Too long for duty cycle"
+    elif wait == QUEUE_FULL:
+        print("TX queue full, {0} queued".format(lora.txQueueDepth()))
+        message = "TX queue full"
+    elif wait != 0:
+        # would break the sub-band's duty cycle
+        print("Duty cycle: {0} ms to wait, {1}% used".format(wait, round(airtime.utilization()*100, 1)))
+        message = "Duty cycle! wait {0}s".format(wait // 1000)
+    else:
+        print("Sending packet: {}".format(text))
+        message = "Sending "+text
+        pingCounter += 1
+    showMap()
+
+def onPingSent(radio, latency):
+    global message
+    print("Sent in {0} ms, {1} queued".format(latency, radio.txQueueDepth()))
+    message = "Sent in {0} ms".format(latency)
+    showMap()
+
+def pingSequence(packet):
+    # the counter of a 'PING #n' packet, for loss figures in the log
+    if packet[:6] == b'PING #':
+        try:
+            return int(bytes(packet[6:]))
+        except ValueError:
+            pass
+    return NO_SEQUENCE
+
+def RTT():
+    global message
+    if rttBench.running:
+        rttBench.stop()
+        message = "RTT stopped"
+    else:
+        rttBench.count = RTT_COUNT
+        rttBench.reset()
+        message = "RTT: {0} pings".format(RTT_COUNT)
+    showMap()
+
+def ADR():
+    # this board picks SF / BW / Tx for both from the other side's packets; the
+    # other side only follows (see adr.py), so turn it on at one end only
+    global adrOn, message
+    adrOn = not adrOn
+    if adrOn:
+        adrControl.adopt()
+        check.append(10)
+        message = "ADR on, margin {0} dB".format(ADR_MARGIN)
+    else:
+        check.remove(10)
+        adrControl.report()
+        message = "ADR off"
+    showMap()
+
+def onAdrChange(adr, peer, sf, bw, power):
+    # ADR retuned the radio: keep the SF / BW / Tx tiles honest
+    global mySF, myBW, myTX, check, message
+    mySF, myBW, myTX = sf, bw, power
+    check = [i for i in check if i not in (1, 2, 3, 4, 7, 8)]
+    for i, on in ((1, bw == 6), (2, bw == 7), (3, sf == 10), (4, sf == 12), (7, power == 10), (8, power == 17)):
+        if on:
+            check.append(i)
+    message = "ADR: SF{0} BW{1} {2}dBm".format(sf, bw, power)
     showMap()
 
+def rttDone():
+    global message
+    rttBench.report()
+    r = rttBench.results()
+    message = "RTT {0}ms {1}% lost".format(r['rttP50'], round(r['loss'] * 100))
+
 def NOP():
      print("NOP")
 
@@ -145,31 +259,44 @@ def Tx17():
         check.append(8)
     setParameters()
 
-menus = ["ping", "BW6", "BW7", "SF10", "SF12", "433", "868", "Tx10", "Tx17"]
-actions = [PING, BW6, BW7, SF10, SF12, F433, F868, Tx10, Tx17]
+menus = ["ping", "BW6", "BW7", "SF10", "SF12", "433", "868", "Tx10", "Tx17", "RTT", "ADR"]
+actions = [PING, BW6, BW7, SF10, SF12, F433, F868, Tx10, Tx17, RTT, ADR]
 numMenus = len(menus)
 
-def setParameters():
-    global mySF, myBW, myFreq, myTX, message
-    # lora reset
+def resetRadio():
+    # lora reset, full init: only needed once at startup
     rst.value(0)
     time.sleep_ms(10)
     rst.value(1)
     time.sleep_ms(100)
     lora.init()
+
+def setParameters():
+    global mySF, myBW, myFreq, myTX, message, retuneDue
     fq = round(myFreq/1000000, 3)
     print("Setting freq to: {0} MHz".format(fq))
-    lora.setFrequency(myFreq)
     bins = (7.8E3, 10.4E3, 15.6E3, 20.8E3, 31.25E3, 41.7E3, 62.5E3, 125E3, 250E3, 500E3)
     if myBW<0 or myBW>9:
         myBW=7
     BWrate = bins[myBW]
     print("Setting BW to: "+str(BWrate/1e3)+" KHz / "+str(myBW))
-    lora.setSignalBandwidth(BWrate)
     print("Setting SF to: "+str(mySF))
-    lora.setSpreadingFactor(mySF)
     print("Setting TX power to: "+str(myTX))
-    lora.setTxPower(myTX)
+    # only the registers that actually change are written
+    n = lora.configure(frequency=myFreq, signal_bandwidth=BWrate, spreading_factor=mySF, tx_power_level=myTX)
+    retuneDue = n < 0
+    if retuneDue:
+        # a packet is on air: the driver applies the change once it is sent,
+        # the main loop comes back here for the rest
+        print("Radio busy, applied after TX")
+        message = "Busy, applied after TX"
+        showMap()
+        return
+    print("{0} register(s) written".format(n))
+    if adrOn is not None:
+        # changed by hand: ADR starts over from here
+        adrControl.adopt()
+        adrNode.adopt()
     print("------------------------")
     print("Checking:")
     fq = round(lora.getFrequency()/1000000.0, 3)
@@ -188,99 +315,98 @@ def setParameters():
     message = "{0} MHz SF{1} BW {2} KHz".format(fq, sf, round(bw/1e3, 1))
     showMap()
 
+lcd.rotation(1)
+lcd.mirror(1)
+# static layer and framebuffer are built once, showMap() only redraws what changed
+ui = MenuRenderer(image, lcd, menus, squareWidth=squareWidth, squareHeight=squareHeight)
+
 def showMap():
-    global whichButton, message, loraPacket, rssi, snr, squareWidth, squareHeight
-    img = image.Image(size=(320, 480))
-    img.draw_rectangle(0, 0, 320, 480, color=(255, 64, 64), fill=True)
-    img.draw_string(140, 10, "MENU", color=(255, 255, 255), scale=2)
-    for i in range(0, numMenus):
-        x = (i % 3) * (squareWidth+10) + 10
-        y = int(i/3) * (squareHeight+10) + 50
-        if whichButton == i:
-            img.draw_rectangle(x, y, squareWidth, squareHeight, color=(0, 191, 191), fill=True)
-        img.draw_rectangle(x, y, squareWidth, squareHeight, color=(0, 0, 0), thickness=3)
-        clr = color=(255, 255, 255)
-        if whichButton == i:
-            clr = (33, 33, 33)
-            offsetX = 32
-            offsetY = 22
-        if check.count(i)>0:
-            # check mark
-            img.draw_rectangle(x+3, y+3, squareWidth-6, squareHeight-6, color=(0, 0, 255), thickness=3)
-        dsp = menus[i]
-        offsetX = 45 - (8*len(dsp))
-        img.draw_string(x+offsetX, y+20, dsp, clr, scale=3)
-    py = y + squareHeight + 10
-    ln = len(message)
-    if ln > 0:
-        myScale = 2
-        myWidth = 5 * myScale
-        img.draw_string(int((320-ln*myWidth)/2), 470-myScale*10, message, (0, 0, 0), scale=myScale)
-    ln = len(loraPacket)
-    if ln > 0:
-        myScale = 2
-        myWidth = 5 * myScale
-        pieces=[]
-        limit = 28
-        while len(loraPacket)>0:
-            pieces.append(loraPacket[0:limit])
-            loraPacket=loraPacket[limit:]
-        pieces.append(rssi+" "+snr)
-        for i in pieces:
-            ln = len(i)
-            img.draw_string(6, py, i, (255, 222, 222), scale=myScale)
-            py += 24
-    lcd.rotation(1)
-    lcd.mirror(1)
-    lcd.display(img)
-    gc.collect()
+    global whichButton, message, loraPacket, rssi, snr
+    ui.setPressed(whichButton)
+    ui.setChecked(check)
+    ui.setPacket(loraPacket, rssi+" "+snr)
+    ui.setMessage(message)
+    ui.render()
+    collectIfLow()
 
+adrOn = None
+retuneDue = False
 showMap()
+resetRadio()
 setParameters()
-while 1:
-    tmp.event()
-    #print(tmp.state, tmp.points)
-    [(y0, x0, t0), (y1, x1, t1)] = tmp.points
-    #print(str(x0)+":"+str(y0))
-    if(x0!=0 and y0 != 0):
-        print("Touch")
-        while(x0!=0 and y0 != 0):
-            saveX = x1
-            saveY = y1
-            if saveY<50:
-                whichButton = -1
-            else:
-                x = int((saveX-10)/(squareWidth+10))
-                y = int((saveY-50)/(squareHeight+10))
-                whichButton = y*3+x
-            showMap()
-            tmp.event()
-            [(y0, x0, t0), (y1, x1, t1)] = tmp.points
+# ADR: this board follows the other side's offers, or makes them itself (ADR tile);
+# both fall back to the settings above after a minute without hearing the other
+adrControl = AdaptiveDataRate(lora, CONTROLLER, margin=ADR_MARGIN, transmit=transmit, onChange=onAdrChange)
+adrNode = AdaptiveDataRate(lora, NODE, transmit=transmit, onChange=onAdrChange)
+adrOn = False
+# RX_CONTINUOUS: packets land in rxRing (from the DIO0 interrupt, or pollRx()
+# below), the loop only drains it
+lora.onReceive(None, ring=rxRing)
+lora.receive()
+
+def onTouch(event, index, x, y):
+    # only called on press, tile change and release
+    global whichButton
+    if event == TOUCH_PRESS or event == TOUCH_MOVE:
+        if event == TOUCH_PRESS:
+            print("Touch")
+        whichButton = index
+    else:
         print("Released")
-        if saveY<50:
+        print(str(x)+":"+str(y))
+        whichButton = -1
+        if index < 0:
             print('abort')
         else:
-            print(str(saveX)+":"+str(saveY))
-            x = int((saveX-10)/(squareWidth+10))
-            y = int((saveY-50)/(squareHeight+10))
-            index = y*3+x
-            if index>(numMenus-1):
-                print('abort')
-            else:
-                print("You selected menu: "+str(index))
-                actions[index]()
-        whichButton = -1
-        showMap()
-    gc.collect()
-    if lora.receivedPacket():
-        try:
-            loraPacket = lora.read_payload().decode()
-            rssi = "RSSI: {}".format(lora.packetRssi())
-            snr = "SNR: {}".format(lora.packetSNR())
-            print("*** Received message *** {} {} {}".format(loraPacket, rssi, snr))
-            message = "Incoming!"
+            print("You selected menu: "+str(index))
+            actions[index]()
+    showMap()
+
+touchInput = TouchInput(tmp, HitTest(numMenus, squareWidth, squareHeight), onTouch)
+
+logFlushedAt = time.ticks_ms()
+try:
+    while 1:
+        touchInput.poll()
+        collectIfLow()
+        if dio0 is None:
+            lora.pollTx()
+            lora.pollRx()
+        if retuneDue and not lora.configPending():
+            setParameters()
+        adr = adrControl if adrOn else adrNode
+        if adr.poll():
+            pass  # a handshake holds the link
+        elif rttBench.running and not rttBench.poll():
+            rttDone()
             showMap()
-        except Exception as e:
-            print(e)
-        gc.collect()
-        time.sleep_ms(30)
\ No newline at end of file
+        slot = rxRing.first()
+        while slot >= 0:
+            try:
+                packet = rxRing.packet(slot)
+                if packetLog is not None:
+                    packetLog.logPacket(lora, rxRing, slot, pingSequence(packet))
+                # ping/pong frames are handled here, of the rest only the newest packet is displayed
+                if not (adr.onReceive(lora, packet, rxRing.snr[slot] / 4, rxRing.rssi[slot]) or
+                        rttBench.onReceive(lora, packet) or rttEcho.onReceive(lora, packet)) and len(rxRing) == 1:
+                    loraPacket = bytes(packet).decode()
+                    rssi = "RSSI: {}".format(rxRing.rssi[slot])
+                    snr = "SNR: {}".format(rxRing.snr[slot] / 4)
+                    stats = lora.rxStats
+                    print("*** Received message *** {} {} {}".format(loraPacket, rssi, snr))
+                    print("ok {0} crc {1} missed {2} overrun {3}".format(stats['delivered'], stats['crcErrors'],
+                          stats['missed'], rxRing.droppedOldest))
+                    message = "Incoming! {0} ok {1} lost".format(stats['delivered'], stats['missed'] + stats['crcErrors'])
+                    showMap()
+            except Exception as e:
+                print(e)
+            rxRing.release()
+            slot = rxRing.first()
+        if packetLog is not None and time.ticks_diff(time.ticks_ms(), logFlushedAt) >= LOG_FLUSH_MS:
+            # don't lose more than LOG_FLUSH_MS of records on a reset or power-off
+            packetLog.flush()
+            logFlushedAt = time.ticks_ms()
+finally:
+    # Ctrl-C in the REPL, or an error: write out what is still buffered
+    if packetLog is not None:
+        packetLog.close()
@@ -0,0 +1,426 @@
+# Adaptive data rate: runs a link at the fastest spreading factor / bandwidth
+# and the lowest TX power its measured SNR allows, instead of fixed settings.
+#
+#   adr = AdaptiveDataRate(lora, CONTROLLER)    # the other side: AdaptiveDataRate(lora, NODE)
+#   # every received payload goes through adr.onReceive() first:
+#   if not adr.onReceive(lora, payload): ...    # not an ADR frame, the application's
+#   while True:
+#       if not adr.poll(): ...                  # main loop; True while a handshake holds the link
+#   adr.report()
+#
+# The controller keeps the SNR and RSSI of the last `window` packets of each
+# peer in fixed arrays. Each SNR is also stored normalised to 0 dBm in 125 kHz,
+# so the window stays valid when power or bandwidth change: the link gives
+# snr0 + power - 10 log10(bandwidth / 125 kHz) dB. The worst sample of the window
+# decides: the fastest (SF, BW) whose demodulation floor plus `margin` dB it
+# clears at maxPower, then the lowest power that still keeps the margin. Faster
+# settings are taken with `hysteresis` dB to spare, slower ones as soon as the
+# margin is gone. Both sides use the same settings, the link is assumed symmetric.
+#
+# Handshake, all frames FRAME: the controller sends PARAMS on the current
+# settings, the node answers ACK and switches once the ACK is out; the
+# controller switches on the ACK and sends CHECK on the new settings, which the
+# node ACKs again. No CHECK within `confirm` ms: the node goes back to the old
+# settings; no ACK to CHECK after `retries` tries: so does the controller. A side
+# that hears nothing from the other for `fallback` ms drops to the settings the
+# link started with, where the other side ends up too.
+try:
+    import ustruct as struct
+except ImportError:
+    import struct
+import math
+from array import array
+
+from sx127x import BANDWIDTHS, bandwidthIndex, timeOnAir, ticks_ms, ticks_diff
+
+CONTROLLER = 0
+NODE = 1
+
+FRAME = struct.Struct('<BBBBBB')   # kind, node, sequence, spreading factor, bandwidth index, tx power
+KIND_PARAMS = 0xd1
+KIND_ACK = 0xd2
+KIND_CHECK = 0xd3
+
+# minimum SNR (dB) the demodulator needs, SF6..SF12 (SX1276 datasheet table 13)
+SNR_FLOOR = (-5.0, -7.5, -10.0, -12.5, -15.0, -17.5, -20.0)
+NOISE_FIGURE = 6.0
+# above this the chip's SNR estimate flattens out: use RSSI - noise floor
+SNR_SATURATION = 5.0
+
+# AdaptiveDataRate.state
+IDLE = 0
+OFFERED = 1     # controller: PARAMS sent, waiting for the ACK
+CHECKING = 2    # controller: on the new settings, CHECK sent, waiting for the ACK
+SWITCHING = 3   # node: ACK queued, switches once it is out
+CONFIRMING = 4  # node: on the new settings, waiting for CHECK
+
+
+def _bwTerm(bw):
+    # 10 log10(bandwidth / 125 kHz) in quarter dB, bw an index into BANDWIDTHS
+    return int(round(40 * math.log10(BANDWIDTHS[bw] / 125E3)))
+
+
+class AdaptiveDataRate:
+    # node: this node's number (NODE); peers: how many nodes the controller
+    #   serves, numbered 0..peers-1
+    # margin, hysteresis: dB; window: samples kept per peer; samples: new
+    #   samples needed after a change before the next decision; length: the
+    #   packet size settings are ranked by
+    # transmit(frame) -> True if the radio took it, lora.send by default
+    # onChange(adr, peer, sf, bw, power): called whenever the radio is retuned,
+    #   bw an index into BANDWIDTHS
+    def __init__(self, lora, role = NODE, node = 0, peers = 1, window = 16, margin = 10,
+                 hysteresis = 3, spreadingFactors = (7, 8, 9, 10, 11, 12),
+                 bandwidths = (125E3, 250E3, 500E3), length = 32, minPower = 2, maxPower = 17,
+                 samples = 4, retries = 3, timeout = None, slack = 200, confirm = None,
+                 fallback = 60000, clock = ticks_ms, transmit = None, onChange = None):
+        self.lora = lora
+        self.role = role
+        self.node = node
+        self.peers = peers if role == CONTROLLER else 1
+        self.window = window
+        self.margin = margin
+        self.hysteresis = hysteresis
+        self.minPower = minPower
+        self.maxPower = maxPower
+        self.samples = samples
+        self.retries = retries
+        self.timeout = timeout
+        self.slack = slack
+        self.confirm = confirm
+        self.fallback = fallback
+        self.clock = clock
+        self.transmit = lora.send if transmit is None else transmit
+        self.onChange = onChange
+        p = lora.parameters
+        # (sf, bw index, demodulation floor + 10 log10(bw / 125 kHz) in quarter dB),
+        # shortest time on air for a `length`-byte packet first
+        candidates = []
+        for sf in spreadingFactors:
+            for bw in bandwidths:
+                bw = bandwidthIndex(bw)
+                candidates.append((sf, bw, int(SNR_FLOOR[sf - 6] * 4) + _bwTerm(bw)))
+        candidates.sort(key=lambda c: timeOnAir(length, c[0], c[1], p['coding_rate'], p['preamble_length'],
+                                                p['enable_CRC'], p['implicitHeader']))
+        self._candidates = candidates
+        # the settings the link starts with, and falls back to
+        self.default = (p['spreading_factor'], bandwidthIndex(p['signal_bandwidth']),
+                        min(max(p['tx_power_level'], 2), 17))
+        n = self.peers
+        self._snr = array('h', [0] * (n * window))    # quarter dB, as measured
+        self._rssi = array('h', [0] * (n * window))   # dBm
+        self._norm = array('h', [0] * (n * window))   # quarter dB at 0 dBm in 125 kHz
+        self._filled = array('H', [0] * n)            # samples in the window
+        self._next = array('H', [0] * n)              # where the next one goes
+        self._fresh = array('H', [0] * n)             # samples since the last change
+        self._heard = [clock()] * n                   # ticks of the last packet from each peer
+        self._sf = bytearray([self.default[0]] * n)
+        self._bw = bytearray([self.default[1]] * n)
+        self._power = bytearray([self.default[2]] * n)
+        self._frame = bytearray(FRAME.size)
+        self.peer = 0   # controller: the peer the radio is set up for, see use()
+        self.state = IDLE
+        self._seq = 0
+        self._target = None
+        self._previous = None
+        self._tries = 0
+        self._sentAt = 0
+        self.stats = {'samples': 0, 'offers': 0, 'changes': 0, 'failed': 0, 'reverted': 0,
+                      'fallbacks': 0, 'frames': 0}
+
+    # --- measurements
+
+    def observe(self, peer = None, snr = None, rssi = None):
+        # adds the last packet's signal (or snr dB / rssi dBm, e.g. from a
+        # PacketRing slot) to peer's window
+        lora = self.lora
+        peer = self.peer if peer is None else peer
+        if snr is None:
+            snr = lora.packetSNR()
+            rssi = lora.packetRssi()
+        p = lora.parameters
+        bw = bandwidthIndex(p['signal_bandwidth'])
+        estimate = snr
+        if snr > SNR_SATURATION:
+            estimate = rssi - (-174 + 10 * math.log10(BANDWIDTHS[bw]) + NOISE_FIGURE)
+        i = peer * self.window + self._next[peer]
+        self._next[peer] = (self._next[peer] + 1) % self.window
+        self._snr[i] = int(round(snr * 4))
+        self._rssi[i] = int(rssi)
+        self._norm[i] = int(round((estimate - p['tx_power_level']) * 4)) + _bwTerm(bw)
+        if self._filled[peer] < self.window:
+            self._filled[peer] += 1
+        if self._fresh[peer] < 0xffff:
+            self._fresh[peer] += 1
+        self._heard[peer] = self.clock()
+        self.stats['samples'] += 1
+
+    def worst(self, peer = None):
+        # lowest normalised SNR in peer's window (quarter dB), None if empty
+        peer = self.peer if peer is None else peer
+        n = self._filled[peer]
+        if n == 0:
+            return None
+        base = peer * self.window
+        worst = self._norm[base]
+        for i in range(base + 1, base + n):
+            if self._norm[i] < worst:
+                worst = self._norm[i]
+        return worst
+
+    def _need(self, sf, bw):
+        return int(SNR_FLOOR[sf - 6] * 4) + _bwTerm(bw)
+
+    def _rank(self, sf, bw):
+        # position in the fastest-first list, settings outside it rank last
+        for i in range(len(self._candidates)):
+            c = self._candidates[i]
+            if c[0] == sf and c[1] == bw:
+                return i
+        return len(self._candidates)
+
+    def _choose(self, norm, margin):
+        extra = int(margin * 4)
+        for sf, bw, need in self._candidates:
+            power = -((norm - need - extra) // 4)   # ceil((need + extra - norm) / 4)
+            if power <= self.maxPower:
+                return (sf, bw, max(power, self.minPower))
+        sf, bw, need = self._candidates[-1]
+        return (sf, bw, self.maxPower)
+
+    def settings(self, peer = None):
+        # (sf, bw index, power) peer is on
+        peer = self.peer if peer is None else peer
+        return (self._sf[peer], self._bw[peer], self._power[peer])
+
+    def headroom(self, peer = None):
+        # dB above the demodulation floor the worst sample of the window leaves
+        # on the current settings, None if the window is empty
+        peer = self.peer if peer is None else peer
+        norm = self.worst(peer)
+        if norm is None:
+            return None
+        sf, bw, power = self.settings(peer)
+        return (norm + 4 * power - self._need(sf, bw)) / 4
+
+    def decide(self, peer = None):
+        # (sf, bw index, power) peer should be on, None if the window is empty
+        peer = self.peer if peer is None else peer
+        norm = self.worst(peer)
+        if norm is None:
+            return None
+        current = self.settings(peer)
+        if self.headroom(peer) < self.margin:
+            return self._choose(norm, self.margin)
+        best = self._choose(norm, self.margin + self.hysteresis)
+        faster = self._rank(best[0], best[1]) < self._rank(current[0], current[1])
+        if faster or (best[:2] == current[:2] and best[2] < current[2]):
+            return best
+        return current
+
+    # --- radio
+
+    def _apply(self, settings, peer = 0):
+        # False while a packet is being sent: configure() would hold the change
+        # back until TX_DONE, and the handshake needs it now
+        lora = self.lora
+        if lora.txBusy():
+            return False
+        sf, bw, power = settings
+        lora.configure(spreading_factor=sf, signal_bandwidth=BANDWIDTHS[bw], tx_power_level=power)
+        if self.onChange:
+            self.onChange(self, peer, sf, bw, power)
+        return True
+
+    def adopt(self, peer = None):
+        # the radio was retuned by hand: take its settings as peer's
+        peer = self.peer if peer is None else peer
+        p = self.lora.parameters
+        self._sf[peer] = p['spreading_factor']
+        self._bw[peer] = bandwidthIndex(p['signal_bandwidth'])
+        self._power[peer] = p['tx_power_level']
+        self._fresh[peer] = 0
+
+    def use(self, peer):
+        # controller: set the radio up for peer, before talking to it
+        if self.state != IDLE:
+            raise Exception('ADR handshake in progress with peer: ', self.peer)
+        if not self._apply(self.settings(peer), peer):
+            raise Exception('Cannot retune while transmitting')
+        self.peer = peer
+
+    def _timeout(self):
+        if self.timeout is not None:
+            return self.timeout
+        return 2 * self.lora.timeOnAir(FRAME.size) // 1000 + self.slack
+
+    def _send(self, kind, node, seq, settings):
+        FRAME.pack_into(self._frame, 0, kind, node, seq, settings[0], settings[1], settings[2])
+        if self.transmit(bytes(self._frame)):
+            self.stats['frames'] += 1
+            return True
+        return False
+
+    # --- receive side: hand every received payload to onReceive()
+
+    def onReceive(self, lora, payload, snr = None, rssi = None):
+        # onReceive(callback) signature, plus the packet's signal when it came
+        # through a PacketRing; measures every packet, returns True when payload
+        # was an ADR frame
+        if len(payload) != FRAME.size or payload[0] not in (KIND_PARAMS, KIND_ACK, KIND_CHECK):
+            if self.role == CONTROLLER:
+                self.observe(None, snr, rssi)
+            else:
+                self._heard[0] = self.clock()
+            return False
+        kind, node, seq, sf, bw, power = FRAME.unpack_from(payload, 0)
+        if self.role == CONTROLLER:
+            if kind == KIND_ACK and node == self.peer and seq == self._seq:
+                self.observe(None, snr, rssi)
+                self._acked()
+            return True
+        if node != self.node:
+            return True
+        self._heard[0] = self.clock()
+        if kind == KIND_PARAMS and self.state == IDLE:
+            if sf < 6 or sf > 12 or bw >= len(BANDWIDTHS):
+                return True
+            self._previous = self.settings(0)
+            self._target = (sf, bw, power)
+            self._seq = seq
+            if self._send(KIND_ACK, self.node, seq, self._target):
+                self.state = SWITCHING
+        elif kind == KIND_CHECK and seq == self._seq:
+            if self.state == CONFIRMING:
+                self._commit(0)
+            # ACKed again if ours got lost
+            self._send(KIND_ACK, self.node, seq, self.settings(0))
+        return True
+
+    def _acked(self):
+        if self.state == OFFERED:
+            # switch and send CHECK from poll(), once the radio is free
+            self.state = CHECKING
+            self._tries = 0
+            self._sentAt = None
+        elif self.state == CHECKING and self._sentAt is not None:
+            self._commit(self.peer)
+
+    def _commit(self, peer):
+        sf, bw, power = self._target
+        self._sf[peer] = sf
+        self._bw[peer] = bw
+        self._power[peer] = power
+        self._fresh[peer] = 0
+        self.state = IDLE
+        self.stats['changes'] += 1
+
+    def _fallBack(self, peer, now):
+        # nothing heard for `fallback` ms: back to the settings the link started with
+        if not self.fallback or self.settings(peer) == self.default:
+            return
+        if ticks_diff(now, self._heard[peer]) < self.fallback or not self._apply(self.default, peer):
+            return
+        self._sf[peer], self._bw[peer], self._power[peer] = self.default
+        self._fresh[peer] = 0
+        self._heard[peer] = now
+        self.stats['fallbacks'] += 1
+
+    # --- main loop
+
+    def poll(self):
+        # returns True while a handshake holds the link: the application should
+        # not transmit then
+        now = self.clock()
+        if self.role == NODE:
+            return self._pollNode(now)
+        peer = self.peer
+        state = self.state
+        if state == IDLE:
+            self._fallBack(peer, now)
+            if self._fresh[peer] < self.samples or self.lora.txBusy():
+                return False
+            target = self.decide(peer)
+            if target is None or target == self.settings(peer):
+                return False
+            self._target = target
+            self._seq = (self._seq + 1) & 0xff
+            self._tries = 0
+            self.state = OFFERED
+            self.stats['offers'] += 1
+            self._offer(now)
+            return True
+        if state == CHECKING and self._sentAt is None:
+            # just ACKed: retune, then make sure the node made it too
+            if self._apply(self._target, peer):
+                self._check(now)
+            return True
+        if self.lora.txBusy() or ticks_diff(now, self._sentAt) < self._timeout():
+            return True
+        if self._tries < self.retries:
+            if state == OFFERED:
+                self._offer(now)
+            else:
+                self._check(now)
+            return True
+        # gave up: the node either never switched or went back by now
+        if state == CHECKING and not self._apply(self.settings(peer), peer):
+            return True
+        if state == CHECKING:
+            self.stats['reverted'] += 1
+        self.stats['failed'] += 1
+        self._fresh[peer] = 0
+        self.state = IDLE
+        return False
+
+    def _offer(self, now):
+        self._tries += 1
+        self._sentAt = now
+        self._send(KIND_PARAMS, self.peer, self._seq, self._target)
+
+    def _check(self, now):
+        self._tries += 1
+        self._sentAt = now
+        self._send(KIND_CHECK, self.peer, self._seq, self._target)
+
+    def _pollNode(self, now):
+        state = self.state
+        if state == IDLE:
+            self._fallBack(0, now)
+            return False
+        if state == SWITCHING:
+            # the ACK went out on the old settings
+            if self._apply(self._target):
+                self.state = CONFIRMING
+                self._sentAt = now
+            return True
+        confirm = self.confirm
+        if confirm is None:
+            confirm = (self.retries + 1) * self._timeout()
+        if ticks_diff(now, self._sentAt) < confirm:
+            return True
+        # no CHECK: the controller didn't get our ACK, or gave up
+        if not self._apply(self._previous):
+            return True
+        self.stats['reverted'] += 1
+        self.state = IDLE
+        return False
+
+    # --- results
+
+    def report(self):
+        print('{0:<6}{1:>4}{2:>8}{3:>6}{4:>9}{5:>8}{6:>8}{7:>10}'.format(
+            'peer', 'SF', 'BW kHz', 'dBm', 'samples', 'SNR', 'RSSI', 'headroom'))
+        for peer in range(self.peers):
+            sf, bw, power = self.settings(peer)
+            n = self._filled[peer]
+            base = peer * self.window
+            snr = min(self._snr[base:base + n]) / 4 if n else 0
+            rssi = min(self._rssi[base:base + n]) if n else 0
+            headroom = self.headroom(peer)
+            print('{0:<6}{1:>4}{2:>8}{3:>6}{4:>9}{5:>8}{6:>8}{7:>10}'.format(
+                peer, sf, BANDWIDTHS[bw] / 1E3, power, self._filled[peer], snr, rssi,
+                '-' if headroom is None else headroom))
+        s = self.stats
+        print('{0} offers, {1} changes, {2} failed, {3} reverted, {4} fallbacks'.format(
+            s['offers'], s['changes'], s['failed'], s['reverted'], s['fallbacks']))
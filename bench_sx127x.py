@@ -0,0 +1,603 @@
+# SPI cost of the SX127x driver's public operations, measured on the simulator.
+# Runs on a PC: python3 bench_sx127x.py
+# For each operation: SPI transactions, bytes on the wire, simulated bus time at
+# the Amigo's 100 kHz, and host wall time (which mostly measures the simulator).
+import contextlib
+import io
+import random
+import time
+
+from sx127x import SX127x, PacketRing, REG_FIFO, BANDWIDTHS, MachineSPI, GC_ALWAYS, GC_EVERY_N, GC_NEVER
+from sx127x_sim import SimSX127x, SimSharedSPI, SimTransport, SimLevelPin, SimClock, link
+from spibus import SpiBus
+from pingpong import PingPong, INITIATOR, RESPONDER
+from bulk import BulkSender, BulkReceiver
+from spectrum import SpectrumScanner
+from adr import AdaptiveDataRate, CONTROLLER, NODE
+
+
+def quiet(fn, *args):
+    # the driver prints to the console; keep the table readable
+    with contextlib.redirect_stdout(io.StringIO()):
+        return fn(*args)
+
+
+def measure(sim, fn, *args, repeat = 1):
+    sim.spi.resetCounters()
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        quiet(fn, *args)
+    wall = (time.perf_counter() - t0) / repeat
+    return (sim.spi.transactions / repeat, sim.spi.bytes / repeat,
+            sim.spi.busTime / repeat, wall)
+
+
+def pair(shadow = False, dio0 = False, **parameters):
+    # two linked radios; dio0: wire the receiver's DIO0; parameters override the defaults
+    a, b = SimSX127x('tx'), SimSX127x('rx')
+    channel = link(a, b)
+    ra = SX127x(spi=a.spi, pin_ss=a.cs, shadow=shadow)
+    rb = SX127x(spi=b.spi, pin_ss=b.cs, shadow=shadow, pin_RxDone=b.dio0 if dio0 else None)
+    for r in (ra, rb):
+        r.parameters.update(parameters)
+    quiet(ra.init)
+    quiet(rb.init)
+    return a, b, ra, rb, channel
+
+
+def operations(shadow = False):
+    a, b, ra, rb, channel = pair(shadow)
+    payload = 'x' * 32
+    rows = []
+
+    def row(name, sim, fn, *args, repeat = 1):
+        rows.append((name,) + measure(sim, fn, *args, repeat=repeat))
+
+    row('init', a, ra.init)
+    row('receivedPacket (idle)', b, rb.receivedPacket, repeat=20)
+    row('print (32 B)', a, ra.print, payload)
+    quiet(rb.receivedPacket)  # RX_DONE pending
+    row('receivedPacket (RX_DONE)', b, rb.receivedPacket)
+    row('read_payload (32 B)', b, rb.read_payload)
+    row('packetRssi', b, rb.packetRssi, repeat=20)
+    row('packetSNR', b, rb.packetSNR, repeat=20)
+    for name, args in (('setFrequency', (868E6,)), ('setSignalBandwidth', (125E3,)),
+                       ('setSpreadingFactor', (10,)), ('setCodingRate', (5,)),
+                       ('setTxPower', (17,)), ('setPreambleLength', (8,)),
+                       ('setSyncWord', (0x12,)), ('enableCRC', (True,))):
+        row(name, a, getattr(ra, name), *args, repeat=20)
+    for sf in (12, 10):
+        rows.append(('configure (SF{0})'.format(sf),) + measure(a, lambda: ra.configure(spreading_factor=sf)))
+    for name in ('getFrequency', 'getSignalBandwidth', 'getSpreadingFactor', 'getCodingRate',
+                 'getTxPower', 'getPreambleLength', 'getSyncWord'):
+        row(name, a, getattr(ra, name), repeat=20)
+    return rows
+
+
+def fifoBursts(sizes = (1, 32, 128, 255)):
+    # FIFO traffic of write() / read_payload(): one transaction of N+1 bytes
+    # (address, then the data) per packet, against a write or read per byte.
+    # write() adds 2 register accesses (payload length), read_payload() 3
+    # (RX address, FIFO pointer, length), 2 bytes each.
+    a, b, ra, rb, channel = pair()
+    print('{0:>6}{1:>16}{2:>16}{3:>16}{4:>16}'.format('bytes', 'burst write', 'per-byte write', 'burst read', 'per-byte read'))
+    for n in sizes:
+        payload = bytes(range(n))
+        burst = measure(a, ra.writeBurst, REG_FIFO, payload)[:2]
+        single = measure(a, lambda: [ra.writeRegister(REG_FIFO, v) for v in payload])[:2]
+        assert burst == (1, n + 1) and single == (n, 2 * n), (burst, single)
+        buffer = bytearray(n)
+        burstRead = measure(a, ra.readBurst, REG_FIFO, buffer)[:2]
+        singleRead = measure(a, lambda: [ra.readRegister(REG_FIFO) for v in payload])[:2]
+        assert burstRead == (1, n + 1) and singleRead == (n, 2 * n), (burstRead, singleRead)
+        # and through the driver's packet path
+        quiet(ra.beginPacket)
+        assert measure(a, ra.write, payload)[:2] == (3, n + 1 + 4)
+        quiet(rb.receivedPacket)
+        quiet(ra.print, 'y' * n)
+        quiet(rb.receivedPacket)
+        assert measure(b, rb.read_payload)[:2] == (4, n + 1 + 6)
+        print('{0:>6}{1:>16}{2:>16}{3:>16}{4:>16}'.format(n, '{0:g} / {1:g} B'.format(*burst), '{0:g} / {1:g} B'.format(*single),
+              '{0:g} / {1:g} B'.format(*burstRead), '{0:g} / {1:g} B'.format(*singleRead)))
+    print()
+
+
+def report(title, rows):
+    print(title)
+    print('{0:<28}{1:>8}{2:>8}{3:>12}{4:>12}'.format('operation', 'xfers', 'bytes', 'bus ms', 'wall us'))
+    for name, xfers, nbytes, bus, wall in rows:
+        print('{0:<28}{1:>8.1f}{2:>8.1f}{3:>12.3f}{4:>12.1f}'.format(name, xfers, nbytes, bus * 1E3, wall * 1E6))
+    print()
+
+
+def exchange(count = 10):
+    # end to end: one radio pings, the other polls like LoRa_Tester does
+    a, b, ra, rb, channel = pair()
+    received = []
+    for i in range(count):
+        quiet(rb.receivedPacket)  # arm RX_SINGLE
+        quiet(ra.print, 'PING #{0}'.format(i))
+        if quiet(rb.receivedPacket):
+            received.append(quiet(rb.read_payload))
+    print('exchange: {0}/{1} delivered, {2:.3f} s simulated, last {3!r} RSSI {4} SNR {5}'.format(
+        len(received), count, channel.now(), received[-1] if received else None,
+        rb.packetRssi(), rb.packetSNR()))
+    print('channel:', channel.stats)
+    print()
+
+
+def sendOnly(count = 5):
+    # a radio with DIO0 wired that never listens: TX_DONE has to come in by
+    # interrupt, nothing calls pollTx()
+    a, b = SimSX127x('tx'), SimSX127x('rx')
+    channel = link(a, b, clock=SimClock())
+    ra = SX127x(spi=a.spi, pin_ss=a.cs, pin_RxDone=a.dio0)
+    quiet(ra.init)
+    done = []
+    for i in range(count):
+        ra.send('SEND ONLY #{0}'.format(i), lambda lora, latency: done.append(latency))
+        while ra.txBusy() and channel.now() < (i + 1) * 2.0:
+            channel.clock.advance(0.001)
+            channel.update()
+    print('send only, DIO0 wired: {0}/{1} sent, {2} TX_DONE callbacks, {3:.3f} s simulated'.format(
+        ra.txStats['sent'], count, len(done), channel.now()))
+    print()
+
+
+def memoryPolicies(count = 50):
+    # host time per packet (print on one side, receivedPacket + read_payload on the
+    # other) under each memory policy; simulated bus time is the same for all
+    print('{0:<28}{1:>12}{2:>12}{3:>8}'.format('memory policy', 'mean us', 'max us', 'gc'))
+    garbage = [[i] * 16 for i in range(20000)]  # give the collector something to walk
+    for name, mode in (('GC_ALWAYS', GC_ALWAYS), ('GC_EVERY_N (8)', GC_EVERY_N), ('GC_NEVER', GC_NEVER)):
+        a, b, ra, rb, channel = pair()
+        for r in (ra, rb):
+            r.setMemoryPolicy(mode, every=8)
+        worst = total = 0.0
+        for i in range(count):
+            quiet(rb.receivedPacket)
+            t0 = time.perf_counter()
+            quiet(ra.print, 'PING #{0}'.format(i))
+            if quiet(rb.receivedPacket):
+                quiet(rb.read_payload)
+            dt = time.perf_counter() - t0
+            total += dt
+            worst = max(worst, dt)
+        collections = ra.memStats['collections'] + rb.memStats['collections']
+        print('{0:<28}{1:>12.1f}{2:>12.1f}{3:>8}'.format(name, total / count * 1E6, worst * 1E6, collections))
+    del garbage
+    print()
+
+
+def receiveModes(count = 40, interval = 0.15, uiTime = 0.12):
+    # A peer sends a packet every `interval` s while the receiver's main loop
+    # spends `uiTime` s redrawing between radio checks (LoRa_Tester's situation).
+    # Polling re-arms RX_SINGLE once per loop; DIO0 + RX_CONTINUOUS never stops listening.
+    # The simulation is deterministic: with the defaults, RX_SINGLE polling gets
+    # exactly 20/40 (5 packets while deaf), the continuous modes everything.
+    defaults = (count, interval, uiTime) == (40, 0.15, 0.12)
+    print('{0:<28}{1:>10}{2:>10}{3:>10}{4:>10}'.format('receive mode', 'sent', 'received', 'deaf', 'xfers'))
+    for mode in ('poll RX_SINGLE', 'DIO0 RX_CONTINUOUS', 'pollRx RX_CONTINUOUS'):
+        a, b, ra, rb, channel = pair(dio0=mode.startswith('DIO0'), spreading_factor=7)
+        ring = PacketRing(8)
+        if 'CONTINUOUS' in mode:
+            rb.onReceive(None, ring=ring)
+            rb.receive()
+        b.spi.resetCounters()
+        received = 0
+        peer = {'sent': 0, 'next': 0.0}
+
+        def spend(seconds):
+            # the receiver is busy; the peer keeps sending on its own schedule
+            for _ in range(int(seconds / 0.01)):
+                channel.clock.advance(0.01)
+                if peer['sent'] < count and channel.now() >= peer['next'] and not ra.txBusy():
+                    ra.send('PING #{0}'.format(peer['sent']))
+                    peer['sent'] += 1
+                    peer['next'] += interval
+                ra.pollTx()
+
+        while peer['sent'] < count or ra.txBusy() or channel.now() < peer['next'] + 1:
+            if mode == 'poll RX_SINGLE':
+                if quiet(rb.receivedPacket):
+                    quiet(rb.read_payload)
+                    received += 1
+            elif mode.startswith('pollRx'):
+                quiet(rb.pollRx)
+            spend(uiTime)
+        sent = peer['sent']
+        if 'CONTINUOUS' in mode:
+            received = rb.rxStats['delivered']
+        print('{0:<28}{1:>10}{2:>10}{3:>10}{4:>10}'.format(mode, sent, received, channel.stats['deaf'], b.spi.transactions))
+        assert sent == count
+        if 'CONTINUOUS' in mode:
+            assert received == count and channel.stats['deaf'] == 0, (mode, received)
+        elif defaults:
+            assert (received, channel.stats['deaf']) == (20, 5), (mode, received, channel.stats['deaf'])
+    print()
+
+
+def pingPong(count = 50, size = 16, step = 0.005):
+    # round trips between two simulated radios, clean link and 10% loss
+    print('{0:<10}{1:>6}{2:>6}{3:>8}{4:>6}{5:>6}{6:>6}{7:>6}{8:>10}'.format(
+        'loss rate', 'sent', 'back', 'loss %', 'p50', 'p90', 'p99', 'max', 'bit/s'))
+    for lossRate in (0.0, 0.1):
+        a, b, ra, rb, channel = pair(spreading_factor=7)
+        channel.lossRate = lossRate
+        channel.random.seed(1)
+        clock = lambda: int(channel.now() * 1000)
+        initiator = PingPong(ra, INITIATOR, count=count, size=size, clock=clock)
+        responder = PingPong(rb, RESPONDER, clock=clock)
+        for radio, pp in ((ra, initiator), (rb, responder)):
+            radio.onReceive(pp.onReceive)
+            radio.receive()
+        while initiator.poll():
+            channel.clock.advance(step)
+            for radio in (ra, rb):
+                radio.pollTx()
+                radio.pollRx()
+        r = initiator.results()
+        print('{0:<10}{1:>6}{2:>6}{3:>8}{4:>6}{5:>6}{6:>6}{7:>6}{8:>10}'.format(
+            lossRate, r['sent'], r['received'], round(r['loss'] * 100, 1), r['rttP50'],
+            r['rttP90'], r['rttP99'], r['rttMax'], r['goodput']))
+    print()
+
+
+def bulkTransfer(size = 3000, step = 0.005):
+    # one bulk transfer per SF/BW, clean link and 10% loss
+    data = bytes(range(256)) * (size // 256 + 1)
+    data = data[:size]
+    print('{0:<10}{1:>4}{2:>8}{3:>10}{4:>8}{5:>10}{6:>8}'.format(
+        'loss rate', 'SF', 'BW kHz', 'fragments', 'resent', 'bit/s', 'ok'))
+    for lossRate in (0.0, 0.1):
+        for sf, bw in ((7, 125E3), (9, 125E3), (7, 250E3)):
+            a, b, ra, rb, channel = pair(spreading_factor=sf, signal_bandwidth=bw)
+            channel.lossRate = lossRate
+            channel.random.seed(1)
+            received = []
+            sender = BulkSender(ra, clock=lambda: int(channel.now() * 1000))
+            receiver = BulkReceiver(rb, size, lambda r, d: received.append(bytes(d)))
+            for radio, end in ((ra, sender), (rb, receiver)):
+                radio.onReceive(end.onReceive)
+                radio.receive()
+            sender.start(data)
+            while sender.poll():
+                channel.clock.advance(step)
+                for radio in (ra, rb):
+                    radio.pollTx()
+                    radio.pollRx()
+            nbytes, ms, transfers, fragments, resent = sender.throughput.get((sf, bw), [0, 0, 0, 0, 0])
+            print('{0:<10}{1:>4}{2:>8}{3:>10}{4:>8}{5:>10}{6:>8}'.format(
+                lossRate, sf, bw / 1E3, sender.count, resent, nbytes * 8 * 1000 // ms if ms else 0,
+                str(received == [data])))
+    print()
+
+
+def dualBand(count = 30, interval = 0.4, uiTime = 0.05, forward = False):
+    # a 433 MHz and an 868 MHz module on one SPI bus (SpiBus), DIO0 wired on
+    # both; a node on each band sends every `interval` s, at the same time.
+    # forward: only the 433 MHz node sends, and the gateway relays each packet
+    # on 868 MHz from the 433 MHz radio's receive callback
+    clock = SimClock()
+    gateways = []
+    nodes = []
+    for frequency in (433E6, 868E6):
+        gw, node = SimSX127x('gw'), SimSX127x('node')
+        link(gw, node, clock=clock)
+        gateways.append(gw)
+        rn = SX127x(spi=node.spi, pin_ss=node.cs)
+        rn.parameters.update(frequency=frequency, spreading_factor=7)
+        quiet(rn.init)
+        nodes.append(rn)
+    spi = SimSharedSPI(gateways)
+    bus = SpiBus()
+    radios = []
+    rings = []
+    for gw, rn in zip(gateways, nodes):
+        r = SX127x(spi=spi, pin_ss=gw.cs, pin_RxDone=gw.dio0)
+        r.parameters.update(frequency=rn.parameters['frequency'], spreading_factor=7)
+        bus.attach(r)
+        quiet(r.init)
+        rings.append(PacketRing(8))
+        r.onReceive(None, ring=rings[-1])
+        r.receive()
+        radios.append(r)
+    relayed = PacketRing(8)
+    if forward:
+        def relay(lora, slot):
+            radios[1].send(bytes(rings[0].packet(slot)))
+        radios[0].onReceive(relay, ring=rings[0])
+        nodes[1].onReceive(None, ring=relayed)
+        nodes[1].receive()
+    senders = 1 if forward else 2
+    sent = [0, 0]
+    due = [0.0, 0.0]
+    while min(sent[:senders]) < count or any(rn.txBusy() for rn in nodes) or clock.now() < max(due) + 1:
+        bus.service()
+        for ring in rings + [relayed]:
+            while ring.first() >= 0:
+                ring.release()
+        for _ in range(int(uiTime / 0.005)):
+            clock.advance(0.005)
+            if forward:
+                nodes[1].pollRx()
+            for i in range(senders):
+                if sent[i] < count and clock.now() >= due[i] and not nodes[i].txBusy():
+                    nodes[i].send('node {0} #{1}'.format(i, sent[i]))
+                    sent[i] += 1
+                    due[i] += interval
+                nodes[i].pollTx()
+    print('{0:<12}{1:>8}{2:>10}{3:>10}'.format('band', 'sent', 'received', 'serviced'))
+    for i, name in enumerate(('433 MHz', '868 MHz')):
+        print('{0:<12}{1:>8}{2:>10}{3:>10}'.format(name, sent[i], radios[i].rxStats['delivered'],
+              bus.stats['serviced'][i]))
+    if forward:
+        print('relayed on 868 MHz: {0} sent by the gateway, {1} received by the node'.format(
+              radios[1].txStats['sent'], nodes[1].rxStats['delivered']))
+    print('bus conflicts: {0}, at most {1} radios pending at once'.format(bus.stats['conflicts'], bus.stats['maxPending']))
+    print()
+
+
+def listenBeforeTalk(nodes = 5, count = 20, interval = 0.5, size = 20, step = 0.002):
+    # `nodes` radios send to one gateway at random times, `interval` s apart on
+    # average each: plain ALOHA against a CAD before every packet, with and
+    # without backoff after a busy CAD
+    print('{0:<12}{1:>8}{2:>10}{3:>12}{4:>8}{5:>10}'.format('access', 'sent', 'received', 'collisions', 'busy', 'dropped'))
+    random.seed(1)  # the drivers draw their backoffs from random
+    for name, lbt, maxBackoff in (('ALOHA', False, 0), ('LBT', True, 5000), ('LBT, no wait', True, 0)):
+        clock = SimClock()
+        ticks = lambda: int(clock.now() * 1000)
+        gw = SimSX127x('gw')
+        sims = [SimSX127x('node{0}'.format(i)) for i in range(nodes)]
+        channel = link(gw, *sims, clock=clock, seed=1)
+        rg = SX127x(spi=gw.spi, pin_ss=gw.cs, clock=ticks)
+        rg.parameters.update(spreading_factor=7)
+        quiet(rg.init)
+        ring = PacketRing(8)
+        rg.onReceive(None, ring=ring)
+        rg.receive()
+        radios = []
+        for sim in sims:
+            r = SX127x(spi=sim.spi, pin_ss=sim.cs, clock=ticks)
+            r.parameters.update(spreading_factor=7)
+            quiet(r.init)
+            r.setListenBeforeTalk(lbt, maxBackoff=maxBackoff)
+            radios.append(r)
+        rnd = random.Random(2)
+        due = [rnd.uniform(0, interval) for _ in radios]
+        sent = [0] * nodes
+        payload = bytes(size)
+        while min(sent) < count or any(r.txBusy() for r in radios) or clock.now() < max(due) + 1:
+            clock.advance(step)
+            for i, r in enumerate(radios):
+                if sent[i] < count and clock.now() >= due[i] and not r.txBusy():
+                    r.send(payload)
+                    sent[i] += 1
+                    due[i] = clock.now() + rnd.expovariate(1 / interval)
+                r.pollTx()
+            rg.pollRx()
+            while ring.first() >= 0:
+                ring.release()
+        busy = sum(r.txStats['busy'] for r in radios)
+        dropped = sum(r.txStats['lbtDropped'] for r in radios)
+        print('{0:<12}{1:>8}{2:>10}{3:>12}{4:>8}{5:>10}'.format(name, sum(sent),
+              rg.rxStats['delivered'], channel.stats['collisions'], busy, dropped))
+    print()
+
+
+def sniffReceive(count = 20, interval = 1.0, sniff = 100, step = 0.002):
+    # a packet every `interval` s; the receiver listens all the time, or sleeps
+    # and runs a CAD every `sniff` ms. The sender's preamble covers the gap.
+    print('{0:<20}{1:>8}{2:>10}{3:>12}{4:>8}{5:>14}'.format('receive mode', 'sent', 'received', 'radio on %', 'CADs', 'false alarms'))
+    for mode in ('RX_CONTINUOUS', 'sniff {0} ms'.format(sniff)):
+        a, b, ra, rb, channel = pair(spreading_factor=7)
+        ra.clock = rb.clock = lambda: int(channel.now() * 1000)
+        # enough preamble symbols (about 1 ms each at SF7) for a sleeping receiver to find it
+        ra.setPreambleLength(sniff + 20)
+        ring = PacketRing(8)
+        rb.onReceive(None, ring=ring)
+        if mode == 'RX_CONTINUOUS':
+            rb.receive()
+        else:
+            rb.receiveSniff(sniff)
+        start = channel.now()
+        sent = 0
+        due = 0.1
+        while sent < count or ra.txBusy() or channel.now() < due + 1:
+            channel.clock.advance(step)
+            if sent < count and channel.now() >= due and not ra.txBusy():
+                ra.send('PING #{0}'.format(sent))
+                sent += 1
+                due += interval
+            ra.pollTx()
+            rb.pollRx()
+            while ring.first() >= 0:
+                ring.release()
+        elapsed = (channel.now() - start) * 1000
+        stats = rb.sniffStats
+        on = stats['onMs'] if stats['cads'] else elapsed
+        print('{0:<20}{1:>8}{2:>10}{3:>12.1f}{4:>8}{5:>14}'.format(mode, sent, rb.rxStats['delivered'],
+              100 * on / elapsed, stats['cads'], stats['falseAlarms']))
+    print()
+
+
+def spectrumScan(start = 433.05E6, stop = 434.79E6, step = 25E3, samples = 8):
+    # two nodes send long packets back to back at 433.5 and 434.2 MHz while a
+    # third radio sweeps the band
+    clock = SimClock()
+    scanner = SimSX127x('scanner')
+    sims = [SimSX127x('node0'), SimSX127x('node1')]
+    link(scanner, *sims, clock=clock)
+    nodes = []
+    for sim, frequency in zip(sims, (433.5E6, 434.2E6)):
+        r = SX127x(spi=sim.spi, pin_ss=sim.cs)
+        r.parameters.update(frequency=frequency, spreading_factor=10)
+        quiet(r.init)
+        nodes.append(r)
+    rs = SX127x(spi=scanner.spi, pin_ss=scanner.cs, shadow=True, clock=lambda: int(clock.now() * 1000))
+    quiet(rs.init)
+    scan = SpectrumScanner(rs, start, stop, step, samples)
+    for r in nodes:
+        r.send(bytes(200))
+    clock.advance(0.01)
+    scanner.spi.resetCounters()
+    scan.sweep()
+    loud = [i for i in range(scan.channels) if scan.maximum[i] > -100]
+    print('sweep: {0} channels, {1} ms simulated, {2} SPI transactions, {3} FRF bytes written (setFrequency: {4})'.format(
+          scan.channels, scan.stats['lastMs'], scanner.spi.transactions, scan.stats['frfBytes'], 3 * scan.channels))
+    print('busy channels: {0}'.format(', '.join('{0:.3f} MHz {1} dBm'.format(scan.frequency(i) / 1E6, scan.maximum[i]) for i in loud)))
+    print('back on {0:.3f} MHz, shadow cache in sync: {1}'.format(rs.getFrequency() / 1E6, not rs.verifyShadow()))
+    print()
+
+
+def transports(count = 50, size = 200):
+    # the same link through SimSPI's byte-by-byte SPI and through SimTransport;
+    # the receiver waits on DIO0 with waitIrq(), as a Linux gateway would
+    print('{0:<14}{1:>10}{2:>8}{3:>10}{4:>10}{5:>10}'.format('transport', 'received', 'xfers', 'bytes', 'bus ms', 'host ms'))
+    for name in ('SimSPI', 'SimTransport'):
+        a, b = SimSX127x('tx'), SimSX127x('rx')
+        link(a, b)
+        if name == 'SimSPI':
+            ra = SX127x(spi=a.spi, pin_ss=a.cs)
+            rb = SX127x(transport=MachineSPI(b.spi, b.cs), pin_RxDone=SimLevelPin(b))
+            waiter = SimTransport(b)   # only lets simulated time run
+        else:
+            ra = SX127x(transport=SimTransport(a))
+            rb = SX127x(transport=SimTransport(b, dio0=True))
+            waiter = rb.transport
+        for r in (ra, rb):
+            r.parameters.update(spreading_factor=7)
+            quiet(r.init)
+        ring = PacketRing(4)
+        rb.onReceive(None, ring=ring)
+        rb.receive()
+        b.spi.resetCounters()
+        payload = bytes(size)
+        t0 = time.perf_counter()
+        for i in range(count):
+            ra.send(payload)
+            if waiter is rb.transport:
+                rb.waitIrq(1000)
+            elif waiter.waitIrq(1000):
+                rb.handleOnDio0(None)
+            ra.pollTx()
+            while ring.first() >= 0:
+                ring.release()
+        wall = (time.perf_counter() - t0) * 1000
+        print('{0:<14}{1:>10}{2:>8}{3:>10}{4:>10.1f}{5:>10.1f}'.format(name, rb.rxStats['delivered'],
+              b.spi.transactions, b.spi.bytes, b.spi.busTime * 1000, wall))
+    print()
+
+def turnaround(count = 20, size = 32):
+    # request / response: the responder (DIO0 wired) answers each request with a
+    # reply it prepared beforehand. Turnaround: end of the request on air to
+    # start of the reply, all of it SPI traffic at 100 kHz.
+    print('{0:<18}{1:>8}{2:>8}{3:>16}{4:>18}'.format('responder FIFO', 'asked', 'intact', 'turnaround ms', 'xfers per reply'))
+    for split in (False, True):
+        a, b, ra, rb, channel = pair(dio0=True, spreading_factor=7)
+        replies = PacketRing(4)
+        ra.onReceive(None, ring=replies)
+        ra.receive()
+        reply = bytes(range(size))
+        xfers = [0]
+
+        def answer(lora, slot):
+            start = b.spi.transactions
+            if split:
+                lora.sendPreloaded(restage)
+            else:
+                lora.send(reply)
+            xfers[0] += b.spi.transactions - start
+
+        def restage(lora, latency):
+            lora.preload(reply)
+        rb.onReceive(answer, ring=PacketRing(4))
+        rb.receive()
+        if split:
+            rb.setDoubleBuffer()
+            rb.preload(reply)
+        intact = 0
+        gaps = []
+        for i in range(count):
+            ra.send('REQ #{0}'.format(i))
+            while replies.first() < 0 and channel.now() < 1000:
+                channel.clock.advance(0.001)
+                ra.pollTx()
+                rb.pollTx()
+                ra.pollRx()
+            request, response = channel.air[-2], channel.air[-1]
+            gaps.append(response['start'] - request['end'])
+            if bytes(replies.packet(replies.first())) == reply:
+                intact += 1
+            replies.release()
+        print('{0:<18}{1:>8}{2:>8}{3:>16.2f}{4:>18.1f}'.format('split' if split else 'shared', count, intact,
+              1000 * sum(gaps) / len(gaps), xfers[0] / count))
+    print()
+
+
+def adaptiveDataRate(seconds = 60, size = 16, step = 0.001):
+    # ping/pong for `seconds` simulated s through a strong, a fair and a weak link
+    # (path loss in dB), starting on LoRa_Tester's SF12 / 125 kHz / 17 dBm: fixed
+    # settings against ADR. Airtime: both directions, per round trip. 1 ms steps:
+    # at 500 kHz the pong comes back quicker than 5 ms polling notices TX_DONE.
+    print('{0:<10}{1:<8}{2:>6}{3:>8}{4:>10}{5:>14}{6:>16}'.format(
+        'path loss', 'link', 'back', 'loss %', 'bit/s', 'airtime ms', 'ends on'))
+    for loss in (120, 130, 150):
+        for name in ('SF12', 'SF10', 'ADR'):
+            sf = 10 if name == 'SF10' else 12
+            a, b, ra, rb, channel = pair(spreading_factor=sf, signal_bandwidth=125E3, tx_power_level=17)
+            channel.setPathLoss(a, b, loss)
+            clock = lambda: int(channel.now() * 1000)
+            airtime = [0]
+
+            def counted(lora):
+                def transmit(payload):
+                    if not lora.send(payload):
+                        return False
+                    airtime[0] += lora.timeOnAir(len(payload))
+                    return True
+                return transmit
+            pp = PingPong(ra, INITIATOR, count=0xffff, size=size, clock=clock, transmit=counted(ra))
+            echo = PingPong(rb, RESPONDER, clock=clock, transmit=counted(rb))
+            gateway = AdaptiveDataRate(ra, CONTROLLER, length=size, clock=clock, transmit=counted(ra))
+            node = AdaptiveDataRate(rb, NODE, clock=clock, transmit=counted(rb))
+            for radio, adr, end in ((ra, gateway, pp), (rb, node, echo)):
+                radio.onReceive(lambda lora, p, adr=adr, end=end: adr.onReceive(lora, p) or end.onReceive(lora, p))
+                radio.receive()
+            adaptive = name == 'ADR'
+            while channel.now() < seconds:
+                if not (adaptive and gateway.poll()):
+                    pp.poll()
+                if adaptive:
+                    node.poll()
+                channel.clock.advance(step)
+                for radio in (ra, rb):
+                    radio.pollTx()
+                    radio.pollRx()
+            r = pp.results()
+            sf, bw, power = gateway.settings() if adaptive else (sf, 7, 17)
+            print('{0:<10}{1:<8}{2:>6}{3:>8}{4:>10}{5:>14}{6:>16}'.format(
+                loss, name, r['received'], round(r['loss'] * 100, 1), r['goodput'],
+                round(airtime[0] / 1000 / r['received'], 1) if r['received'] else '-',
+                'SF{0}/{1:g}k/{2}dBm'.format(sf, BANDWIDTHS[bw] / 1E3, power)))
+    print()
+
+
+if __name__ == '__main__':
+    report('SX127x over SPI, shadow cache off', operations(False))
+    report('SX127x over SPI, shadow cache on', operations(True))
+    fifoBursts()
+    exchange()
+    sendOnly()
+    memoryPolicies()
+    receiveModes()
+    pingPong()
+    bulkTransfer()
+    dualBand()
+    dualBand(forward=True)
+    listenBeforeTalk()
+    sniffReceive()
+    spectrumScan()
+    transports()
+    turnaround()
+    adaptiveDataRate()
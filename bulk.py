@@ -0,0 +1,262 @@
+# Bulk transfers: byte buffers larger than one LoRa packet (sensor dumps, camera
+# thumbnails) are split into numbered fragments and sent back to back, with no
+# reconfiguration in between. The receiver reassembles them into a
+# preallocated buffer, keeps a bitmap of what arrived, and after each burst
+# answers with the list of missing fragments. Only those are sent again.
+#
+#   sender = BulkSender(lora)                 receiver = BulkReceiver(lora, 8192, onComplete)
+#   lora.onReceive(sender.onReceive)          lora.onReceive(receiver.onReceive)
+#   sender.start(data)
+#   while sender.poll(): ...                  # from the main loop
+#   sender.report()
+#
+# Frames: HEADER, then data (DATA, DATA_END) or a bitmap of missing fragments,
+# 1 bit per fragment (STATUS; no bit set: transfer complete).
+try:
+    import ustruct as struct
+except ImportError:
+    import struct
+
+from sx127x import MAX_PKT_LENGTH, ticks_ms, ticks_diff
+
+HEADER = struct.Struct('<BBBBH')  # kind, transfer id, fragment index, fragment count, byte offset
+KIND_DATA = 0xb1
+KIND_DATA_END = 0xb2    # last fragment of a burst: the receiver answers with a STATUS
+KIND_STATUS = 0xb3
+MAX_FRAGMENTS = 255
+FRAGMENT_SIZE = MAX_PKT_LENGTH - HEADER.size
+
+# BulkSender.state
+IDLE = 0
+SENDING = 1
+WAITING = 2     # for the receiver's STATUS
+DONE = 3
+FAILED = 4
+
+
+def _bitmapSize(count):
+    return (count + 7) >> 3
+
+
+class BulkSender:
+    # transmit(frame) -> True if the radio took the frame (lora.send by default).
+    # It must hand the frame over at once or refuse it: frame buffers are reused.
+    def __init__(self, lora, fragmentSize = FRAGMENT_SIZE, timeout = None, retries = 3,
+                 margin = 300, clock = ticks_ms, transmit = None, onDone = None):
+        self.lora = lora
+        self.fragmentSize = min(fragmentSize, FRAGMENT_SIZE)
+        self.timeout = timeout
+        self.retries = retries
+        self.margin = margin
+        self.clock = clock
+        self.transmit = lora.send if transmit is None else transmit
+        self.onDone = onDone    # onDone(sender, ok)
+        # one frame per TX queue entry, plus the one being filled
+        self._pool = [bytearray(HEADER.size + self.fragmentSize) for _ in range(lora.maxTxQueue + 1)]
+        self._next = 0
+        self._missing = bytearray(_bitmapSize(MAX_FRAGMENTS))
+        self._id = 0
+        self.state = IDLE
+        self.throughput = {}    # (sf, bw): [bytes, ms, transfers, fragments, retransmits]
+        self.stats = {'transfers': 0, 'failed': 0, 'fragments': 0, 'retransmits': 0, 'timeouts': 0}
+
+    def start(self, data):
+        if len(data) > MAX_FRAGMENTS * self.fragmentSize or len(data) > 0xffff:
+            raise Exception('Too large for one transfer: ', len(data))
+        self.data = memoryview(data)
+        self.count = max(1, (len(data) + self.fragmentSize - 1) // self.fragmentSize)
+        self._id = (self._id + 1) & 0xff
+        for i in range(len(self._missing)):
+            self._missing[i] = 0
+        for i in range(self.count):
+            self._missing[i >> 3] |= 1 << (i & 7)
+        self._sent = 0          # fragments of this transfer handed to the radio
+        self._retransmits = 0
+        self._retries = 0
+        self._burst()
+        self._started = self.clock()
+        self.state = SENDING
+        self.poll()
+
+    def busy(self):
+        return self.state == SENDING or self.state == WAITING
+
+    def _burst(self):
+        # the fragments to (re)send, from the missing bitmap
+        self._queue = [i for i in range(self.count) if self._missing[i >> 3] & (1 << (i & 7))]
+        self._pos = 0
+
+    def _frame(self, index, last):
+        offset = index * self.fragmentSize
+        chunk = self.data[offset:offset + self.fragmentSize]
+        frame = self._pool[self._next]
+        self._next = (self._next + 1) % len(self._pool)
+        HEADER.pack_into(frame, 0, KIND_DATA_END if last else KIND_DATA, self._id, index, self.count, offset)
+        frame[HEADER.size:HEADER.size + len(chunk)] = chunk
+        return memoryview(frame)[:HEADER.size + len(chunk)]
+
+    def _timeout(self):
+        if self.timeout is not None:
+            return self.timeout
+        # our last fragment's airtime, then the receiver's STATUS
+        toa = self.lora.timeOnAir(HEADER.size + self.fragmentSize) + \
+            self.lora.timeOnAir(HEADER.size + _bitmapSize(self.count))
+        return toa // 1000 + self.margin
+
+    def poll(self):
+        # keeps the TX queue fed; returns False when the transfer is over
+        if self.state == SENDING:
+            while self._pos < len(self._queue):
+                index = self._queue[self._pos]
+                last = self._pos == len(self._queue) - 1
+                if self.lora.txQueueDepth() >= self.lora.maxTxQueue or \
+                        not self.transmit(self._frame(index, last)):
+                    return True
+                self._pos += 1
+                self._sent += 1
+                self.stats['fragments'] += 1
+            if not self.lora.txBusy():
+                self.state = WAITING
+                self._waitStart = self.clock()
+        elif self.state == WAITING:
+            if ticks_diff(self.clock(), self._waitStart) >= self._timeout():
+                self.stats['timeouts'] += 1
+                self._retries += 1
+                if self._retries > self.retries:
+                    self._finish(False)
+                    return False
+                # no STATUS: send the last fragment again to ask for one
+                self._queue = [self.count - 1]
+                self._pos = 0
+                self._retransmits += 1
+                self.stats['retransmits'] += 1
+                self.state = SENDING
+        return self.busy()
+
+    def onReceive(self, lora, payload):
+        # onReceive(callback) signature; returns True when payload was a STATUS for us
+        if len(payload) < HEADER.size:
+            return False
+        kind, tid, index, count, offset = HEADER.unpack_from(payload, 0)
+        if kind != KIND_STATUS:
+            return False
+        if tid != self._id or not self.busy():
+            return True
+        n = _bitmapSize(self.count)
+        missing = False
+        for i in range(n):
+            b = payload[HEADER.size + i] if HEADER.size + i < len(payload) else 0
+            self._missing[i] = b
+            missing = missing or b != 0
+        if not missing:
+            self._finish(True)
+            return True
+        if self.state == WAITING or self._pos >= len(self._queue):
+            self._burst()
+            self._retransmits += len(self._queue)
+            self.stats['retransmits'] += len(self._queue)
+            self._retries = 0
+            self.state = SENDING
+        return True
+
+    def _finish(self, ok):
+        elapsed = ticks_diff(self.clock(), self._started)
+        self.state = DONE if ok else FAILED
+        if ok:
+            self.stats['transfers'] += 1
+            p = self.lora.parameters
+            key = (p['spreading_factor'], p['signal_bandwidth'])
+            t = self.throughput.setdefault(key, [0, 0, 0, 0, 0])
+            t[0] += len(self.data)
+            t[1] += elapsed
+            t[2] += 1
+            t[3] += self._sent
+            t[4] += self._retransmits
+        else:
+            self.stats['failed'] += 1
+        self.elapsed = elapsed
+        if self.onDone:
+            self.onDone(self, ok)
+
+    def report(self):
+        print('{0:>4}{1:>8}{2:>10}{3:>10}{4:>10}{5:>12}'.format('SF', 'BW kHz', 'transfers', 'bytes', 'resent', 'bit/s'))
+        for key in sorted(self.throughput):
+            sf, bw = key
+            nbytes, ms, transfers, fragments, resent = self.throughput[key]
+            print('{0:>4}{1:>8}{2:>10}{3:>10}{4:>10}{5:>12}'.format(
+                sf, bw / 1E3, transfers, nbytes, resent, nbytes * 8 * 1000 // ms if ms else 0))
+
+
+class BulkReceiver:
+    # Reassembles into one preallocated buffer of maxSize bytes;
+    # onComplete(receiver, data) gets a memoryview into it, valid until the next transfer.
+    # Nothing runs on a timer here: the sender asks for a STATUS when it needs one.
+    def __init__(self, lora, maxSize = 8192, onComplete = None, transmit = None):
+        self.lora = lora
+        self.buffer = bytearray(maxSize)
+        self.onComplete = onComplete
+        self.transmit = lora.send if transmit is None else transmit
+        self._have = bytearray(_bitmapSize(MAX_FRAGMENTS))
+        self._status = bytearray(HEADER.size + _bitmapSize(MAX_FRAGMENTS))
+        self._id = -1
+        self.count = 0
+        self.length = 0
+        self.complete = False
+        self.stats = {'fragments': 0, 'duplicates': 0, 'transfers': 0, 'tooLarge': 0, 'status': 0}
+
+    def onReceive(self, lora, payload):
+        # onReceive(callback) signature; returns True when payload was a fragment
+        if len(payload) < HEADER.size:
+            return False
+        kind, tid, index, count, offset = HEADER.unpack_from(payload, 0)
+        if kind != KIND_DATA and kind != KIND_DATA_END:
+            return False
+        if tid != self._id:
+            # a new transfer
+            self._id = tid
+            self.count = count
+            self.length = 0
+            self.complete = False
+            for i in range(len(self._have)):
+                self._have[i] = 0
+        size = len(payload) - HEADER.size
+        if offset + size > len(self.buffer) or index >= count:
+            self.stats['tooLarge'] += 1
+            return True
+        bit = 1 << (index & 7)
+        if self._have[index >> 3] & bit:
+            self.stats['duplicates'] += 1
+        else:
+            self.buffer[offset:offset + size] = memoryview(payload)[HEADER.size:]
+            self._have[index >> 3] |= bit
+            self.stats['fragments'] += 1
+            if index == count - 1:
+                self.length = offset + size
+        if kind == KIND_DATA_END:
+            self._answer()
+        return True
+
+    def missing(self):
+        n = 0
+        for i in range(self.count):
+            if not self._have[i >> 3] & (1 << (i & 7)):
+                n += 1
+        return n
+
+    def _answer(self):
+        # STATUS with the bitmap of missing fragments; empty: all there
+        n = _bitmapSize(self.count)
+        status = self._status
+        HEADER.pack_into(status, 0, KIND_STATUS, self._id, 0, self.count, 0)
+        for i in range(n):
+            status[HEADER.size + i] = ~self._have[i] & 0xff
+        extra = self.count & 7
+        if extra:
+            status[HEADER.size + n - 1] &= (1 << extra) - 1
+        self.transmit(bytes(status[:HEADER.size + n]))
+        self.stats['status'] += 1
+        if not self.complete and self.missing() == 0:
+            self.complete = True
+            self.stats['transfers'] += 1
+            if self.onComplete:
+                self.onComplete(self, memoryview(self.buffer)[:self.length])
@@ -1,17 +1,28 @@
-import sensor, lcd, time
+import sensor, lcd
+from stagetimer import StageTimer
+
+REPORT_EVERY = 100 # frames between two reports: printing every frame slows the loop down
+DOUBLE_BUFFER = True # capture frame N+1 while frame N is displayed, if the firmware can
 
-clock = time.clock()
 sensor.reset()
 sensor.set_pixformat(sensor.RGB565)
 sensor.set_framesize(sensor.QVGA)
+if DOUBLE_BUFFER and hasattr(sensor, 'set_double_buff'):
+    sensor.set_double_buff(True)
+    print("Double buffering on")
 sensor.run(1)
 sensor.skip_frames()
 
 lcd.init(freq=15000000)
 
+timer = StageTimer(('snapshot', 'process', 'display'), every=REPORT_EVERY)
 while(True):
-    clock.tick()
+    timer.start()
     img = sensor.snapshot()
-    fps =clock.fps()
-    print("%2.1ffps" %(fps))
+    timer.mark(0)
+    # processing goes here
+    timer.mark(1)
     lcd.display(img)
+    timer.mark(2)
+    if timer.frame():
+        timer.report()
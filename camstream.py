@@ -0,0 +1,342 @@
+# Camera frames over LoRa.
+# Frames are small grayscale images (80x60 by default) cut into square tiles.
+# Each frame is compared with what the receiver last got, and only the tiles that
+# changed are sent, plus a few unchanged ones in rotation so that a lost packet
+# is healed after a while. A tile is sent whole (not as a delta), so losing one
+# packet never corrupts later frames. Pixels are quantized to 4 bits, and each
+# tile goes either run-length coded or as packed nibbles, whichever is shorter.
+#
+# Runs on a PC too: python3 camstream.py encodes synthetic frames, decodes them
+# and prints bytes per frame and encode time.
+#
+# Packet: PACKET header, then per tile: index u8, length u8 (bit 7: RLE), data.
+try:
+    import ustruct as struct
+except ImportError:
+    import struct
+
+import time
+
+from sx127x import MAX_PKT_LENGTH
+
+try:
+    ticks_us = time.ticks_us
+    ticks_diff = time.ticks_diff
+except AttributeError:  # CPython
+    def ticks_us():
+        return int(time.perf_counter() * 1000000)
+    def ticks_diff(a, b):
+        return a - b
+
+PACKET = struct.Struct('<BBB')   # kind, frame number, tiles in this packet
+KIND_TILES = 0xc1
+RLE_FLAG = 0x80
+
+
+def downsample(src, srcWidth, srcHeight, dst, width, height):
+    # nearest-neighbour shrink of an 8-bit grayscale image, into dst
+    i = 0
+    for y in range(height):
+        row = (y * srcHeight // height) * srcWidth
+        for x in range(width):
+            dst[i] = src[row + x * srcWidth // width]
+            i += 1
+    return dst
+
+
+class TileEncoder:
+    # threshold: sum of absolute differences (4-bit levels) above which a tile
+    # counts as changed; refresh: unchanged tiles resent per frame, in rotation
+    def __init__(self, width = 80, height = 60, tile = 10, threshold = 24, refresh = 1):
+        if width % tile or height % tile:
+            raise Exception('Frame size must be a multiple of the tile size: ', tile)
+        self.width = width
+        self.height = height
+        self.tile = tile
+        self.cols = width // tile
+        self.tiles = self.cols * (height // tile)
+        self.threshold = threshold
+        self.refresh = refresh
+        self.frame = bytearray(width * height)      # current frame, 4-bit levels
+        self.reference = bytearray(width * height)  # what the receiver has
+        self._scratch = bytearray(tile * tile)      # worst-case tile encoding
+        self._order = 0
+        self.number = 0
+        self.stats = {'frames': 0, 'tiles': 0, 'bytes': 0, 'lastUs': 0, 'maxUs': 0, 'totalUs': 0}
+
+    def _origin(self, index):
+        return (index // self.cols) * self.tile * self.width + (index % self.cols) * self.tile
+
+    def encode(self, image):
+        # quantize an 8-bit grayscale frame; returns the tile indexes worth
+        # sending, most changed first
+        t0 = ticks_us()
+        frame = self.frame
+        for i in range(len(frame)):
+            frame[i] = image[i] >> 4
+        changed = []
+        for index in range(self.tiles):
+            d = self._difference(index)
+            if d > self.threshold:
+                changed.append((d, index))
+        changed.sort(reverse=True)
+        tiles = [index for d, index in changed]
+        for _ in range(min(self.refresh, self.tiles - len(tiles))):
+            # next unchanged tile in rotation
+            while self._order in tiles:
+                self._order = (self._order + 1) % self.tiles
+            tiles.append(self._order)
+            self._order = (self._order + 1) % self.tiles
+        self.number = (self.number + 1) & 0xff
+        self.stats['frames'] += 1
+        self.stats['lastUs'] = 0
+        self._time(t0)
+        return tiles
+
+    def _time(self, t0):
+        # encode time of the current frame: encode() plus packets()
+        dt = ticks_diff(ticks_us(), t0)
+        stats = self.stats
+        stats['lastUs'] += dt
+        stats['totalUs'] += dt
+        if stats['lastUs'] > stats['maxUs']:
+            stats['maxUs'] = stats['lastUs']
+
+    def _difference(self, index):
+        frame = self.frame
+        reference = self.reference
+        start = self._origin(index)
+        total = 0
+        for y in range(self.tile):
+            p = start + y * self.width
+            for x in range(p, p + self.tile):
+                d = frame[x] - reference[x]
+                total += d if d >= 0 else -d
+        return total
+
+    def encodeTile(self, index, out, offset):
+        # writes index, length and data at out[offset:]; returns the bytes written,
+        # 0 if it doesn't fit
+        frame = self.frame
+        start = self._origin(index)
+        rle = self._scratch     # one byte per run of up to 16: never more than a byte per pixel
+        n = 0
+        run = 0
+        value = -1
+        for y in range(self.tile):
+            p = start + y * self.width
+            for x in range(p, p + self.tile):
+                v = frame[x]
+                if v == value and run < 16:
+                    run += 1
+                else:
+                    if run:
+                        rle[n] = ((run - 1) << 4) | value
+                        n += 1
+                    value = v
+                    run = 1
+        rle[n] = ((run - 1) << 4) | value
+        n += 1
+        packed = self.tile * self.tile // 2
+        size = min(n, packed)
+        if offset + 2 + size > len(out):
+            return 0
+        out[offset] = index
+        if n < packed:
+            out[offset + 1] = RLE_FLAG | n
+            out[offset + 2:offset + 2 + n] = rle[:n]
+        else:
+            out[offset + 1] = packed
+            o = offset + 2
+            for y in range(self.tile):
+                p = start + y * self.width
+                for x in range(p, p + self.tile, 2):
+                    out[o] = (frame[x] << 4) | frame[x + 1]
+                    o += 1
+        return 2 + size
+
+    def packets(self, tiles, maxPackets = 2, size = MAX_PKT_LENGTH):
+        # packs tiles into at most maxPackets packets; returns [(packet, [tile indexes])]
+        t0 = ticks_us()
+        out = []
+        pos = 0
+        while pos < len(tiles) and len(out) < maxPackets:
+            buf = bytearray(size)
+            offset = PACKET.size
+            sent = []
+            while pos < len(tiles):
+                n = self.encodeTile(tiles[pos], buf, offset)
+                if n == 0:
+                    break
+                offset += n
+                sent.append(tiles[pos])
+                pos += 1
+            if not sent:
+                break
+            PACKET.pack_into(buf, 0, KIND_TILES, self.number, len(sent))
+            out.append((memoryview(buf)[:offset], sent))
+            self.stats['bytes'] += offset
+            self.stats['tiles'] += len(sent)
+        self._time(t0)
+        return out
+
+    def commit(self, tiles):
+        # these tiles reached the radio: the receiver now has them
+        for index in tiles:
+            start = self._origin(index)
+            for y in range(self.tile):
+                p = start + y * self.width
+                self.reference[p:p + self.tile] = self.frame[p:p + self.tile]
+
+
+class TileDecoder:
+    def __init__(self, width = 80, height = 60, tile = 10):
+        self.width = width
+        self.height = height
+        self.tile = tile
+        self.cols = width // tile
+        self.tiles = self.cols * (height // tile)
+        self.frame = bytearray(width * height)  # 8-bit grayscale
+        self.number = -1
+        self.stats = {'packets': 0, 'tiles': 0, 'errors': 0}
+
+    def decode(self, packet):
+        # applies a tile packet; returns the tiles updated, -1 if not one.
+        # A tile that doesn't fit the frame or the packet counts as an error
+        # and ends the packet: nothing after it can be trusted.
+        if len(packet) < PACKET.size:
+            return -1
+        kind, number, count = PACKET.unpack_from(packet, 0)
+        if kind != KIND_TILES:
+            return -1
+        self.number = number
+        self.stats['packets'] += 1
+        offset = PACKET.size
+        packed = self.tile * self.tile // 2
+        done = 0
+        for _ in range(count):
+            if offset + 2 > len(packet):
+                self.stats['errors'] += 1
+                break
+            index = packet[offset]
+            length = packet[offset + 1]
+            rle = length & RLE_FLAG
+            length &= ~RLE_FLAG
+            offset += 2
+            if index >= self.tiles or offset + length > len(packet) or (not rle and length != packed):
+                self.stats['errors'] += 1
+                break
+            if rle:
+                self._rle(index, packet, offset, length)
+            else:
+                self._packed(index, packet, offset)
+            offset += length
+            done += 1
+            self.stats['tiles'] += 1
+        return done
+
+    def _origin(self, index):
+        return (index // self.cols) * self.tile * self.width + (index % self.cols) * self.tile
+
+    def _rle(self, index, data, offset, length):
+        frame = self.frame
+        start = self._origin(index)
+        t = self.tile
+        i = 0
+        for o in range(offset, offset + length):
+            b = data[o]
+            v = (b & 0x0f) * 17
+            for _ in range((b >> 4) + 1):
+                if i >= t * t:
+                    break
+                frame[start + (i // t) * self.width + i % t] = v
+                i += 1
+
+    def _packed(self, index, data, offset):
+        frame = self.frame
+        start = self._origin(index)
+        o = offset
+        for y in range(self.tile):
+            p = start + y * self.width
+            for x in range(p, p + self.tile, 2):
+                b = data[o]
+                frame[x] = (b >> 4) * 17
+                frame[x + 1] = (b & 0x0f) * 17
+                o += 1
+
+
+class CameraStreamer:
+    # Sends the changed tiles of each frame offered, as long as the radio is
+    # free; frames that come in while it is busy are skipped, tiles that were not
+    # sent stay different from the reference and go with a later frame.
+    # transmit(packet) -> True if taken: lora.send by default, pass e.g.
+    # lambda p: airtime.send(p) == 0 to stay within the duty cycle.
+    def __init__(self, lora, encoder, maxPackets = 2, transmit = None):
+        self.lora = lora
+        self.encoder = encoder
+        self.maxPackets = maxPackets
+        self.transmit = lora.send if transmit is None else transmit
+        self.stats = {'offered': 0, 'sent': 0, 'skipped': 0, 'packets': 0, 'bytes': 0, 'lastBytes': 0}
+
+    def offer(self, image):
+        # image: 8-bit grayscale, encoder.width x encoder.height; returns bytes sent
+        self.stats['offered'] += 1
+        if self.lora.txBusy():
+            self.stats['skipped'] += 1
+            return 0
+        encoder = self.encoder
+        sent = 0
+        for packet, tiles in encoder.packets(encoder.encode(image), self.maxPackets):
+            if not self.transmit(packet):
+                break
+            encoder.commit(tiles)
+            sent += len(packet)
+            self.stats['packets'] += 1
+        if sent:
+            self.stats['sent'] += 1
+        else:
+            self.stats['skipped'] += 1
+        self.stats['bytes'] += sent
+        self.stats['lastBytes'] = sent
+        return sent
+
+
+def syntheticFrame(n, width = 80, height = 60, out = None):
+    # a gradient background with a bright square moving across it
+    out = bytearray(width * height) if out is None else out
+    sx = (n * 3) % (width - 16)
+    sy = 20 + (n % 8)
+    for y in range(height):
+        for x in range(width):
+            v = (x * 2 + y) & 0xff
+            if sx <= x < sx + 16 and sy <= y < sy + 16:
+                v = 240
+            out[y * width + x] = v
+    return out
+
+
+if __name__ == '__main__':
+    encoder = TileEncoder()
+    decoder = TileDecoder()
+    frame = bytearray(80 * 60)
+    print('{0:>6}{1:>8}{2:>8}{3:>10}{4:>10}'.format('frame', 'tiles', 'bytes', 'encode us', 'mean err'))
+    for n in range(20):
+        syntheticFrame(n, out=frame)
+        tiles = encoder.encode(frame)
+        nbytes = 0
+        for packet, sent in encoder.packets(tiles, maxPackets=8):
+            decoder.decode(packet)
+            encoder.commit(sent)
+            nbytes += len(packet)
+        # the decoder must hold exactly what the encoder thinks it has
+        assert decoder.frame == bytearray(v * 17 for v in encoder.reference)
+        err = sum(abs(frame[i] - decoder.frame[i]) for i in range(len(frame))) / len(frame)
+        print('{0:>6}{1:>8}{2:>8}{3:>10}{4:>10.1f}'.format(n, len(tiles), nbytes, encoder.stats['lastUs'], err))
+    stats = encoder.stats
+    print('mean {0} bytes/frame, {1} us/frame'.format(stats['bytes'] // stats['frames'], stats['totalUs'] // stats['frames']))
+    # truncated, out-of-frame and misframed tiles are counted, not applied
+    before = bytes(decoder.frame)
+    for bad in (b'\xc1\x00\x01\x05\x32\x11', b'\xc1\x00\x01\x30\x81\x00', b'\xc1\x00\x01\x05\x10' + bytes(16)):
+        assert decoder.decode(bad) == 0
+    assert decoder.frame == before and decoder.stats['errors'] == 3
+    print('{0} malformed packets rejected'.format(decoder.stats['errors']))
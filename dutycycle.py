@@ -0,0 +1,166 @@
+# Duty-cycle aware transmit scheduling for the SX127x driver.
+# Keeps, per regulatory sub-band, the airtime used over a sliding window and
+# refuses (or holds back) packets that would go over the band's budget.
+#
+#   sched = AirtimeScheduler(lora)
+#   wait = sched.send('PING')     # 0: on its way, >0: ms until it would fit,
+#                                 # TOO_LONG / QUEUE_FULL: refused
+#   sched.send('PING', wait=True)  # queue it instead, poll() sends it when allowed
+#   sched.poll()                   # call from the main loop
+from array import array
+
+from sx127x import ticks_ms, ticks_diff
+
+# (low Hz, high Hz, duty cycle, name), ETSI EN 300 220 / LoRaWAN regional parameters
+EU868_BANDS = ((863.0E6, 868.0E6, 0.01, 'g'),
+               (868.0E6, 868.6E6, 0.01, 'g1'),
+               (868.7E6, 869.2E6, 0.001, 'g2'),
+               (869.4E6, 869.65E6, 0.1, 'g3'),
+               (869.7E6, 870.0E6, 0.01, 'g4'),
+               (433.05E6, 434.79E6, 0.1, 'eu433'))
+
+# AirtimeScheduler.send() refusals
+TOO_LONG = -1       # the packet alone is over the band's budget
+QUEUE_FULL = -2     # the driver's TX queue is full, nothing was charged
+
+
+class AirtimeScheduler:
+    # Airtime is kept in fixed buckets (window / buckets ms each) per band, so
+    # memory doesn't grow with traffic. Frequencies outside every band are not
+    # limited.
+    def __init__(self, lora, bands = EU868_BANDS, window = 3600000, buckets = 60):
+        self.lora = lora
+        self.bands = bands
+        self.window = window
+        self.buckets = buckets
+        self.bucketLen = window // buckets
+        n = len(bands)
+        self._used = [array('L', [0] * buckets) for _ in range(n)]  # airtime, us
+        self._ids = [array('l', [-1] * buckets) for _ in range(n)]  # absolute bucket number
+        self._pending = []
+        self._t0 = ticks_ms()
+        self.stats = {'sent': 0, 'rejected': 0, 'delayed': 0, 'queueFull': 0, 'airtime': 0}
+
+    def now(self):
+        return ticks_diff(ticks_ms(), self._t0)
+
+    def band(self, frequency):
+        for i in range(len(self.bands)):
+            low, high, duty, name = self.bands[i]
+            if low <= frequency < high:
+                return i
+        return -1
+
+    def budget(self, band):
+        # us of airtime allowed per window
+        return int(self.bands[band][2] * self.window * 1000)
+
+    def used(self, band, now = None):
+        # us of airtime used in the current window
+        if band < 0:
+            return 0
+        now = self.now() if now is None else now
+        oldest = now // self.bucketLen - self.buckets
+        ids = self._ids[band]
+        used = self._used[band]
+        total = 0
+        for i in range(self.buckets):
+            if ids[i] > oldest:
+                total += used[i]
+        return total
+
+    def utilization(self, frequency = None):
+        # fraction of the band's budget used in the window (0.0 .. 1.0+)
+        band = self.band(self.lora.parameters['frequency'] if frequency is None else frequency)
+        if band < 0:
+            return 0.0
+        return self.used(band) / self.budget(band)
+
+    def metrics(self):
+        # {band name: (used us, budget us, utilization)} for every band
+        out = {}
+        now = self.now()
+        for i in range(len(self.bands)):
+            used = self.used(i, now)
+            budget = self.budget(i)
+            out[self.bands[i][3]] = (used, budget, used / budget)
+        return out
+
+    def delay(self, frequency, airtime, now = None):
+        # ms until airtime (us) fits in the band's budget: 0 now, TOO_LONG never
+        band = self.band(frequency)
+        if band < 0:
+            return 0
+        budget = self.budget(band)
+        if airtime > budget:
+            return TOO_LONG
+        now = self.now() if now is None else now
+        current = now // self.bucketLen
+        over = self.used(band, now) + airtime - budget
+        if over <= 0:
+            return 0
+        # let the oldest buckets slide out of the window until it fits
+        ids = self._ids[band]
+        used = self._used[band]
+        live = [i for i in range(self.buckets) if ids[i] > current - self.buckets]
+        live.sort(key=lambda i: ids[i])
+        for i in live:
+            over -= used[i]
+            if over <= 0:
+                return (ids[i] + self.buckets) * self.bucketLen - now
+        return TOO_LONG
+
+    def record(self, frequency, airtime, now = None):
+        band = self.band(frequency)
+        self.stats['airtime'] += airtime
+        if band < 0:
+            return
+        now = self.now() if now is None else now
+        current = now // self.bucketLen
+        slot = current % self.buckets
+        if self._ids[band][slot] != current:
+            self._ids[band][slot] = current
+            self._used[band][slot] = 0
+        self._used[band][slot] += airtime
+
+    def send(self, payload, callback = None, wait = False):
+        # returns 0 when the packet was handed to the radio, otherwise the ms it
+        # would have to wait, TOO_LONG for the band, ever, or QUEUE_FULL
+        if isinstance(payload, str):
+            payload = payload.encode()  # airtime goes by bytes, not characters
+        airtime = self.lora.timeOnAir(len(payload))
+        frequency = self.lora.parameters['frequency']
+        delay = self.delay(frequency, airtime)
+        if delay == 0 and not (wait and self._pending):
+            if not self.lora.send(payload, callback):
+                self.stats['queueFull'] += 1
+                return QUEUE_FULL
+            self.record(frequency, airtime)
+            self.stats['sent'] += 1
+            return 0
+        if wait and delay >= 0:
+            self._pending.append((payload, callback))
+            self.stats['delayed'] += 1
+            return max(delay, 1)
+        self.stats['rejected'] += 1
+        return delay
+
+    def pending(self):
+        return len(self._pending)
+
+    def poll(self):
+        # send held-back packets, in order, as soon as the budget allows
+        while self._pending:
+            payload, callback = self._pending[0]
+            airtime = self.lora.timeOnAir(len(payload))
+            frequency = self.lora.parameters['frequency']
+            if self.delay(frequency, airtime) != 0:
+                break
+            if not self.lora.send(payload, callback):
+                # TX queue full: stays first in line
+                self.stats['queueFull'] += 1
+                break
+            self._pending.pop(0)
+            self.record(frequency, airtime)
+            self.stats['sent'] += 1
+        return len(self._pending)
@@ -0,0 +1,96 @@
+# SX127x on a Linux host (Raspberry Pi and the like): spidev for the registers,
+# a sysfs GPIO for DIO0. Needs the spidev package (pip install spidev).
+#
+#   from sx127x import SX127x
+#   from linuxspi import SpidevTransport, LinuxGpio
+#   lora = SX127x(transport=SpidevTransport(0, 0, dio0=LinuxGpio(25)))
+#   lora.init()
+#   lora.onReceive(None, ring=ring)
+#   lora.receive()
+#   while True:
+#       lora.waitIrq(1000)        # blocks in poll(), handles DIO0 here
+#
+# The kernel drives CS, so each access is a single xfer2() call, bursts
+# included. Reset the module through its own GPIO before init(), as on the Amigo.
+import os
+import select
+
+try:
+    import spidev
+except ImportError:
+    spidev = None
+
+
+class LinuxGpio:
+    # Input line through /sys/class/gpio, with rising-edge wakeups. Same
+    # interface as the MicroPython pins the driver takes, but nothing runs in
+    # interrupt context: SX127x.waitIrq() waits for the line and handles it.
+    def __init__(self, number, base = '/sys/class/gpio'):
+        path = '{0}/gpio{1}'.format(base, number)
+        if not os.path.exists(path):
+            with open(base + '/export', 'w') as f:
+                f.write(str(number))
+        with open(path + '/direction', 'w') as f:
+            f.write('in')
+        with open(path + '/edge', 'w') as f:
+            f.write('rising')
+        self._fd = os.open(path + '/value', os.O_RDONLY | os.O_NONBLOCK)
+        self._poll = select.poll()
+        self._poll.register(self._fd, select.POLLPRI | select.POLLERR)
+
+    def value(self):
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        return 1 if os.read(self._fd, 2)[:1] == b'1' else 0
+
+    def wait(self, timeout):
+        # True once the line is up, False after timeout ms
+        if self.value():
+            return True
+        # reading the value above re-armed the edge
+        if not self._poll.poll(timeout):
+            return False
+        return self.value() == 1
+
+    def set_handler_for_irq_on_rising_edge(self, handler):
+        pass  # see SX127x.waitIrq()
+
+    def detach_irq(self):
+        pass
+
+    def close(self):
+        os.close(self._fd)
+
+
+class SpidevTransport:
+    # bus, device: /dev/spidev<bus>.<device>; speed in Hz (the SX127x takes up to 10 MHz)
+    def __init__(self, bus = 0, device = 0, speed = 1000000, dio0 = None):
+        if spidev is None:
+            raise Exception('linuxspi needs the spidev package: ', 'pip install spidev')
+        self.dev = spidev.SpiDev()
+        self.dev.open(bus, device)
+        self.dev.max_speed_hz = speed
+        self.dev.mode = 0
+        self.dio0 = dio0
+
+    def read(self, address):
+        return self.dev.xfer2([address & 0x7f, 0])[1]
+
+    def write(self, address, value):
+        self.dev.xfer2([address | 0x80, value & 0xff])
+
+    def readBurst(self, address, buffer):
+        data = self.dev.xfer2([address & 0x7f] + [0] * len(buffer))
+        buffer[:] = bytes(data[1:])
+
+    def writeBurst(self, address, buffer):
+        self.dev.xfer2([address | 0x80] + list(buffer))
+
+    def waitIrq(self, timeout):
+        if self.dio0 is None:
+            return False
+        return self.dio0.wait(timeout)
+
+    def close(self):
+        self.dev.close()
+        if self.dio0 is not None:
+            self.dio0.close()
@@ -0,0 +1,418 @@
+# Retained-mode renderer for the LoRa_Tester touch menu.
+# The 320x480 framebuffer and the static layer (background, title, tile frames)
+# are built once; after that only what changed is redrawn: a tile that was
+# pressed/released or (un)checked, the packet area, the message line. Nothing
+# changed, nothing is pushed to the LCD.
+#
+# image and lcd are passed in (MaixPy's modules on the device, stand-ins on a PC),
+# so frame time and redraw area can be measured anywhere.
+import time
+
+try:
+    ticks_us = time.ticks_us
+    ticks_diff = time.ticks_diff
+except AttributeError:  # CPython
+    def ticks_us():
+        return int(time.perf_counter() * 1000000)
+    def ticks_diff(a, b):
+        return a - b
+
+BACKGROUND = (255, 64, 64)
+PRESSED = (0, 191, 191)
+BORDER = (0, 0, 0)
+CHECKED = (0, 0, 255)
+LABEL = (255, 255, 255)
+LABEL_PRESSED = (33, 33, 33)
+TITLE = (255, 255, 255)
+PACKET = (255, 222, 222)
+MESSAGE = (0, 0, 0)
+
+LINE_CHARS = 28   # packet text is wrapped at this many characters
+LINE_HEIGHT = 24
+
+
+class MenuRenderer:
+    def __init__(self, image, lcd, menus, width = 320, height = 480,
+                 squareWidth = 90, squareHeight = 70, partial = False):
+        self.lcd = lcd
+        self.menus = menus
+        self.width = width
+        self.height = height
+        self.squareWidth = squareWidth
+        self.squareHeight = squareHeight
+        # partial: push only dirty rectangles with lcd.display(roi=, oft=)
+        self.partial = partial
+        self.fb = image.Image(size=(width, height))
+        self._tiles = [self.tileRect(i) for i in range(len(menus))]
+        rows = (len(menus) + 2) // 3
+        self.packetTop = 50 + rows * (squareHeight + 10)
+        self.messageTop = height - 30
+        self._pressed = -1
+        self._checked = [False] * len(menus)
+        self._message = ''
+        self._packet = ''
+        self._status = ''
+        self._dirty = []  # rectangles to push
+        self._dirtyTiles = []
+        self._dirtyPacket = False
+        self._dirtyMessage = False
+        self._full = True
+        self.resetStats()
+
+    def resetStats(self):
+        self.stats = {'frames': 0, 'skipped': 0, 'full': 0, 'tiles': 0,
+                      'pixels': 0, 'lastUs': 0, 'maxUs': 0, 'totalUs': 0}
+
+    def tileRect(self, i):
+        x = (i % 3) * (self.squareWidth + 10) + 10
+        y = (i // 3) * (self.squareHeight + 10) + 50
+        return (x, y, self.squareWidth, self.squareHeight)
+
+    # --- state: each setter only marks what it changes
+
+    def setPressed(self, index):
+        if index != self._pressed:
+            for i in (self._pressed, index):
+                if 0 <= i < len(self.menus) and i not in self._dirtyTiles:
+                    self._dirtyTiles.append(i)
+            self._pressed = index
+
+    def setChecked(self, checked):
+        for i in range(len(self.menus)):
+            state = i in checked
+            if state != self._checked[i]:
+                self._checked[i] = state
+                if i not in self._dirtyTiles:
+                    self._dirtyTiles.append(i)
+
+    def setMessage(self, message):
+        if message != self._message:
+            self._message = message
+            self._dirtyMessage = True
+
+    def setPacket(self, packet, status = ''):
+        if packet != self._packet or status != self._status:
+            self._packet = packet
+            self._status = status
+            self._dirtyPacket = True
+
+    def invalidate(self):
+        # redraw everything on the next render(), e.g. after something else used the LCD
+        self._full = True
+
+    # --- drawing
+
+    def render(self):
+        if not (self._full or self._dirtyTiles or self._dirtyPacket or self._dirtyMessage):
+            self.stats['skipped'] += 1
+            return False
+        t0 = ticks_us()
+        img = self.fb
+        if self._full:
+            img.draw_rectangle(0, 0, self.width, self.height, color=BACKGROUND, fill=True)
+            img.draw_string(140, 10, "MENU", color=TITLE, scale=2)
+            self._dirtyTiles = list(range(len(self.menus)))
+            self._dirtyPacket = True
+            self._dirtyMessage = True
+            self._dirty = [(0, 0, self.width, self.height)]
+            self.stats['full'] += 1
+        for i in self._dirtyTiles:
+            self._drawTile(i)
+        self.stats['tiles'] += len(self._dirtyTiles)
+        if self._dirtyPacket:
+            self._drawPacket()
+        if self._dirtyMessage:
+            self._drawMessage()
+        self._push()
+        for x, y, w, h in self._dirty:
+            self.stats['pixels'] += w * h
+        self._dirty = []
+        self._dirtyTiles = []
+        self._dirtyPacket = False
+        self._dirtyMessage = False
+        self._full = False
+        dt = ticks_diff(ticks_us(), t0)
+        stats = self.stats
+        stats['frames'] += 1
+        stats['lastUs'] = dt
+        stats['totalUs'] += dt
+        if dt > stats['maxUs']:
+            stats['maxUs'] = dt
+        return True
+
+    def _mark(self, rect):
+        if not self._full:
+            self._dirty.append(rect)
+
+    def _drawTile(self, i):
+        img = self.fb
+        x, y, w, h = self._tiles[i]
+        pressed = i == self._pressed
+        img.draw_rectangle(x, y, w, h, color=PRESSED if pressed else BACKGROUND, fill=True)
+        img.draw_rectangle(x, y, w, h, color=BORDER, thickness=3)
+        if self._checked[i]:
+            # check mark
+            img.draw_rectangle(x+3, y+3, w-6, h-6, color=CHECKED, thickness=3)
+        dsp = self.menus[i]
+        offsetX = 45 - (8*len(dsp))
+        img.draw_string(x+offsetX, y+20, dsp, LABEL_PRESSED if pressed else LABEL, scale=3)
+        self._mark((x, y, w, h))
+
+    def _drawPacket(self):
+        img = self.fb
+        rect = (0, self.packetTop, self.width, self.messageTop - self.packetTop)
+        img.draw_rectangle(rect[0], rect[1], rect[2], rect[3], color=BACKGROUND, fill=True)
+        packet = self._packet
+        if packet:
+            py = self.packetTop
+            for start in range(0, len(packet), LINE_CHARS):
+                img.draw_string(6, py, packet[start:start+LINE_CHARS], PACKET, scale=2)
+                py += LINE_HEIGHT
+            img.draw_string(6, py, self._status, PACKET, scale=2)
+        self._mark(rect)
+
+    def _drawMessage(self):
+        img = self.fb
+        rect = (0, self.messageTop, self.width, self.height - self.messageTop)
+        img.draw_rectangle(rect[0], rect[1], rect[2], rect[3], color=BACKGROUND, fill=True)
+        ln = len(self._message)
+        if ln > 0:
+            myScale = 2
+            myWidth = 5 * myScale
+            img.draw_string(int((self.width-ln*myWidth)/2), self.height-10-myScale*10, self._message, MESSAGE, scale=myScale)
+        self._mark(rect)
+
+    def _push(self):
+        if self.partial and self._dirty[0] != (0, 0, self.width, self.height):
+            for x, y, w, h in self._dirty:
+                self.lcd.display(self.fb, roi=(x, y, w, h), oft=(x, y))
+        else:
+            self.lcd.display(self.fb)
+
+
+# touch events passed to TouchInput's handler
+TOUCH_PRESS = 0
+TOUCH_MOVE = 1     # finger moved onto another tile (or off all tiles)
+TOUCH_RELEASE = 2
+
+
+class HitTest:
+    # coordinates -> menu index, from two precomputed lookup tables (column per
+    # x, row per y) instead of arithmetic on every sample. Gaps and the title
+    # bar give -1.
+    def __init__(self, numMenus, squareWidth = 90, squareHeight = 70, width = 320, height = 480):
+        self.numMenus = numMenus
+        self._cols = bytearray(b'\xff' * width)
+        self._rows = bytearray(b'\xff' * height)
+        for col in range(3):
+            x = col * (squareWidth + 10) + 10
+            for px in range(x, min(x + squareWidth, width)):
+                self._cols[px] = col
+        for row in range((numMenus + 2) // 3):
+            y = row * (squareHeight + 10) + 50
+            for py in range(y, min(y + squareHeight, height)):
+                self._rows[py] = row
+
+    def index(self, x, y):
+        if not (0 <= x < len(self._cols) and 0 <= y < len(self._rows)):
+            return -1
+        col = self._cols[x]
+        row = self._rows[y]
+        if col == 0xff or row == 0xff:
+            return -1
+        i = row * 3 + col
+        return i if i < self.numMenus else -1
+
+
+class TouchInput:
+    # Polls the touch controller and calls handler(event, index, x, y) only on
+    # transitions: press, moving to another tile, release. A touch state must be
+    # seen on `debounce` consecutive polls before it counts, which filters the
+    # controller's spurious zero samples while a finger is down.
+    def __init__(self, touch, hitTest, handler, debounce = 2):
+        self.touch = touch
+        self.hitTest = hitTest
+        self.handler = handler
+        self.debounce = debounce
+        self.pressed = False
+        self.index = -1
+        self.x = 0
+        self.y = 0
+        self._streak = 0
+        self.stats = {'polls': 0, 'events': 0, 'bounces': 0}
+
+    def poll(self):
+        self.stats['polls'] += 1
+        self.touch.event()
+        # the Amigo's controller reports (y, x, t) pairs
+        (y0, x0, t0), (y1, x1, t1) = self.touch.points
+        down = x0 != 0 and y0 != 0
+        if down != self.pressed:
+            self._streak += 1
+            if self._streak < self.debounce:
+                return
+        elif self._streak:
+            self.stats['bounces'] += 1
+        self._streak = 0
+        if down:
+            index = self.hitTest.index(x1, y1)
+            self.x = x1
+            self.y = y1
+            if not self.pressed:
+                self.pressed = True
+                self.index = index
+                self._emit(TOUCH_PRESS)
+            elif index != self.index:
+                self.index = index
+                self._emit(TOUCH_MOVE)
+        elif self.pressed:
+            # released: report where the finger was last seen
+            self.pressed = False
+            self._emit(TOUCH_RELEASE)
+            self.index = -1
+
+    def _emit(self, event):
+        self.stats['events'] += 1
+        self.handler(event, self.index, self.x, self.y)
+
+
+if __name__ == '__main__':
+    # PC bench: stand-in image/lcd modules that count draw calls and pixels, the
+    # renderer against the old showMap() path (new image, everything redrawn and
+    # pushed on every call) over the same sequence of UI updates.
+    class StubImage:
+        def __init__(self, size):
+            self.width, self.height = size
+            self.calls = 0
+            self.pixels = 0
+        def draw_rectangle(self, x, y, w, h, color = None, thickness = 1, fill = False):
+            self.calls += 1
+            self.pixels += w * h if fill else 2 * (w + h) * thickness
+        def draw_string(self, x, y, text, color = None, scale = 1):
+            self.calls += 1
+            self.pixels += len(text) * 8 * scale * 10 * scale
+
+    class StubImageModule:
+        def __init__(self):
+            self.images = []
+        def Image(self, size):
+            img = StubImage(size)
+            self.images.append(img)
+            return img
+        def counts(self):
+            return sum(i.calls for i in self.images), sum(i.pixels for i in self.images)
+
+    class StubLcd:
+        def __init__(self):
+            self.calls = 0
+            self.pixels = 0
+        def display(self, img, roi = None, oft = None):
+            self.calls += 1
+            self.pixels += roi[2] * roi[3] if roi else img.width * img.height
+
+    def oldShowMap(image, lcd, menus, pressed, checked, packet, status, message):
+        # the pre-MenuRenderer showMap(), minus the LCD rotation calls
+        img = image.Image(size=(320, 480))
+        img.draw_rectangle(0, 0, 320, 480, color=BACKGROUND, fill=True)
+        img.draw_string(140, 10, "MENU", color=TITLE, scale=2)
+        for i in range(len(menus)):
+            x = (i % 3) * 100 + 10
+            y = (i // 3) * 80 + 50
+            if pressed == i:
+                img.draw_rectangle(x, y, 90, 70, color=PRESSED, fill=True)
+            img.draw_rectangle(x, y, 90, 70, color=BORDER, thickness=3)
+            if i in checked:
+                img.draw_rectangle(x+3, y+3, 84, 64, color=CHECKED, thickness=3)
+            img.draw_string(x+45-8*len(menus[i]), y+20, menus[i], LABEL_PRESSED if pressed == i else LABEL, scale=3)
+        py = y + 80
+        if message:
+            img.draw_string(int((320-len(message)*10)/2), 450, message, MESSAGE, scale=2)
+        if packet:
+            for start in range(0, len(packet), LINE_CHARS):
+                img.draw_string(6, py, packet[start:start+LINE_CHARS], PACKET, scale=2)
+                py += LINE_HEIGHT
+            img.draw_string(6, py, status, PACKET, scale=2)
+        lcd.display(img)
+
+    menus = ["ping", "BW6", "BW7", "SF10", "SF12", "433", "868", "Tx10", "Tx17", "RTT", "ADR"]
+    packet = 'Hello from the other Amigo, packet #42'
+    # (step, pressed, checked, packet, status, message), as LoRa_Tester drives showMap()
+    script = [('start', -1, [2, 4, 5, 8], '', '', '')]
+    script += [('press', 0, [2, 4, 5, 8], '', '', '')]
+    script += [('move', 1, [2, 4, 5, 8], '', '', '')]
+    script += [('release', -1, [1, 4, 5, 8], '', '', '125.0 KHz')]
+    script += [('idle', -1, [1, 4, 5, 8], '', '', '125.0 KHz')] * 20
+    script += [('packet', -1, [1, 4, 5, 8], packet, 'RSSI: -71 SNR: 9.5', 'Incoming! 1 ok 0 lost')]
+    script += [('message', -1, [1, 4, 5, 8], packet, 'RSSI: -71 SNR: 9.5', 'PING sent')]
+
+    image = StubImageModule()
+    lcd = StubLcd()
+    t0 = ticks_us()
+    for step, pressed, checked, pkt, status, message in script:
+        oldShowMap(image, lcd, menus, pressed, checked, pkt, status, message)
+    oldUs = ticks_diff(ticks_us(), t0)
+    oldCalls, oldPixels = image.counts()
+    print('{0:<22}{1:>8}{2:>8}{3:>12}{4:>12}{5:>10}'.format('path', 'frames', 'draws', 'drawn px', 'pushed px', 'us'))
+    print('{0:<22}{1:>8}{2:>8}{3:>12}{4:>12}{5:>10}'.format('old showMap', lcd.calls, oldCalls, oldPixels, lcd.pixels, oldUs))
+    for partial in (False, True):
+        image = StubImageModule()
+        lcd = StubLcd()
+        ui = MenuRenderer(image, lcd, menus, partial=partial)
+        t0 = ticks_us()
+        for step, pressed, checked, pkt, status, message in script:
+            ui.setPressed(pressed)
+            ui.setChecked(checked)
+            ui.setPacket(pkt, status)
+            ui.setMessage(message)
+            if ui.render() and step == 'start':
+                firstUs = ui.stats['lastUs']
+        us = ticks_diff(ticks_us(), t0)
+        calls, pixels = image.counts()
+        stats = ui.stats
+        assert len(image.images) == 1 and stats['full'] == 1
+        assert stats['frames'] + stats['skipped'] == len(script) and stats['skipped'] >= 20
+        assert calls < oldCalls and lcd.calls < len(script)
+        print('{0:<22}{1:>8}{2:>8}{3:>12}{4:>12}{5:>10}'.format(
+            'MenuRenderer partial' if partial else 'MenuRenderer', stats['frames'], calls, pixels, lcd.pixels, us))
+    # after the first full frame, press/move/release only redraw the tiles involved
+    stats = ui.stats
+    print('full frame {0} us, later frames {1} us mean, {2} tiles redrawn, {3} frames skipped'.format(
+        firstUs, (stats['totalUs'] - firstUs) // (stats['frames'] - 1), stats['tiles'], stats['skipped']))
+
+    # scripted touch: press, drag across tiles and a gap, release, then a tap
+    # shorter than the debounce window and a drag off the tiles
+    class StubTouch:
+        def __init__(self, samples):
+            self.samples = samples
+            self.points = ((0, 0, 0), (0, 0, 0))
+        def event(self):
+            x, y = self.samples.pop(0)
+            self.points = ((y, x, 0), (y, x, 0))
+
+    UP = (0, 0)
+    samples = [UP, UP,
+               (50, 80), (50, 80),     # press tile 0
+               UP,                     # one spurious zero sample while held
+               (150, 80),              # onto tile 1
+               (105, 80),              # the gap between tiles 1 and 2
+               (150, 160), (150, 160), # tile 4
+               UP, UP,                 # release on tile 4
+               (250, 80), UP, UP,      # tap on tile 2 within the debounce window
+               (50, 160), (50, 160),   # press tile 3
+               (50, 20), UP, UP]       # onto the title bar, release
+    events = []
+    actions = []
+    def onTouch(event, index, x, y):
+        # what LoRa_Tester does: a release on a tile runs its action
+        events.append((event, index))
+        if event == TOUCH_RELEASE and index >= 0:
+            actions.append(menus[index])
+    touchInput = TouchInput(StubTouch(samples), HitTest(len(menus)), onTouch, debounce=2)
+    while samples:
+        touchInput.poll()
+    assert events == [(TOUCH_PRESS, 0), (TOUCH_MOVE, 1), (TOUCH_MOVE, -1), (TOUCH_MOVE, 4), (TOUCH_RELEASE, 4),
+                      (TOUCH_PRESS, 3), (TOUCH_MOVE, -1), (TOUCH_RELEASE, -1)], events
+    assert actions == ['SF12'], actions
+    assert touchInput.stats['bounces'] == 2
+    print('touch: {0} polls, {1} events, {2} bounces filtered, actions fired: {3}'.format(
+        touchInput.stats['polls'], touchInput.stats['events'], touchInput.stats['bounces'], ', '.join(actions)))
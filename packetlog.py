@@ -0,0 +1,79 @@
+# Append-only binary packet log, for range tests.
+# Records have a fixed layout and are packed into a RAM buffer; the file (on the
+# SD card) is only written when the buffer is full, in one large block, so
+# logging never holds up reception. Read the logs on a PC with packetlog_reader.py.
+#
+# File: an 8-byte header, then records of RECORD_HEAD.size + payloadBytes bytes:
+#   ticks_ms u32, frequency Hz u32, sf u8, bw index u8, tx power dBm i8,
+#   SNR quarter dB i8, RSSI dBm i16, payload length u8, flags u8, sequence u16,
+#   then the first payloadBytes bytes of the payload, zero padded.
+try:
+    import ustruct as struct
+except ImportError:
+    import struct
+
+from sx127x import bandwidthIndex
+
+MAGIC = b'LRLG'
+VERSION = 1
+FILE_HEAD = struct.Struct('<4sBBH')        # magic, version, payloadBytes, reserved
+RECORD_HEAD = struct.Struct('<IIBBbbhBBH')  # 18 bytes
+
+FLAG_CRC_ERROR = 0x01
+FLAG_TX = 0x02      # a packet we sent, not one we received
+NO_SEQUENCE = 0xffff
+
+
+class PacketLogger:
+    def __init__(self, path, payloadBytes = 32, bufferRecords = 64):
+        self.payloadBytes = payloadBytes
+        self.recordSize = RECORD_HEAD.size + payloadBytes
+        self._buf = bytearray(self.recordSize * bufferRecords)
+        self._mv = memoryview(self._buf)
+        self._capacity = bufferRecords
+        self._count = 0
+        self.stats = {'records': 0, 'flushes': 0, 'bytes': 0}
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(FILE_HEAD.pack(MAGIC, VERSION, payloadBytes, 0))
+        else:
+            with open(path, 'rb') as f:
+                magic, version, size, reserved = FILE_HEAD.unpack(f.read(FILE_HEAD.size))
+            if magic != MAGIC or size != payloadBytes:
+                raise Exception('Not a packet log with {0}-byte payloads: '.format(payloadBytes), path)
+
+    def log(self, ticks, frequency, sf, bw, txPower, rssi, snr, payload, seq = NO_SEQUENCE, flags = 0):
+        offset = self._count * self.recordSize
+        length = len(payload)
+        RECORD_HEAD.pack_into(self._buf, offset, ticks & 0xffffffff, int(frequency), sf,
+                              bandwidthIndex(bw), int(txPower), max(-128, min(127, int(snr * 4))), int(rssi),
+                              length, flags, seq & 0xffff)
+        offset += RECORD_HEAD.size
+        n = min(length, self.payloadBytes)
+        self._mv[offset:offset + n] = payload[:n]
+        if n < self.payloadBytes:
+            for i in range(offset + n, offset + self.payloadBytes):
+                self._buf[i] = 0
+        self._count += 1
+        self.stats['records'] += 1
+        if self._count == self._capacity:
+            self.flush()
+
+    def logPacket(self, lora, ring, slot, seq = NO_SEQUENCE, flags = 0):
+        # a packet received into a PacketRing slot, with the radio's current settings
+        p = lora.parameters
+        self.log(ring.ticks[slot], p['frequency'], p['spreading_factor'], p['signal_bandwidth'],
+                 p['tx_power_level'], ring.rssi[slot], ring.snr[slot] / 4, ring.packet(slot), seq, flags)
+
+    def flush(self):
+        if self._count:
+            n = self._count * self.recordSize
+            self._file.write(self._mv[:n])
+            self._file.flush()
+            self._count = 0
+            self.stats['flushes'] += 1
+            self.stats['bytes'] += n
+
+    def close(self):
+        self.flush()
+        self._file.close()
@@ -0,0 +1,116 @@
+# Offline analysis of packetlog.py logs, on a PC:
+#   python3 packetlog_reader.py packets.bin [more.bin ...]
+# The log is memory-mapped and parsed in bulk into one array per field (numpy
+# structured arrays if numpy is installed, the array module otherwise), then
+# summarised per configuration (frequency, SF, BW, TX power): packets, loss from
+# sequence-number gaps, CRC errors, RSSI and SNR min/mean/max.
+import mmap
+import sys
+from array import array
+
+from sx127x import BANDWIDTHS
+from packetlog import MAGIC, FILE_HEAD, RECORD_HEAD, FLAG_CRC_ERROR, FLAG_TX, NO_SEQUENCE
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+FIELDS = ('ticks', 'frequency', 'sf', 'bw', 'txPower', 'snr', 'rssi', 'length', 'flags', 'seq')
+TYPECODES = ('L', 'L', 'B', 'B', 'b', 'b', 'h', 'B', 'B', 'H')
+
+
+def readLog(path):
+    # {field: array} plus 'payload' (list of bytes, as logged) for every record in the file
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return _parse(mm)
+        finally:
+            mm.close()
+
+
+def _parse(buf):
+    magic, version, payloadBytes, reserved = FILE_HEAD.unpack_from(buf, 0)
+    if magic != MAGIC:
+        raise ValueError('not a packet log')
+    size = RECORD_HEAD.size + payloadBytes
+    count = (len(buf) - FILE_HEAD.size) // size  # a torn last record is ignored
+    if numpy is not None:
+        dtype = numpy.dtype([('ticks', '<u4'), ('frequency', '<u4'), ('sf', 'u1'), ('bw', 'u1'),
+                             ('txPower', 'i1'), ('snr', 'i1'), ('rssi', '<i2'), ('length', 'u1'),
+                             ('flags', 'u1'), ('seq', '<u2'), ('payload', 'V{0}'.format(payloadBytes))])
+        records = numpy.frombuffer(buf, dtype=dtype, count=count, offset=FILE_HEAD.size)
+        columns = {name: records[name].copy() for name in FIELDS}
+        columns['payload'] = [bytes(p)[:n] for p, n in zip(records['payload'], records['length'])]
+        del records  # the mmap can't be closed while numpy still holds it
+        return columns
+    body = memoryview(buf)[FILE_HEAD.size:FILE_HEAD.size + count * size]
+    columns = {name: array(code) for name, code in zip(FIELDS, TYPECODES)}
+    payloads = []
+    unpack = RECORD_HEAD.unpack_from
+    for offset in range(0, count * size, size):
+        values = unpack(body, offset)
+        for name, value in zip(FIELDS, values):
+            columns[name].append(value)
+        start = offset + RECORD_HEAD.size
+        payloads.append(bytes(body[start:start + min(values[7], payloadBytes)]))
+    columns['payload'] = payloads
+    body.release()
+    return columns
+
+
+def summarize(columns):
+    # {(frequency, sf, bw Hz, txPower): stats} over received records
+    groups = {}
+    for i in range(len(columns['ticks'])):
+        if columns['flags'][i] & FLAG_TX:
+            continue
+        key = (int(columns['frequency'][i]), int(columns['sf'][i]),
+               BANDWIDTHS[min(int(columns['bw'][i]), len(BANDWIDTHS) - 1)], int(columns['txPower'][i]))
+        groups.setdefault(key, []).append(i)
+    out = {}
+    for key, rows in groups.items():
+        good = [i for i in rows if not columns['flags'][i] & FLAG_CRC_ERROR]
+        rssi = [int(columns['rssi'][i]) for i in good]
+        snr = [columns['snr'][i] / 4.0 for i in good]
+        seqs = sorted(set(int(columns['seq'][i]) for i in good if columns['seq'][i] != NO_SEQUENCE))
+        expected = seqs[-1] - seqs[0] + 1 if seqs else len(good)
+        received = len(seqs) if seqs else len(good)
+        out[key] = {'packets': len(rows), 'crcErrors': len(rows) - len(good),
+                    'expected': expected, 'lost': expected - received,
+                    'loss': (expected - received) / expected if expected else 0.0,
+                    'rssi': _spread(rssi), 'snr': _spread(snr)}
+    return out
+
+
+def _spread(values):
+    if not values:
+        return (None, None, None)
+    return (min(values), sum(values) / len(values), max(values))
+
+
+def report(out, stream = sys.stdout):
+    stream.write('{0:>12}{1:>4}{2:>8}{3:>5}{4:>8}{5:>7}{6:>6}{7:>22}{8:>22}\n'.format(
+        'MHz', 'SF', 'BW kHz', 'dBm', 'packets', 'loss', 'crc', 'RSSI min/mean/max', 'SNR min/mean/max'))
+    for key in sorted(out):
+        frequency, sf, bw, power = key
+        s = out[key]
+        stream.write('{0:>12.3f}{1:>4}{2:>8}{3:>5}{4:>8}{5:>6.1f}%{6:>6}{7:>22}{8:>22}\n'.format(
+            frequency / 1E6, sf, bw / 1E3, power, s['packets'], s['loss'] * 100, s['crcErrors'],
+            _fmt(s['rssi']), _fmt(s['snr'])))
+
+
+def _fmt(spread):
+    if spread[0] is None:
+        return '-'
+    return '{0:.1f}/{1:.1f}/{2:.1f}'.format(*spread)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.exit('usage: packetlog_reader.py LOG [LOG ...]')
+    for path in sys.argv[1:]:
+        columns = readLog(path)
+        print('{0}: {1} records'.format(path, len(columns['ticks'])))
+        report(summarize(columns))
@@ -0,0 +1,187 @@
+# Ping/pong link benchmark.
+# The initiator sends small binary frames, the responder echoes each one back as
+# soon as it arrives. The initiator measures round-trip time, loss, duplicates
+# and goodput; the last `samples` RTTs are kept in a fixed array for percentiles.
+#
+#   pp = PingPong(lora, INITIATOR, count=100)   # the other side: PingPong(lora, RESPONDER)
+#   lora.onReceive(pp.onReceive); lora.receive()
+#   while pp.poll(): ...                       # call from the main loop
+#   pp.report()
+#
+# Stop and wait: the next ping is only sent once the pong came back, or after
+# `timeout` ms (by default twice the time on air, plus `margin`).
+try:
+    import ustruct as struct
+except ImportError:
+    import struct
+from array import array
+
+from sx127x import ticks_ms, ticks_diff
+
+INITIATOR = 0
+RESPONDER = 1
+
+FRAME = struct.Struct('<BHI')   # kind, sequence number, initiator's ticks_ms
+KIND_PING = 0xa1
+KIND_PONG = 0xa2
+
+
+class PingPong:
+    # transmit(payload) -> True if the radio took it; lora.send by default, pass
+    # e.g. lambda p: airtime.send(p) == 0 to stay within the duty cycle
+    def __init__(self, lora, role = INITIATOR, count = 0, size = 16, timeout = None,
+                 margin = 200, samples = 64, clock = ticks_ms, transmit = None):
+        self.lora = lora
+        self.transmit = lora.send if transmit is None else transmit
+        self.role = role
+        self.count = count          # pings to send, 0: until stop()
+        self.size = max(size, FRAME.size)
+        self.margin = margin
+        self.timeout = timeout
+        self.clock = clock
+        self._frame = bytearray(self.size)
+        self._rtt = array('L', [0] * samples)
+        self._sorted = array('L', [0] * samples)
+        self._seen = bytearray(32)  # pongs already received, bitmap over seq & 0xff
+        self.reset()
+
+    def reset(self):
+        self.seq = 0
+        self._waiting = False
+        self._sentAt = 0
+        self._started = None
+        self._finished = None
+        self._samples = 0
+        self.running = self.role == RESPONDER or self.count != 0
+        self.stats = {'sent': 0, 'received': 0, 'lost': 0, 'late': 0, 'duplicates': 0,
+                      'echoed': 0, 'bytes': 0, 'minRtt': 0, 'maxRtt': 0, 'totalRtt': 0}
+
+    def stop(self):
+        self.running = False
+
+    def _timeout(self):
+        if self.timeout is not None:
+            return self.timeout
+        return 2 * self.lora.timeOnAir(self.size) // 1000 + self.margin
+
+    # --- receive side: hand every received payload to onReceive()
+
+    def onReceive(self, lora, payload):
+        # onReceive(callback) signature; returns True when payload was one of ours
+        if len(payload) < FRAME.size:
+            return False
+        kind, seq, stamp = FRAME.unpack_from(payload, 0)
+        if kind == KIND_PING and self.role == RESPONDER:
+            # echo the whole frame, only the kind changes
+            frame = bytearray(payload)
+            frame[0] = KIND_PONG
+            if self.transmit(frame):
+                self.stats['echoed'] += 1
+            return True
+        if kind == KIND_PONG and self.role == INITIATOR:
+            self._pong(seq, stamp, len(payload))
+            return True
+        return False
+
+    def _pong(self, seq, stamp, length):
+        stats = self.stats
+        bit = 1 << (seq & 7)
+        byte = (seq & 0xff) >> 3
+        if self._seen[byte] & bit:
+            stats['duplicates'] += 1
+            return
+        self._seen[byte] |= bit
+        if not self._waiting or seq != (self.seq - 1) & 0xffff:
+            # came back after we gave up on it
+            stats['late'] += 1
+            return
+        self._waiting = False
+        rtt = ticks_diff(self.clock(), stamp & 0xffffffff)
+        stats['received'] += 1
+        stats['bytes'] += length
+        stats['totalRtt'] += rtt
+        if stats['received'] == 1 or rtt < stats['minRtt']:
+            stats['minRtt'] = rtt
+        if rtt > stats['maxRtt']:
+            stats['maxRtt'] = rtt
+        self._rtt[self._samples % len(self._rtt)] = rtt
+        self._samples += 1
+
+    # --- initiator
+
+    def poll(self):
+        # sends the next ping when due; returns False once the run is over
+        if self.role == RESPONDER or not self.running:
+            return self.running
+        now = self.clock()
+        if self._waiting:
+            if ticks_diff(now, self._sentAt) < self._timeout():
+                return True
+            self._waiting = False
+            self.stats['lost'] += 1
+        if self.count and self.stats['sent'] >= self.count:
+            self.running = False
+            self._finished = now
+            return False
+        if self.lora.txBusy():
+            return True
+        if self._started is None:
+            self._started = now
+        seq = self.seq
+        FRAME.pack_into(self._frame, 0, KIND_PING, seq, now & 0xffffffff)
+        if not self.transmit(bytes(self._frame)):
+            return True  # try again on the next poll
+        byte = (seq & 0xff) >> 3
+        self._seen[byte] &= ~(1 << (seq & 7)) & 0xff
+        self.seq = (seq + 1) & 0xffff
+        self._sentAt = now
+        self._waiting = True
+        self.stats['sent'] += 1
+        return True
+
+    # --- results
+
+    def percentile(self, p):
+        # p-th percentile (0..100) of the last `samples` RTTs, ms
+        n = min(self._samples, len(self._rtt))
+        if n == 0:
+            return 0
+        s = self._sorted
+        for i in range(n):
+            # insertion sort into the scratch array, nothing allocated
+            v = self._rtt[i]
+            j = i
+            while j > 0 and s[j - 1] > v:
+                s[j] = s[j - 1]
+                j -= 1
+            s[j] = v
+        return s[min(n - 1, (p * n) // 100)]
+
+    def elapsed(self):
+        # ms from the first ping to the end of the run (or now)
+        if self._started is None:
+            return 0
+        end = self.clock() if self._finished is None else self._finished
+        return ticks_diff(end, self._started)
+
+    def results(self):
+        stats = self.stats
+        done = stats['received'] + stats['lost']
+        elapsed = self.elapsed()
+        return {'sent': stats['sent'], 'received': stats['received'],
+                'loss': stats['lost'] / done if done else 0.0,
+                'duplicates': stats['duplicates'], 'late': stats['late'],
+                'rttMin': stats['minRtt'], 'rttMax': stats['maxRtt'],
+                'rttMean': stats['totalRtt'] // stats['received'] if stats['received'] else 0,
+                'rttP50': self.percentile(50), 'rttP90': self.percentile(90),
+                'rttP99': self.percentile(99),
+                # payload bits that made it there and back, per second
+                'goodput': stats['bytes'] * 8 * 1000 // elapsed if elapsed else 0}
+
+    def report(self):
+        r = self.results()
+        print('{0} sent, {1} received, {2}% lost, {3} late, {4} duplicates'.format(
+            r['sent'], r['received'], round(r['loss'] * 100, 1), r['late'], r['duplicates']))
+        print('RTT ms min {0} mean {1} p50 {2} p90 {3} p99 {4} max {5}'.format(
+            r['rttMin'], r['rttMean'], r['rttP50'], r['rttP90'], r['rttP99'], r['rttMax']))
+        print('goodput {0} bit/s'.format(r['goodput']))
@@ -0,0 +1,169 @@
+# RSSI spectrum survey for the SX127x driver: sweeps a frequency range in fixed
+# steps and samples the channel RSSI a few times per step, to find quiet
+# channels before a deployment.
+#
+#   scan = SpectrumScanner(lora, 433.05E6, 434.79E6, 25E3, samples=8)
+#   scan.sweep()                  # min / mean / max dBm per channel
+#   scan.quietest(5)              # the 5 channels with the lowest peaks
+#   fall = Waterfall(image, lcd, scan)
+#   while True:
+#       scan.sweep(); fall.draw()  # one row per sweep on the LCD
+#
+# The radio stays in RX_CONTINUOUS for the whole sweep and is retuned on the fly,
+# like LoRa frequency hopping does: a new channel only costs the FRF bytes that
+# changed, written in one burst that always ends with FRF_LSB (the chip applies
+# the new frequency when the LSB is written), then `samples` reads of RSSI_VALUE.
+# The RSSI is measured in the radio's current LoRa bandwidth. The frequency and
+# mode the radio had are restored when the sweep ends.
+#
+# Note: REG_RSSI_WIDEBAND, despite its name, is the chip's wideband noise
+# register used as a random number source; the per-channel RSSI is RSSI_VALUE.
+from array import array
+
+from sx127x import (REG_OP_MODE, REG_FRF_MSB, REG_RSSI_VALUE, MODE_LONG_RANGE_MODE,
+                    MODE_RX_CONTINUOUS)
+
+
+class SpectrumScanner:
+    # discard: RSSI reads thrown away after each retune while the PLL and the
+    # RSSI filter settle
+    def __init__(self, lora, start, stop, step, samples = 8, discard = 1):
+        self.lora = lora
+        self.start = start
+        self.step = step
+        self.samples = samples
+        self.discard = discard
+        n = int((stop - start) // step) + 1
+        self.channels = n
+        self._frf = array('L', [int((start + i * step) / 61.03516) for i in range(n)])
+        # RSSI_VALUE - offset = dBm, the offset depends on the band (see packetRssi())
+        self._offset = bytearray([164 if start + i * step < 868E6 else 157 for i in range(n)])
+        self.minimum = array('h', [0] * n)
+        self.mean = array('h', [0] * n)
+        self.maximum = array('h', [0] * n)
+        self._burst = bytearray(3)
+        self._views = [memoryview(self._burst)[k:] for k in range(3)]
+        self.stats = {'sweeps': 0, 'lastMs': 0, 'frfBytes': 0, 'reads': 0}
+
+    def frequency(self, channel):
+        return self.start + channel * self.step
+
+    def sweep(self):
+        lora = self.lora
+        read = lora.readRegister
+        burst = self._burst
+        views = self._views
+        frfs = self._frf
+        offsets = self._offset
+        minimum = self.minimum
+        mean = self.mean
+        maximum = self.maximum
+        samples = self.samples
+        discard = self.discard
+        stats = self.stats
+        t0 = lora.clock()
+        mode = read(REG_OP_MODE)
+        lora.writeRegister(REG_OP_MODE, MODE_LONG_RANGE_MODE | MODE_RX_CONTINUOUS)
+        last = -1
+        written = 0
+        for i in range(self.channels):
+            frf = frfs[i]
+            changed = frf ^ last if last >= 0 else 0xffffff
+            # first byte that differs, MSB = 0; LSB always goes, it latches the change
+            first = 0 if changed & 0xff0000 else (1 if changed & 0xff00 else 2)
+            burst[0] = frf >> 16
+            burst[1] = (frf >> 8) & 0xff
+            burst[2] = frf & 0xff
+            lora.writeBurst(REG_FRF_MSB + first, views[first])
+            written += 3 - first
+            last = frf
+            for _ in range(discard):
+                read(REG_RSSI_VALUE)
+            low = 255
+            high = 0
+            total = 0
+            for _ in range(samples):
+                v = read(REG_RSSI_VALUE)
+                total += v
+                if v < low:
+                    low = v
+                if v > high:
+                    high = v
+            offset = offsets[i]
+            minimum[i] = low - offset
+            maximum[i] = high - offset
+            mean[i] = total // samples - offset
+        # writeBurst() bypasses the shadow cache: setFrequency() rewrites it
+        lora.setFrequency(lora.parameters['frequency'])
+        lora.writeRegister(REG_OP_MODE, mode)
+        stats['sweeps'] += 1
+        stats['lastMs'] = lora.clock() - t0
+        stats['frfBytes'] += written
+        stats['reads'] += self.channels * (samples + discard)
+        return self.channels
+
+    def quietest(self, count = 5, values = None):
+        # indices of the `count` channels with the lowest values (by default the peaks)
+        values = self.maximum if values is None else values
+        order = sorted(range(self.channels), key=lambda i: values[i])
+        return order[:count]
+
+    def report(self, count = 5):
+        print('{0} channels, {1:.3f} to {2:.3f} MHz, sweep {3} ms'.format(self.channels,
+              self.start / 1E6, self.frequency(self.channels - 1) / 1E6, self.stats['lastMs']))
+        print('{0:<14}{1:>8}{2:>8}{3:>8}'.format('MHz', 'min', 'mean', 'max'))
+        for i in self.quietest(count):
+            print('{0:<14.4f}{1:>8}{2:>8}{3:>8}'.format(self.frequency(i) / 1E6,
+                  self.minimum[i], self.mean[i], self.maximum[i]))
+
+
+# waterfall colours, quiet to loud
+PALETTE = ((0, 0, 64), (0, 0, 160), (0, 64, 255), (0, 160, 255), (0, 224, 160),
+           (0, 255, 64), (128, 255, 0), (224, 224, 0), (255, 160, 0), (255, 64, 0),
+           (255, 0, 0), (255, 255, 255))
+
+
+class Waterfall:
+    # One row per sweep, drawn at the next line of the framebuffer (wrapping at
+    # the bottom, a white line marks the newest row) and pushed to the LCD alone,
+    # so a sweep costs one thin lcd.display(). `image` and `lcd` are the MaixPy
+    # modules, as for menu_ui.MenuRenderer. Values are dBm between floor and ceiling.
+    def __init__(self, image, lcd, scanner, width = 320, height = 480,
+                 floor = -130, ceiling = -60, values = 'maximum'):
+        self.lcd = lcd
+        self.scanner = scanner
+        self.width = width
+        self.height = height
+        self.floor = floor
+        self.ceiling = ceiling
+        self.values = values
+        self.fb = image.Image(size=(width, height))
+        self.fb.draw_rectangle(0, 0, width, height, color=PALETTE[0], fill=True)
+        self.row = 0
+        # channel -> first x, channel count may be more or less than width
+        n = scanner.channels
+        self._x = array('H', [i * width // n for i in range(n + 1)])
+
+    def colour(self, dbm):
+        levels = len(PALETTE) - 1
+        k = (dbm - self.floor) * levels // (self.ceiling - self.floor)
+        return PALETTE[0 if k < 0 else (levels - 1 if k >= levels else k)]
+
+    def draw(self):
+        fb = self.fb
+        values = getattr(self.scanner, self.values)
+        xs = self._x
+        y = self.row
+        for i in range(self.scanner.channels):
+            x0 = xs[i]
+            x1 = xs[i + 1] - 1
+            if x1 >= x0:
+                fb.draw_line(x0, y, x1, y, color=self.colour(values[i]))
+        marker = (y + 1) % self.height
+        fb.draw_line(0, marker, self.width - 1, marker, color=PALETTE[-1])
+        if marker:
+            self.lcd.display(fb, roi=(0, y, self.width, 2), oft=(0, y))
+        else:
+            self.lcd.display(fb, roi=(0, y, self.width, 1), oft=(0, y))
+            self.lcd.display(fb, roi=(0, 0, self.width, 1), oft=(0, 0))
+        self.row = marker
@@ -0,0 +1,128 @@
+# Several SX127x on one SPI bus, each with its own CS pin, e.g. a 433 MHz and
+# an 868 MHz module on SPI1 for a dual-band gateway.
+#
+#   bus = SpiBus()
+#   lora433 = SX127x(spi=spi1, pin_ss=cs433, ...)
+#   lora868 = SX127x(spi=spi1, pin_ss=cs868, ...)
+#   bus.attach(lora433, dio433)      # before init() and onReceive()
+#   bus.attach(lora868, dio868)
+#   while True:
+#       bus.service()                # from the main loop
+#
+# Every transaction holds the bus from CS low to CS high, and the driver holds
+# it across multi-transaction sequences (reading a packet, starting a TX) with
+# aquire_lock(). Nothing ever waits for the bus: DIO0 interrupts only flag the
+# radio, and service() handles the flagged radios from the main loop, in turn,
+# starting after the one served first last time, so a busy radio can't starve
+# the other. Radios without DIO0 are polled by service().
+
+
+class _BusCS:
+    # CS pin that takes the bus while low
+    def __init__(self, pin, bus, lora):
+        self.pin = pin
+        self.bus = bus
+        self.lora = lora
+
+    def value(self, level = None):
+        if level is None:
+            return self.pin.value()
+        if level == 0:
+            self.bus.acquire(self.lora)
+            self.pin.value(0)
+        else:
+            self.pin.value(1)
+            self.bus.release(self.lora)
+
+
+class _BusDio:
+    # DIO0 pin whose interrupt only flags the radio for service()
+    def __init__(self, pin, bus, index):
+        self.pin = pin
+        self.bus = bus
+        self.index = index
+
+    def set_handler_for_irq_on_rising_edge(self, handler):
+        bus = self.bus
+        bit = 1 << self.index
+        def flag(source):
+            bus._pending |= bit
+        self.pin.set_handler_for_irq_on_rising_edge(flag)
+
+    def detach_irq(self):
+        self.pin.detach_irq()
+
+
+class SpiBus:
+    def __init__(self):
+        self.radios = []
+        self._owner = None
+        self._depth = 0
+        self._pending = 0   # bit per radio: DIO0 went up
+        self._next = 0
+        self.stats = {'serviced': [], 'polled': [], 'conflicts': 0, 'maxPending': 0}
+
+    def attach(self, lora, pin_dio0 = None):
+        # pin_dio0: the radio's DIO0, if not already given as pin_RxDone
+        index = len(self.radios)
+        self.radios.append(lora)
+        self.stats['serviced'].append(0)
+        self.stats['polled'].append(0)
+        transport = lora.transport
+        if not hasattr(transport, 'cs'):
+            raise Exception('SpiBus needs a transport with a CS pin: ', lora.name)
+        lora.bus = self
+        transport.cs = _BusCS(transport.cs, self, lora)
+        pin = pin_dio0 if pin_dio0 is not None else lora.pin_RxDone
+        if pin is not None:
+            lora.pin_RxDone = _BusDio(pin, self, index)
+        return index
+
+    def acquire(self, lora):
+        if self._owner is not None and self._owner is not lora:
+            # someone used a radio from an interrupt handler while another had the bus
+            self.stats['conflicts'] += 1
+            raise Exception('SPI bus held by: ', self._owner.name)
+        self._owner = lora
+        self._depth += 1
+
+    def release(self, lora):
+        if self._owner is lora and self._depth > 0:
+            self._depth -= 1
+            if self._depth == 0:
+                self._owner = None
+
+    def busy(self):
+        return self._owner is not None
+
+    def service(self):
+        # one round over the radios; returns how many were served
+        n = len(self.radios)
+        if n == 0 or self._owner is not None:
+            return 0
+        pending = self._pending
+        count = 0
+        for k in range(n):
+            if pending & (1 << k):
+                count += 1
+        if count > self.stats['maxPending']:
+            self.stats['maxPending'] = count
+        served = 0
+        start = self._next
+        for k in range(n):
+            i = (start + k) % n
+            lora = self.radios[i]
+            bit = 1 << i
+            if self._pending & bit:
+                self._pending &= ~bit
+                lora.handleOnDio0(None)
+                self.stats['serviced'][i] += 1
+                served += 1
+            elif not isinstance(lora.pin_RxDone, _BusDio):
+                lora.pollTx()
+                if lora.pollRx():
+                    self.stats['polled'][i] += 1
+                    served += 1
+        if served:
+            self._next = (start + 1) % n
+        return served
@@ -0,0 +1,182 @@
+# SPI tracing and profiling for the SX127x driver.
+# Opt-in: enable() puts counting wrappers in front of the radio's transfer() and
+# transferBurst() (and of its public methods, to know which API call caused each
+# transaction); disable() removes them and the driver is back to its own
+# methods, so tracing costs nothing while it is off.
+#
+#   tracer = SpiTracer(lora, traceSize=256)
+#   tracer.enable()
+#   lora.send('PING')
+#   tracer.report()      # per register, per API call, timing histograms
+#   tracer.dump()        # the last transactions, oldest first
+#   tracer.disable()
+#
+# Collected per register (address & 0x7f): transactions and bytes. Per API
+# call: transactions, bytes, us. Per kind (read, write, burst read, burst
+# write): a histogram of transaction times. With traceSize > 0, a ring of the
+# last transactions: (us, address with the write bit, kind, value read or
+# written, or burst length).
+from array import array
+
+from sx127x import SX127x, REGISTER_NAMES
+from stagetimer import ticks_us, ticks_diff
+
+READ = 0
+WRITE = 1
+BURST_READ = 2
+BURST_WRITE = 3
+KINDS = ('read', 'write', 'burst read', 'burst write')
+
+DIRECT = '(direct)'     # register access from outside any public method
+# what the API wrappers leave alone: the register layer itself
+LOW_LEVEL = ('readRegister', 'writeRegister', 'readBurst', 'writeBurst', 'transfer', 'transferBurst')
+
+
+class SpiTracer:
+    def __init__(self, lora, traceSize = 0, bins = 16, binUs = 100):
+        self.lora = lora
+        self.bins = bins
+        self.binUs = binUs
+        self.traceSize = traceSize
+        self._time = array('L', [0] * traceSize)
+        self._addr = bytearray(traceSize)
+        self._kind = bytearray(traceSize)
+        self._value = array('H', [0] * traceSize)
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        self.regCount = array('L', [0] * 0x80)
+        self.regBytes = array('L', [0] * 0x80)
+        self.hist = [array('L', [0] * self.bins) for _ in KINDS]
+        self.apis = {}      # name: [transactions, bytes, us]
+        self.api = None
+        self._head = 0
+        self._count = 0
+
+    def enable(self, apis = True):
+        if self.enabled:
+            return
+        lora = self.lora
+        self._transfer = lora.transfer
+        self._transferBurst = lora.transferBurst
+        lora.transfer = self._tracedTransfer
+        lora.transferBurst = self._tracedBurst
+        self._wrapped = []
+        if apis:
+            for name in dir(SX127x):
+                if name[0] == '_' or name in LOW_LEVEL:
+                    continue
+                fn = getattr(lora, name)
+                if callable(fn):
+                    setattr(lora, name, self._wrap(name, fn))
+                    self._wrapped.append(name)
+        self.enabled = True
+
+    def disable(self):
+        if not self.enabled:
+            return
+        lora = self.lora
+        # the instance attributes go, the class methods show through again
+        for name in ['transfer', 'transferBurst'] + self._wrapped:
+            delattr(lora, name)
+        self.enabled = False
+
+    def _wrap(self, name, fn):
+        tracer = self
+
+        def wrapped(*args, **kwargs):
+            # transactions go to the outermost public call
+            outer = tracer.api
+            if outer is None:
+                tracer.api = name
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                tracer.api = outer
+        return wrapped
+
+    def _tracedTransfer(self, address, value = None):
+        t0 = ticks_us()
+        ret = self._transfer(address, value)
+        if value is None:
+            self._record(t0, address, READ, ret, 2)
+        else:
+            self._record(t0, address, WRITE, value, 2)
+        return ret
+
+    def _tracedBurst(self, address, buffer, write = False):
+        t0 = ticks_us()
+        self._transferBurst(address, buffer, write)
+        self._record(t0, address, BURST_WRITE if write else BURST_READ, len(buffer), 1 + len(buffer))
+
+    def _record(self, t0, address, kind, value, nbytes):
+        dt = ticks_diff(ticks_us(), t0)
+        reg = address & 0x7f
+        self.regCount[reg] += 1
+        self.regBytes[reg] += nbytes
+        b = dt // self.binUs
+        self.hist[kind][b if b < self.bins else self.bins - 1] += 1
+        name = self.api if self.api is not None else DIRECT
+        a = self.apis.get(name)
+        if a is None:
+            a = self.apis[name] = [0, 0, 0]
+        a[0] += 1
+        a[1] += nbytes
+        a[2] += dt
+        if self.traceSize:
+            i = self._head
+            self._time[i] = t0 & 0xffffffff
+            self._addr[i] = address & 0xff
+            self._kind[i] = kind
+            self._value[i] = value & 0xffff
+            self._head = (i + 1) % self.traceSize
+            if self._count < self.traceSize:
+                self._count += 1
+
+    def trace(self):
+        # [(us, address, kind, value)], oldest first
+        out = []
+        start = (self._head - self._count) % self.traceSize if self.traceSize else 0
+        for n in range(self._count):
+            i = (start + n) % self.traceSize
+            out.append((self._time[i], self._addr[i], self._kind[i], self._value[i]))
+        return out
+
+    def dump(self):
+        for t, address, kind, value in self.trace():
+            reg = address & 0x7f
+            detail = '{0} bytes'.format(value) if kind >= BURST_READ else '0x{0:02x}'.format(value)
+            print('{0:>10} {1:<12} 0x{2:02x} {3:<16} {4}'.format(t, KINDS[kind], reg,
+                  REGISTER_NAMES.get(reg, ''), detail))
+
+    def replay(self, lora = None):
+        # re-issue the traced register writes, in order, on lora (by default the
+        # traced radio). Bursts are skipped: their data isn't kept. Returns the
+        # number of writes replayed.
+        lora = self.lora if lora is None else lora
+        n = 0
+        for t, address, kind, value in self.trace():
+            if kind == WRITE:
+                lora.writeRegister(address & 0x7f, value)
+                n += 1
+        return n
+
+    def report(self):
+        print('{0:<28}{1:>8}{2:>8}{3:>10}'.format('API call', 'xfers', 'bytes', 'us'))
+        for name in sorted(self.apis, key=lambda k: -self.apis[k][0]):
+            xfers, nbytes, us = self.apis[name]
+            print('{0:<28}{1:>8}{2:>8}{3:>10}'.format(name, xfers, nbytes, us))
+        print()
+        print('{0:<28}{1:>8}{2:>8}'.format('register', 'xfers', 'bytes'))
+        for reg in range(0x80):
+            if self.regCount[reg]:
+                print('{0:<28}{1:>8}{2:>8}'.format('0x{0:02x} {1}'.format(reg, REGISTER_NAMES.get(reg, '')),
+                      self.regCount[reg], self.regBytes[reg]))
+        print()
+        # the last bin is open-ended
+        print('transaction time, bins of {0} us'.format(self.binUs))
+        for kind in range(len(KINDS)):
+            h = self.hist[kind]
+            if sum(h):
+                print('{0:<12} {1}'.format(KINDS[kind], ' '.join(str(c) for c in h)))
@@ -0,0 +1,139 @@
+# Per-stage timing for frame loops, without printing on every frame.
+# Each stage's durations go into a fixed histogram (bins of binUs us, the last
+# bin catching everything longer), so recording costs two ticks_us() and a few
+# array updates, and nothing is allocated. report() prints mean, p50, p90 and max
+# per stage, plus frames per second.
+#
+#   timer = StageTimer(('snapshot', 'process', 'display'))
+#   while True:
+#       timer.start()
+#       img = sensor.snapshot(); timer.mark(0)
+#       ...                      timer.mark(1)
+#       lcd.display(img);        timer.mark(2)
+#       if timer.frame(): timer.report()   # True every `every` frames
+import time
+from array import array
+
+try:
+    ticks_us = time.ticks_us
+    ticks_diff = time.ticks_diff
+except AttributeError:  # CPython
+    def ticks_us():
+        return int(time.perf_counter() * 1000000)
+    def ticks_diff(a, b):
+        return a - b
+
+
+class StageTimer:
+    def __init__(self, stages, bins = 32, binUs = 2000, every = 100, clock = ticks_us):
+        self.stages = stages
+        self.clock = clock  # us
+        self.bins = bins
+        self.binUs = binUs
+        self.every = every
+        self._hist = [array('L', [0] * bins) for _ in stages]
+        self._total = array('L', [0] * len(stages))
+        self._max = array('L', [0] * len(stages))
+        self._t = 0
+        self._frameStart = 0
+        self.reset()
+
+    def reset(self):
+        for h in self._hist:
+            for i in range(self.bins):
+                h[i] = 0
+        for i in range(len(self.stages)):
+            self._total[i] = 0
+            self._max[i] = 0
+        self.frames = 0
+        self._since = self.clock()
+
+    def start(self):
+        self._t = self.clock()
+
+    def mark(self, stage):
+        # the time since start() or the previous mark() goes to `stage`
+        now = self.clock()
+        dt = ticks_diff(now, self._t)
+        self._t = now
+        b = dt // self.binUs
+        self._hist[stage][b if b < self.bins else self.bins - 1] += 1
+        self._total[stage] += dt
+        if dt > self._max[stage]:
+            self._max[stage] = dt
+
+    def frame(self):
+        # count a frame; True when it's time to report
+        self.frames += 1
+        return self.frames >= self.every
+
+    def count(self, stage):
+        return sum(self._hist[stage])
+
+    def mean(self, stage):
+        # us
+        count = self.count(stage)
+        return self._total[stage] / count if count else 0
+
+    def percentile(self, stage, p):
+        # upper edge of the bin holding the p-th percentile (at most the max), us
+        h = self._hist[stage]
+        n = 0
+        for i in range(self.bins):
+            n += h[i]
+        if n == 0:
+            return 0
+        target = (p * n + 99) // 100
+        seen = 0
+        for i in range(self.bins):
+            seen += h[i]
+            if seen >= target:
+                break
+        return min((i + 1) * self.binUs, self._max[stage])
+
+    def fps(self):
+        dt = ticks_diff(self.clock(), self._since)
+        return self.frames * 1000000 / dt if dt > 0 else 0.0
+
+    def report(self, reset = True):
+        print('{0} frames, {1:.1f} fps'.format(self.frames, self.fps()))
+        print('{0:<10}{1:>9}{2:>9}{3:>9}{4:>9}'.format('stage', 'mean ms', 'p50 ms', 'p90 ms', 'max ms'))
+        for i in range(len(self.stages)):
+            print('{0:<10}{1:>9.1f}{2:>9.1f}{3:>9.1f}{4:>9.1f}'.format(self.stages[i], self.mean(i) / 1000,
+                  self.percentile(i, 50) / 1000, self.percentile(i, 90) / 1000, self._max[i] / 1000))
+        if reset:
+            self.reset()
+
+
+if __name__ == '__main__':
+    # fake us clock: each stage takes a known time, so every number is exact
+    now = [0]
+    timer = StageTimer(('snapshot', 'process', 'display'), bins=8, binUs=2000, every=10, clock=lambda: now[0])
+    durations = ((3000, 500, 12000), (3000, 1500, 12000), (5000, 500, 40000))
+    reports = 0
+    for n in range(30):
+        timer.start()
+        for stage, dt in enumerate(durations[n % 3]):
+            now[0] += dt
+            timer.mark(stage)
+        if timer.frame():
+            reports += 1
+            if reports < 3:
+                timer.reset()
+    assert reports == 3 and timer.frames == 10
+    # 10 frames since the last reset: 4 of the last pattern, 3 of each other
+    for stage in range(3):
+        assert timer.count(stage) == 10
+        expected = sum(durations[n % 3][stage] for n in range(20, 30))
+        assert timer._total[stage] == expected, (stage, timer._total[stage], expected)
+    # the stages cover the frames exactly: nothing counted twice or lost
+    assert sum(timer._total) == now[0] - timer._since
+    assert timer.mean(0) == 3800 and timer._max[0] == 5000
+    # a percentile is its bin's upper edge, capped at the max
+    assert timer.percentile(0, 50) == 4000 and timer.percentile(0, 90) == 5000
+    assert timer.mean(1) == 800 and timer.percentile(1, 50) == 1500
+    # 40 ms is past the last bin (16 ms): it is counted there, max is exact
+    assert timer.percentile(2, 50) == 14000 and timer.percentile(2, 90) == 16000 and timer._max[2] == 40000
+    frameUs = sum(sum(durations[n % 3]) for n in range(20, 30)) / 10
+    assert abs(timer.fps() - 1000000 / frameUs) < 0.01
+    timer.report()
@@ -1,6 +1,21 @@
 # DATE: 2020-12-3
 import gc
-import machine
+import time
+from array import array
+
+try:
+    from random import getrandbits
+except ImportError:
+    from urandom import getrandbits
+
+try:
+    ticks_ms = time.ticks_ms
+    ticks_diff = time.ticks_diff
+except AttributeError:  # CPython
+    def ticks_ms():
+        return int(time.monotonic() * 1000)
+    def ticks_diff(a, b):
+        return a - b
 
 PA_OUTPUT_RFO_PIN = 0
 PA_OUTPUT_PA_BOOST_PIN = 1
@@ -17,7 +32,8 @@ REG_FIFO_ADDR_PTR = 0x0d
 
 REG_FIFO_TX_BASE_ADDR = 0x0e
 FifoTxBaseAddr = 0x00
-# FifoTxBaseAddr = 0x80
+# double buffering (setDoubleBuffer()): TX in the top half, RX in the bottom one
+FifoSplitTxBaseAddr = 0x80
 
 REG_FIFO_RX_BASE_ADDR = 0x0f
 FifoRxBaseAddr = 0x00
@@ -25,11 +41,14 @@ REG_FIFO_RX_CURRENT_ADDR = 0x10
 REG_IRQ_FLAGS_MASK = 0x11
 REG_IRQ_FLAGS = 0x12
 REG_RX_NB_BYTES = 0x13
+REG_RX_HEADER_CNT_VALUE_MSB = 0x14  # valid headers since sleep, 16 bits
+REG_RX_PACKET_CNT_VALUE_MSB = 0x16
 REG_PKT_SNR_VALUE = 0x19
 REG_PKT_RSSI_VALUE = 0x1a
-REG_PKT_SNR_VALUE = 0x1b
+REG_RSSI_VALUE = 0x1b
 REG_MODEM_CONFIG_1 = 0x1d
 REG_MODEM_CONFIG_2 = 0x1e
+REG_SYMB_TIMEOUT_LSB = 0x1f
 REG_PREAMBLE_MSB = 0x20
 REG_PREAMBLE_LSB = 0x21
 REG_PAYLOAD_LENGTH = 0x22
@@ -49,51 +68,371 @@ MODE_STDBY = 0x01
 MODE_TX = 0x03
 MODE_RX_CONTINUOUS = 0x05
 MODE_RX_SINGLE = 0x06
+MODE_CAD = 0x07
 
 # PA config
 PA_BOOST = 0x80
 MAX_POWER = 0x70
 
 # IRQ masks
+IRQ_CAD_DETECTED_MASK = 0x01
+IRQ_CAD_DONE_MASK = 0x04
 IRQ_TX_DONE_MASK = 0x08
 IRQ_PAYLOAD_CRC_ERROR_MASK = 0x20
 IRQ_RX_DONE_MASK = 0x40
 IRQ_RX_TIME_OUT_MASK = 0x80
 
+# DIO0 mapping (REG_DIO_MAPPING_1 bits 7-6)
+DIO0_RX_DONE = 0x00
+DIO0_TX_DONE = 0x40
+DIO0_CAD_DONE = 0x80
+
+# what the packet at the head of the TX queue is waiting for
+TX_ON_AIR = 0
+TX_CAD = 1      # listen before talk: channel activity detection running
+TX_BACKOFF = 2  # channel was busy, retry later
+
+# sniffing receive (receiveSniff()) phases
+SNIFF_IDLE = 0  # asleep until the next CAD
+SNIFF_CAD = 1
+SNIFF_RX = 2    # activity seen: RX_SINGLE until a packet or the symbol timeout
+
 # Buffer size
 MAX_PKT_LENGTH = 255
 
+# signal bandwidths in Hz, by MODEM_CONFIG_1 index
+BANDWIDTHS = (7.8E3, 10.4E3, 15.6E3, 20.8E3, 31.25E3, 41.7E3, 62.5E3, 125E3, 250E3, 500E3)
+
+# keys accepted by SX127x.configure(), same as the parameters dict
+# ('output_pin', PA_OUTPUT_RFO_PIN or PA_OUTPUT_PA_BOOST_PIN, may be left out: PA_BOOST)
+CONFIG_KEYS = ('frequency', 'tx_power_level', 'signal_bandwidth', 'spreading_factor',
+               'coding_rate', 'preamble_length', 'implicitHeader', 'sync_word', 'enable_CRC',
+               'output_pin')
+
+# Memory policies, see setMemoryPolicy()
+GC_ALWAYS = 0   # gc.collect() after every packet
+GC_NEVER = 1
+GC_EVERY_N = 2  # every N packets
+GC_LOW_HEAP = 3 # only when free heap drops below a threshold
+
+# PacketRing overflow policies
+RING_DROP_OLDEST = 0
+RING_DROP_NEWEST = 1
+
+# Configuration registers mirrored by the optional shadow cache.
+# Only registers the chip never changes on its own belong here.
+SHADOW_REGS = (REG_FRF_MSB, REG_FRF_MID, REG_FRF_LSB, REG_PA_CONFIG, REG_LNA,
+               REG_FIFO_TX_BASE_ADDR, REG_FIFO_RX_BASE_ADDR,
+               REG_MODEM_CONFIG_1, REG_MODEM_CONFIG_2, REG_MODEM_CONFIG_3,
+               REG_PREAMBLE_MSB, REG_PREAMBLE_LSB,
+               REG_DETECTION_OPTIMIZE, REG_DETECTION_THRESHOLD,
+               REG_SYNC_WORD, REG_DIO_MAPPING_1)
+# address -> name, for register dumps and diffs
+REGISTER_NAMES = {}
+for _name in list(globals()):
+    if _name.startswith('REG_'):
+        REGISTER_NAMES[globals()[_name]] = _name[4:]
+
+# address -> slot + 1 (0: not shadowed)
+_shadowSlot = bytearray(0x80)
+for _i in range(len(SHADOW_REGS)):
+    _shadowSlot[SHADOW_REGS[_i]] = _i + 1
+
+def bandwidthIndex(sbw):
+    # BW either by frequency (125E3) or by number (7)
+    sbw = abs(sbw) # just in case there's an idiot in the room
+    if sbw < 10:
+        return int(sbw)
+    for i in range(len(BANDWIDTHS)):
+        if sbw <= BANDWIDTHS[i]:
+            return i
+    return len(BANDWIDTHS) - 1
+
+def paConfig(level, outputPin = PA_OUTPUT_PA_BOOST_PIN):
+    # (REG_PA_CONFIG value, level as clamped) for level dBm on the given PA output
+    if outputPin == PA_OUTPUT_RFO_PIN:
+        level = min(max(level, 0), 14)
+        return MAX_POWER | level, level
+    level = min(max(level, 2), 17)
+    return PA_BOOST | MAX_POWER | (level - 2), level
+
+def needsLowDataRateOptimize(sf, bw):
+    # LowDataRateOptimize is mandated when a symbol lasts more than 16 ms
+    return 1000 / (BANDWIDTHS[bandwidthIndex(bw)] / 2 ** sf) > 16
+
+# symbol time in us, SYMBOL_US[bw index][sf - 6]
+SYMBOL_US = tuple(tuple(int((1 << sf) * 1E6 / bw) for sf in range(6, 13)) for bw in BANDWIDTHS)
+
+def timeOnAir(length, sf, bw, cr = 5, preamble = 8, crc = False, implicit = False, ldro = None):
+    # microseconds on air for a payload of length bytes, SX1276 datasheet 4.1.1.7.
+    # bw by frequency or number, cr as the denominator (5..8), ldro None: automatic
+    sf = min(max(sf, 6), 12)
+    bw = bandwidthIndex(bw)
+    tsym = SYMBOL_US[bw][sf - 6]
+    if ldro is None:
+        ldro = tsym > 16000
+    num = 8 * length - 4 * sf + 28 + (16 if crc else 0) - (20 if implicit else 0)
+    den = 4 * (sf - (2 if ldro else 0))
+    symbols = 8 + max(-(-num // den) * (min(max(cr, 5), 8)), 0)
+    # preamble + 4.25 symbols
+    return (preamble * 4 + 17) * tsym // 4 + symbols * tsym
+
+def decodeRegisters(regs):
+    # named LoRa fields from a 128-byte register snapshot (see SX127x.snapshotRegisters)
+    bw = min(regs[REG_MODEM_CONFIG_1] >> 4, len(BANDWIDTHS) - 1)
+    frf = (regs[REG_FRF_MSB] << 16) | (regs[REG_FRF_MID] << 8) | regs[REG_FRF_LSB]
+    pa = regs[REG_PA_CONFIG]
+    snr = regs[REG_PKT_SNR_VALUE]
+    return {'longRangeMode': bool(regs[REG_OP_MODE] & MODE_LONG_RANGE_MODE),
+            'mode': regs[REG_OP_MODE] & 0x07,
+            'frequency': int(frf * 61.03516),
+            'paBoost': bool(pa & PA_BOOST),
+            'maxPower': (pa >> 4) & 0x07,
+            'outputPower': pa & 0x0f,
+            'lnaGain': regs[REG_LNA] >> 5,
+            'lnaBoostHf': regs[REG_LNA] & 0x03,
+            'fifoAddrPtr': regs[REG_FIFO_ADDR_PTR],
+            'fifoTxBaseAddr': regs[REG_FIFO_TX_BASE_ADDR],
+            'fifoRxBaseAddr': regs[REG_FIFO_RX_BASE_ADDR],
+            'fifoRxCurrentAddr': regs[REG_FIFO_RX_CURRENT_ADDR],
+            'irqFlagsMask': regs[REG_IRQ_FLAGS_MASK],
+            'irqFlags': regs[REG_IRQ_FLAGS],
+            'rxNbBytes': regs[REG_RX_NB_BYTES],
+            'rxHeaderCount': (regs[REG_RX_HEADER_CNT_VALUE_MSB] << 8) | regs[REG_RX_HEADER_CNT_VALUE_MSB + 1],
+            'rxPacketCount': (regs[REG_RX_PACKET_CNT_VALUE_MSB] << 8) | regs[REG_RX_PACKET_CNT_VALUE_MSB + 1],
+            'packetSnr': (snr - 256 if snr > 127 else snr) * 0.25,
+            'packetRssi': regs[REG_PKT_RSSI_VALUE] - (164 if frf * 61.03516 < 868E6 else 157),
+            'bandwidth': BANDWIDTHS[bw],
+            'codingRate': ((regs[REG_MODEM_CONFIG_1] >> 1) & 0x07) + 4,
+            'implicitHeader': bool(regs[REG_MODEM_CONFIG_1] & 0x01),
+            'spreadingFactor': regs[REG_MODEM_CONFIG_2] >> 4,
+            'crc': bool(regs[REG_MODEM_CONFIG_2] & 0x04),
+            'symbTimeout': ((regs[REG_MODEM_CONFIG_2] & 0x03) << 8) | regs[REG_MODEM_CONFIG_2 + 1],
+            'preambleLength': (regs[REG_PREAMBLE_MSB] << 8) | regs[REG_PREAMBLE_LSB],
+            'payloadLength': regs[REG_PAYLOAD_LENGTH],
+            'lowDataRateOptimize': bool(regs[REG_MODEM_CONFIG_3] & 0x08),
+            'agcAutoOn': bool(regs[REG_MODEM_CONFIG_3] & 0x04),
+            'detectionOptimize': regs[REG_DETECTION_OPTIMIZE] & 0x07,
+            'detectionThreshold': regs[REG_DETECTION_THRESHOLD],
+            'syncWord': regs[REG_SYNC_WORD],
+            'dio0Mapping': regs[REG_DIO_MAPPING_1] >> 6,
+            'version': regs[REG_VERSION]}
+
+def diffRegisters(before, after):
+    # [(address, name, before, after), ...] for every register that differs
+    changes = []
+    for i in range(1, 0x80):
+        if before[i] != after[i]:
+            changes.append((i, REGISTER_NAMES.get(i, ''), before[i], after[i]))
+    return changes
+
 def twos(val): # 8-bit
     if (val & (1 << 7)) != 0:
         val = val - (1 << 8)
     return (val & 0xff)
 
+class PacketRing:
+    # Fixed-size ring of preallocated packet slots, filled by SX127x.receiveInto().
+    # Slot i is packet(i) (length[i] bytes), with rssi[i] (dBm), snr[i] (quarter
+    # dB, divide by 4) and ticks[i] (ticks_ms at reception) alongside.
+    #   i = ring.first()
+    #   while i >= 0:
+    #       handle(ring.packet(i), ring.rssi[i], ring.snr[i] / 4)
+    #       ring.release()
+    #       i = ring.first()
+    def __init__(self, slots = 8, slotSize = MAX_PKT_LENGTH, policy = RING_DROP_OLDEST):
+        self.slots = slots
+        self.slotSize = slotSize
+        self.policy = policy
+        self._buf = bytearray(slots * slotSize)
+        mv = memoryview(self._buf)
+        self._views = [mv[i * slotSize:(i + 1) * slotSize] for i in range(slots)]
+        # per slot, the last length-cut view handed out and its length
+        self._windows = list(self._views)
+        self._windowLength = array('H', [slotSize] * slots)
+        self.length = array('H', [0] * slots)
+        self.rssi = array('h', [0] * slots)
+        self.snr = array('b', [0] * slots)
+        self.ticks = array('L', [0] * slots)
+        self.clear()
+
+    def clear(self):
+        self._head = 0  # next slot to fill
+        self._count = 0
+        self.stored = 0
+        self.droppedOldest = 0
+        self.droppedNewest = 0
+
+    def __len__(self):
+        return self._count
+
+    def view(self, slot):
+        return self._views[slot]
+
+    def window(self, slot, length):
+        # the first length bytes of slot. The view is kept, so while packets of
+        # one length come in (pings, fixed frames) nothing is allocated; a new
+        # length costs one memoryview slice.
+        if self._windowLength[slot] != length:
+            self._windows[slot] = self._views[slot][:length]
+            self._windowLength[slot] = length
+        return self._windows[slot]
+
+    def packet(self, slot):
+        return self.window(slot, self.length[slot])
+
+    def first(self):
+        # oldest slot, or -1 when empty
+        if self._count == 0:
+            return -1
+        return (self._head - self._count) % self.slots
+
+    def release(self):
+        if self._count:
+            self._count -= 1
+
+    def reserve(self):
+        # slot to fill next, or -1 if the packet must be dropped
+        if self._count == self.slots:
+            if self.policy == RING_DROP_NEWEST:
+                self.droppedNewest += 1
+                return -1
+            self.droppedOldest += 1
+            self._count -= 1
+        return self._head
+
+    def commit(self, slot, length, rssi = 0, snr = 0, ticks = 0):
+        self.length[slot] = length
+        self.rssi[slot] = rssi
+        self.snr[slot] = snr
+        self.ticks[slot] = ticks
+        self._head = (slot + 1) % self.slots
+        self._count += 1
+        self.stored += 1
+
+
+class MachineSPI:
+    # Transport over a MicroPython machine.SPI and a CS pin (MaixPy GPIO,
+    # machine.Pin). A transport gives the driver:
+    #   read(address) -> value, write(address, value): one register
+    #   readBurst(address, buffer), writeBurst(address, buffer): consecutive
+    #       registers (or the FIFO) in one transaction
+    #   waitIrq(timeout_ms) -> True if DIO0 is up (it stays up until the flag
+    #       it is mapped to is cleared)
+    #   dio0: the DIO0 pin, or None
+    # Others: linuxspi.SpidevTransport (Linux spidev), sx127x_sim.SimTransport.
+    def __init__(self, spi, cs, dio0 = None):
+        self.spi = spi
+        self.cs = cs
+        self.dio0 = dio0
+
+    def read(self, address):
+        self.cs.value(0)
+        self.spi.write(address & 0x7f)
+        response = self.spi.read(1)
+        self.cs.value(1)
+        return response[0]
+
+    def write(self, address, value):
+        self.cs.value(0)
+        self.spi.write(address | 0x80)
+        self.spi.write(value)
+        self.cs.value(1)
+
+    def readBurst(self, address, buffer):
+        self.cs.value(0)
+        self.spi.write(address & 0x7f)
+        if len(buffer) > 0:
+            self.spi.readinto(buffer)
+        self.cs.value(1)
+
+    def writeBurst(self, address, buffer):
+        self.cs.value(0)
+        self.spi.write(address | 0x80)
+        if len(buffer) > 0:
+            self.spi.write(buffer)
+        self.cs.value(1)
+
+    def waitIrq(self, timeout):
+        if self.dio0 is None:
+            return False
+        start = ticks_ms()
+        while not self.dio0.value():
+            if ticks_diff(ticks_ms(), start) >= timeout:
+                return False
+        return True
+
+
 class SX127x:
     # The controller can be ESP8266, ESP32, Raspberry Pi, or a PC.
     # The controller needs to provide an interface consisted of:
-    # 1. a SPI, with transfer function.
+    # 1. a transport for register access: spi and pin_ss (MicroPython), or any
+    #    object with MachineSPI's methods as transport (see linuxspi.py for spidev).
     # 2. a reset pin, with low(), high() functions.
     # 3. IRQ pinS , to be triggered by RFM96W's DIO0~5 pins. These pins each has two functions:
     #   3.1 set_handler_for_irq_on_rising_edge()
     #   3.2 detach_irq()
+    #    or, on a PC, the transport's DIO0 and waitIrq() from the main loop.
     # 4. a function to blink on-board LED.
 
     def __init__(self,
-                 spi, pin_ss, name = 'SX127x',
+                 spi = None, pin_ss = None, name = 'SX127x',
                  parameters = {'frequency' : 433E6, 'tx_power_level': 20, 'signal_bandwidth': 125E3,
                                'spreading_factor': 10, 'coding_rate': 5, 'preamble_length': 8,
                                'implicitHeader'  : False, 'sync_word': 0x12, 'enable_CRC': False},
-                 onReceive = None):
+                 onReceive = None, shadow = False, pin_RxDone = None, maxTxQueue = 8,
+                 clock = ticks_ms, transport = None):
         self.name = name
-        self.parameters = parameters
+        self.parameters = dict(parameters)
+        self._frequency = self.parameters['frequency']
+        self._implicitHeaderMode = None
         self._onReceive = onReceive
+        if transport is None:
+            transport = MachineSPI(spi, pin_ss)
+        elif pin_RxDone is None:
+            pin_RxDone = transport.dio0
+        self.transport = transport
+        self.pin_RxDone = pin_RxDone  # DIO0
+        self.bus = None  # set by spibus.SpiBus.attach()
+        self.clock = clock  # ms, for TX latency, backoffs, sniffing and packet stamps
+        # non-blocking TX: [(payload, callback, implicitHeader, queued_ms), ...]
+        self._txQueue = []
+        self._txCurrent = None
+        self._txStarted = 0
+        self._txPhase = TX_ON_AIR
+        self._configPending = {}  # configure() changes waiting for TX_DONE
+        self.maxTxQueue = maxTxQueue
+        self.setListenBeforeTalk(False)
+        self.resetTxStats()
+        # continuous receive
+        self._rxRing = None
+        self._listen = False
+        self._sniffInterval = None
+        self._sniffPhase = SNIFF_IDLE
+        self._sniffAt = 0
+        self._sniffOn = 0
+        self.resetSniffStats()
+        self._rxHeaders = 0
+        self._rxCnt = bytearray(2)
+        self._snapshot = bytearray(0x80)
+        self.resetRxStats()
+        # FIFO layout, see setDoubleBuffer()
+        self._txBase = FifoTxBaseAddr
+        self._rxBase = FifoRxBaseAddr
+        self._txRoom = MAX_PKT_LENGTH
+        self._staged = None
+        self.setMemoryPolicy(GC_ALWAYS)
         self._lock = False
-        self.spi = spi
-        self.pin_ss = pin_ss
+        self._shadow = None
+        self._shadowValid = 0
+        self._shadowVerify = False
+        self.enableShadow(shadow)
 
     def init(self, parameters = None):
         if parameters:
-            self.parameters = parameters
+            self.parameters = dict(parameters)
+        # the chip may have been reset: forget what we think it holds
+        self.invalidateShadow()
         # check version
         version = self.readRegister(REG_VERSION)
         if version != 0x12:
@@ -109,7 +448,7 @@ class SX127x:
         self.writeRegister(REG_LNA, self.readRegister(REG_LNA) | 0x03)
         # set auto AGC
         self.writeRegister(REG_MODEM_CONFIG_3, 0x04)
-        self.setTxPower(self.parameters['tx_power_level'])
+        self.setTxPower(self.parameters['tx_power_level'], self.parameters.get('output_pin', PA_OUTPUT_PA_BOOST_PIN))
         self._implicitHeaderMode = None
         self.implicitHeaderMode(self.parameters['implicitHeader'])
         self.setSpreadingFactor(self.parameters['spreading_factor'])
@@ -119,20 +458,80 @@ class SX127x:
         self.enableCRC(self.parameters['enable_CRC'])
         # set LowDataRateOptimize flag if symbol time > 16ms (default disable on reset)
         # self.writeRegister(REG_MODEM_CONFIG_3, self.readRegister(REG_MODEM_CONFIG_3) & 0xF7)  # default disable on reset
-        if 1000 / (self.parameters['signal_bandwidth'] / 2 ** self.parameters['spreading_factor']) > 16:
+        if needsLowDataRateOptimize(self.parameters['spreading_factor'], self.parameters['signal_bandwidth']):
             self.writeRegister(REG_MODEM_CONFIG_3, self.readRegister(REG_MODEM_CONFIG_3) | 0x08)
         # set base addresses
-        self.writeRegister(REG_FIFO_TX_BASE_ADDR, FifoTxBaseAddr)
-        self.writeRegister(REG_FIFO_RX_BASE_ADDR, FifoRxBaseAddr)
+        self.writeRegister(REG_FIFO_TX_BASE_ADDR, self._txBase)
+        self.writeRegister(REG_FIFO_RX_BASE_ADDR, self._rxBase)
+        self._staged = None
         self.standby()
+        # DIO0 also signals TX_DONE, so its interrupt is taken from here on and
+        # not only once onReceive() is called: a radio that only sends needs it too
+        if self.pin_RxDone:
+            self.pin_RxDone.set_handler_for_irq_on_rising_edge(handler = self.handleOnDio0)
+
+    # Double buffering: the 256-byte FIFO is split, RX in 0x00-0x7F and TX in
+    # 0x80-0xFF, so packets are limited to 128 bytes each way. In exchange, a
+    # frame can be written to the FIFO while the radio keeps receiving
+    # (preload()). Sending it is then a single OP_MODE write (after the DIO0
+    # mapping, if DIO0 is wired), straight from RX, and the radio goes back to
+    # RX on TX_DONE. While a frame is staged, RX is restarted after each packet,
+    # so that the next one lands at the RX base again and can't run into the
+    # TX half.
+    def setDoubleBuffer(self, enable = True):
+        self._txBase = FifoSplitTxBaseAddr if enable else FifoTxBaseAddr
+        self._rxBase = FifoRxBaseAddr
+        self._txRoom = 0x100 - self._txBase if enable else MAX_PKT_LENGTH
+        self._staged = None
+        self.writeRegister(REG_FIFO_TX_BASE_ADDR, self._txBase)
+        self.writeRegister(REG_FIFO_RX_BASE_ADDR, self._rxBase)
+
+    def doubleBuffered(self):
+        return self._txBase != self._rxBase
 
     def beginPacket(self, implicitHeaderMode = False):
-        self.standby()
-        self.implicitHeaderMode(implicitHeaderMode)
+        # with a split FIFO, the TX half can be filled without leaving RX, as
+        # long as the header mode stays (it is shared with the receiver)
+        if not self.doubleBuffered() or implicitHeaderMode != self._implicitHeaderMode:
+            self.standby()
+            self.implicitHeaderMode(implicitHeaderMode)
+        self._staged = None
         # reset FIFO address and paload length
-        self.writeRegister(REG_FIFO_ADDR_PTR, FifoTxBaseAddr)
+        self.writeRegister(REG_FIFO_ADDR_PTR, self._txBase)
         self.writeRegister(REG_PAYLOAD_LENGTH, 0)
 
+    def preload(self, payload, implicitHeader = False):
+        # stage the next frame in the TX half while the radio keeps receiving;
+        # send(payload) or sendPreloaded() transmits it without rewriting it.
+        # Returns the number of bytes staged, -1 while a packet is being sent.
+        if not self.doubleBuffered():
+            raise Exception('preload() needs setDoubleBuffer(): ', self.name)
+        if self._txCurrent is not None:
+            return -1  # the TX half is in use until TX_DONE
+        if isinstance(payload, str):
+            payload = payload.encode()
+        self.aquire_lock(True)
+        try:
+            self.beginPacket(implicitHeader)
+            size = self.write(payload)
+            self._staged = payload
+            if self._listen and self._txCurrent is None and self._sniffInterval is None:
+                # packets already received may have moved the RX write position
+                self._restartRx()
+        finally:
+            self.aquire_lock(False)
+        return size
+
+    def sendPreloaded(self, callback = None):
+        if self._staged is None:
+            return False
+        return self.send(self._staged, callback, self._implicitHeaderMode)
+
+    def _restartRx(self):
+        # back to RX through standby: the chip writes the next packet at the RX base
+        self.writeRegister(REG_OP_MODE, MODE_LONG_RANGE_MODE | MODE_STDBY)
+        self.writeRegister(REG_OP_MODE, MODE_LONG_RANGE_MODE | MODE_RX_CONTINUOUS)
+
     def endPacket(self):
         # put in TX mode
         self.writeRegister(REG_OP_MODE, MODE_LONG_RANGE_MODE | MODE_TX)
@@ -141,35 +540,203 @@ class SX127x:
             pass
         # clear IRQs
         self.writeRegister(REG_IRQ_FLAGS, IRQ_TX_DONE_MASK)
+        if self._listen:
+            self.receive()
         self.collect_garbage()
 
+    # Non-blocking transmit.
+    # send() queues a payload and returns at once; TX_DONE is picked up either by
+    # the DIO0 interrupt (pin_RxDone, handled from init() on) or by calling
+    # pollTx() from the main loop, and the next queued packet is started right away.
+    # callback(lora, latency_ms) is called when the packet is on air and done,
+    # latency_ms being the time from send() to TX_DONE.
+    def send(self, payload, callback = None, implicitHeader = False):
+        if len(self._txQueue) >= self.maxTxQueue:
+            self.txStats['dropped'] += 1
+            return False
+        if isinstance(payload, str):
+            payload = payload.encode()
+        self._txQueue.append((payload, callback, implicitHeader, self.clock()))
+        self.txStats['queued'] += 1
+        if len(self._txQueue) > self.txStats['maxDepth']:
+            self.txStats['maxDepth'] = len(self._txQueue)
+        if self._txCurrent is None:
+            self._startTx()
+        return True
+
+    def txBusy(self):
+        return self._txCurrent is not None
+
+    def configPending(self):
+        return len(self._configPending) > 0
+
+    def txQueueDepth(self):
+        return len(self._txQueue)
+
+    def pollTx(self):
+        # cheap poll step: one register read while a packet is on air
+        if self._txCurrent is None:
+            return False
+        phase = self._txPhase
+        if phase == TX_ON_AIR:
+            if self.readRegister(REG_IRQ_FLAGS) & IRQ_TX_DONE_MASK:
+                self._txDone()
+        elif phase == TX_CAD:
+            self._txCadDone(self.cadResult())
+        elif ticks_diff(self.clock(), self._txRetryAt) >= 0:
+            # backoff over: look again
+            self._txPhase = TX_CAD
+            self.startCad()
+        return self._txCurrent is not None
+
+    def handleOnTxDone(self, event_source):
+        if self._txCurrent is not None:
+            if self._txPhase == TX_CAD:
+                self._txCadDone(self.cadResult())
+            elif self._txPhase == TX_ON_AIR:
+                self._txDone()
+
+    def resetTxStats(self):
+        # busy: CADs that found the channel in use; lbtDropped: packets given up
+        # on after `attempts` busy CADs
+        self.txStats = {'queued': 0, 'sent': 0, 'dropped': 0, 'maxDepth': 0,
+                        'lastLatency': 0, 'maxLatency': 0, 'totalLatency': 0, 'lastAirtime': 0,
+                        'busy': 0, 'lbtDropped': 0}
+
+    # Listen before talk: with it on, each queued packet waits for a CAD that
+    # finds the channel clear. After a busy CAD it backs off for a random time,
+    # up to `slot` ms (default: the packet's airtime) times 2 ** tries, at most
+    # maxBackoff ms (0: no backoff, look again on the next pollTx()); after
+    # `attempts` busy CADs the packet is dropped and its callback gets -1.
+    # Backoffs end in pollTx(): call it even with DIO0 wired.
+    def setListenBeforeTalk(self, enable = True, attempts = 8, slot = None, maxBackoff = 5000):
+        self._lbt = enable
+        self._lbtAttempts = attempts
+        self._lbtSlot = slot
+        self._lbtMaxBackoff = maxBackoff
+        self._lbtTries = 0
+
+    def _startTx(self):
+        self._txCurrent = self._txQueue.pop(0)
+        if self._lbt:
+            self._lbtTries = 0
+            self._txPhase = TX_CAD
+            self.startCad()
+        else:
+            self._transmit()
+
+    def _txCadDone(self, result):
+        if result < 0:
+            return
+        if result == 0:
+            self._transmit()
+            return
+        self.txStats['busy'] += 1
+        self._lbtTries += 1
+        if self._lbtTries >= self._lbtAttempts:
+            payload, callback, implicitHeader, queued = self._txCurrent
+            self._txCurrent = None
+            self._txPhase = TX_ON_AIR
+            self.txStats['lbtDropped'] += 1
+            self._txNext()
+            if callback:
+                callback(self, -1)
+            return
+        slot = self._lbtSlot
+        if slot is None:
+            slot = self.timeOnAir(len(self._txCurrent[0])) // 1000 + 1
+        window = min(slot << self._lbtTries, self._lbtMaxBackoff)
+        self._txRetryAt = self.clock() + (window and getrandbits(16) % window)
+        self._txPhase = TX_BACKOFF
+        if self._listen and self._sniffInterval is None:
+            # keep receiving meanwhile
+            self._resumeRx()
+
+    def _transmit(self):
+        payload, callback, implicitHeader, queued = self._txCurrent
+        self._txPhase = TX_ON_AIR
+        self.aquire_lock(True)
+        try:
+            if payload is not self._staged or implicitHeader != self._implicitHeaderMode:
+                self.beginPacket(implicitHeader)
+                self.write(payload)
+            self._staged = None
+            if self.pin_RxDone:
+                self.writeRegister(REG_DIO_MAPPING_1, DIO0_TX_DONE)
+            self._txStarted = self.clock()
+            self.writeRegister(REG_OP_MODE, MODE_LONG_RANGE_MODE | MODE_TX)
+        finally:
+            self.aquire_lock(False)
+
+    def _txDone(self):
+        now = self.clock()
+        self.writeRegister(REG_IRQ_FLAGS, IRQ_TX_DONE_MASK)
+        payload, callback, implicitHeader, queued = self._txCurrent
+        self._txCurrent = None
+        stats = self.txStats
+        latency = ticks_diff(now, queued)
+        stats['sent'] += 1
+        stats['lastLatency'] = latency
+        stats['totalLatency'] += latency
+        stats['lastAirtime'] = ticks_diff(now, self._txStarted)
+        if latency > stats['maxLatency']:
+            stats['maxLatency'] = latency
+        # keep the radio busy first, then report
+        self._txNext()
+        if callback:
+            callback(self, latency)
+
+    def _txNext(self):
+        if self._configPending:
+            changes = self._configPending
+            self._configPending = {}
+            self.configure(**changes)
+        if self._txQueue:
+            self._startTx()
+        elif self._listen:
+            self._resumeRx()
+
+    def _resumeRx(self):
+        # hand DIO0 back to RX_DONE and resume listening, the way we were
+        if self.pin_RxDone:
+            self.writeRegister(REG_DIO_MAPPING_1, DIO0_RX_DONE)
+        if self._sniffInterval is None:
+            self.receive()
+        else:
+            self._sniffPhase = SNIFF_IDLE
+            self._sniffAt = self.clock()
+
     def write(self, buffer):
         currentLength = self.readRegister(REG_PAYLOAD_LENGTH)
         size = len(buffer)
-        # check size
-        size = min(size, (MAX_PKT_LENGTH - FifoTxBaseAddr - currentLength))
-        # write data
-        for i in range(size):
-            self.writeRegister(REG_FIFO, buffer[i])
+        # check size: what is left of the TX area (everything, or the TX half)
+        size = min(size, self._txRoom - currentLength)
+        # write data, one burst: single CS assertion, address byte, then payload
+        if size < len(buffer):
+            buffer = memoryview(buffer)[:size]
+        self.writeBurst(REG_FIFO, buffer)
         # update length
         self.writeRegister(REG_PAYLOAD_LENGTH, currentLength + size)
         return size
 
     def aquire_lock(self, lock = False):
-        if 0:  # MicroPython is single threaded, doesn't need lock.
+        # MicroPython is single threaded: only radios sharing an SPI bus
+        # (spibus.SpiBus) need a lock, to keep a multi-transaction sequence whole
+        bus = self.bus
+        if bus is not None:
             if lock:
-                while self._lock:
-                    pass
-                self._lock = True
+                bus.acquire(self)
             else:
-                self._lock = False
+                bus.release(self)
 
     def print(self, string, implicitHeader = False):
         self.aquire_lock(True)  # wait until RX_Done, lock and begin writing.
-        self.beginPacket(implicitHeader)
-        self.write(string.encode())
-        self.endPacket()
-        self.aquire_lock(False) # unlock when done writing
+        try:
+            self.beginPacket(implicitHeader)
+            self.write(string.encode())
+            self.endPacket()
+        finally:
+            self.aquire_lock(False) # unlock when done writing
 
     def getIrqFlags(self):
         irqFlags = self.readRegister(REG_IRQ_FLAGS)
@@ -180,23 +747,27 @@ class SX127x:
         return (self.readRegister(REG_PKT_RSSI_VALUE) - (164 if self._frequency < 868E6 else 157))
     
     def packetSNR(self):
-        return (self.readRegister(REG_PKT_SNR_VALUE)) * 0.25
+        return self._packetSnrQuarter() * 0.25
+
+    def _packetSnrQuarter(self):
+        snr = self.readRegister(REG_PKT_SNR_VALUE)
+        if snr > 127:  # two's complement, quarter dB
+            snr -= 256
+        return snr
 
     def standby(self):
         self.writeRegister(REG_OP_MODE, MODE_LONG_RANGE_MODE | MODE_STDBY)
 
     def sleep(self):
         self.writeRegister(REG_OP_MODE, MODE_LONG_RANGE_MODE | MODE_SLEEP)
+        self._rxHeaders = 0  # the chip clears its packet counters in sleep
 
     def setTxPower(self, level, outputPin = PA_OUTPUT_PA_BOOST_PIN):
-        if (outputPin == PA_OUTPUT_RFO_PIN):
-            # RFO
-            level = min(max(level, 0), 14)
-            self.writeRegister(REG_PA_CONFIG, 0x70 | level)
-        else:
-            # PA BOOST
-            level = min(max(level, 2), 17)
-            self.writeRegister(REG_PA_CONFIG, PA_BOOST | MAX_POWER | (level - 2))
+        # RFO: 0-14 dBm, PA_BOOST: 2-17 dBm
+        value, level = paConfig(level, outputPin)
+        self.writeRegister(REG_PA_CONFIG, value)
+        self.parameters['tx_power_level'] = level
+        self.parameters['output_pin'] = outputPin
 
     def getTxPower(self):
         regpa = self.readRegister(REG_PA_CONFIG)
@@ -212,6 +783,7 @@ class SX127x:
 
     def setFrequency(self, frequency):
         self._frequency = frequency
+        self.parameters['frequency'] = frequency
         #frfs = {169E6: (42, 64, 0),
         #        433E6: (108, 64, 0),
         #        434E6: (108, 128, 0),
@@ -237,6 +809,7 @@ class SX127x:
 
     def setSpreadingFactor(self, sf):
         sf = min(max(sf, 6), 12)
+        self.parameters['spreading_factor'] = sf
         self.writeRegister(REG_DETECTION_OPTIMIZE, 0xc5 if sf == 6 else 0xc3)
         self.writeRegister(REG_DETECTION_THRESHOLD, 0x0c if sf == 6 else 0x0a)
         self.writeRegister(REG_MODEM_CONFIG_2, (self.readRegister(REG_MODEM_CONFIG_2) & 0x0f) | ((sf << 4) & 0xf0))
@@ -246,29 +819,21 @@ class SX127x:
         return ((cf2 >> 4) & 0x0f)
 
     def setSignalBandwidth(self, sbw):
-        sbw = abs(sbw) # just in case there's an idiot in the room
-        bins = (7.8E3, 10.4E3, 15.6E3, 20.8E3, 31.25E3, 41.7E3, 62.5E3, 125E3, 250E3, 500E3)
         # Added 500KHz
         # Enable setting BW by frequency or numbers
         # setSignalBandwidth(6) --> 62.5E3
-        if sbw <10:
-            bw =  bins[sbw]
-            print(bw)
-        else:
-            for i in range(len(bins)):
-                if sbw <= bins[i]:
-                    bw = i
-                    break
-        self.writeRegister(REG_MODEM_CONFIG_1, int((self.readRegister(REG_MODEM_CONFIG_1) & 0x0f) | (int(bw) << 4)))
+        bw = bandwidthIndex(sbw)
+        self.parameters['signal_bandwidth'] = BANDWIDTHS[bw]
+        self.writeRegister(REG_MODEM_CONFIG_1, (self.readRegister(REG_MODEM_CONFIG_1) & 0x0f) | (bw << 4))
 
     def getSignalBandwidth(self):
         cf1 = self.readRegister(REG_MODEM_CONFIG_1)
-        bw = (cf1 >> 4) & 0x0f
-        bins = (7.8E3, 10.4E3, 15.6E3, 20.8E3, 31.25E3, 41.7E3, 62.5E3, 125E3, 250E3)
-        return [bw, bins[bw]]
+        bw = min((cf1 >> 4) & 0x0f, len(BANDWIDTHS) - 1)
+        return [bw, BANDWIDTHS[bw]]
 
     def setCodingRate(self, denominator):
         denominator = min(max(denominator, 5), 8)
+        self.parameters['coding_rate'] = denominator
         cr = denominator - 4
         self.writeRegister(REG_MODEM_CONFIG_1, (self.readRegister(REG_MODEM_CONFIG_1) & 0xf1) | (cr << 1))
 
@@ -278,6 +843,7 @@ class SX127x:
         return cr+4
 
     def setPreambleLength(self, length):
+        self.parameters['preamble_length'] = length
         self.writeRegister(REG_PREAMBLE_MSB, (length >> 8) & 0xff)
         self.writeRegister(REG_PREAMBLE_LSB, (length >> 0) & 0xff)
 
@@ -287,25 +853,109 @@ class SX127x:
         return (msb<<8) | lsb
 
     def enableCRC(self, enable_CRC = False):
+        self.parameters['enable_CRC'] = enable_CRC
         modem_config_2 = self.readRegister(REG_MODEM_CONFIG_2)
         config = modem_config_2 | 0x04 if enable_CRC else modem_config_2 & 0xfb
         self.writeRegister(REG_MODEM_CONFIG_2, config)
 
     def setSyncWord(self, sw):
+        self.parameters['sync_word'] = sw
         self.writeRegister(REG_SYNC_WORD, sw)
 
     def getSyncWord(self):
         return self.readRegister(REG_SYNC_WORD)
 
+    # Incremental reconfiguration: configure(spreading_factor=12, frequency=868E6)
+    # works out the register values for the new settings (LowDataRateOptimize and
+    # SF6 detection settings included) and writes only those that differ from the
+    # chip. No reset, no init(). The radio is parked in standby only if something
+    # has to be written while it is receiving, then put back in its previous mode.
+    # TX power is encoded for the PA output last given to setTxPower() (or as
+    # output_pin), so an RFO module stays on RFO.
+    # Returns the number of registers written. While a packet is being sent the
+    # changes are kept and applied once it is done, before the next queued
+    # packet starts; returns -1 then (configPending() is True until applied).
+    def configure(self, **changes):
+        for key in changes:
+            if key not in CONFIG_KEYS:
+                raise Exception('Unknown parameter: ', key)
+        if self._txCurrent is not None:
+            self._configPending.update(changes)
+            return -1
+        parameters = dict(self.parameters)
+        parameters.update(changes)
+        writes = []
+        for address, value in self._configRegisters(parameters):
+            if self.readRegister(address) != value:
+                writes.append((address, value))
+        self.parameters = parameters
+        self._frequency = parameters['frequency']
+        self._implicitHeaderMode = parameters['implicitHeader']
+        if not writes:
+            return 0
+        mode = self.readRegister(REG_OP_MODE)
+        busy = (mode & 0x07) not in (MODE_SLEEP, MODE_STDBY)
+        if busy:
+            self.standby()
+        for address, value in writes:
+            self.writeRegister(address, value)
+        if busy:
+            self.writeRegister(REG_OP_MODE, mode)
+        return len(writes)
+
+    def _configRegisters(self, p):
+        # [(register, value), ...] the chip should hold for parameters p
+        frf = int(p['frequency'] / 61.03516)
+        bw = bandwidthIndex(p['signal_bandwidth'])
+        sf = min(max(p['spreading_factor'], 6), 12)
+        cr = min(max(p['coding_rate'], 5), 8) - 4
+        pa, level = paConfig(p['tx_power_level'], p.get('output_pin', PA_OUTPUT_PA_BOOST_PIN))
+        preamble = p['preamble_length']
+        # keep SymbTimeout MSB and AGC bits as they are
+        cf2 = (self.readRegister(REG_MODEM_CONFIG_2) & 0x03) | (sf << 4) | (0x04 if p['enable_CRC'] else 0)
+        cf3 = self.readRegister(REG_MODEM_CONFIG_3) & 0xf7
+        if needsLowDataRateOptimize(sf, bw):
+            cf3 |= 0x08
+        return ((REG_FRF_MSB, (frf >> 16) & 0xff), (REG_FRF_MID, (frf >> 8) & 0xff), (REG_FRF_LSB, frf & 0xff),
+                (REG_PA_CONFIG, pa),
+                (REG_MODEM_CONFIG_1, (bw << 4) | (cr << 1) | (1 if p['implicitHeader'] else 0)),
+                (REG_MODEM_CONFIG_2, cf2), (REG_MODEM_CONFIG_3, cf3),
+                (REG_PREAMBLE_MSB, (preamble >> 8) & 0xff), (REG_PREAMBLE_LSB, preamble & 0xff),
+                (REG_SYNC_WORD, p['sync_word']),
+                (REG_DETECTION_OPTIMIZE, 0xc5 if sf == 6 else 0xc3),
+                (REG_DETECTION_THRESHOLD, 0x0c if sf == 6 else 0x0a))
+
+    def timeOnAir(self, length):
+        # airtime (us) of a length-byte packet with the chip's current settings;
+        # free with the shadow cache on
+        cf1 = self.readRegister(REG_MODEM_CONFIG_1)
+        cf2 = self.readRegister(REG_MODEM_CONFIG_2)
+        cf3 = self.readRegister(REG_MODEM_CONFIG_3)
+        return timeOnAir(length, cf2 >> 4, min(cf1 >> 4, len(BANDWIDTHS) - 1), ((cf1 >> 1) & 0x07) + 4,
+                         self.getPreambleLength(), cf2 & 0x04, cf1 & 0x01, cf3 & 0x08)
+
     # def enable_Rx_Done_IRQ(self, enable = True):
     #     if enable:
     #         self.writeRegister(REG_IRQ_FLAGS_MASK, self.readRegister(REG_IRQ_FLAGS_MASK) & ~IRQ_RX_DONE_MASK)
     #     else:
     #         self.writeRegister(REG_IRQ_FLAGS_MASK, self.readRegister(REG_IRQ_FLAGS_MASK) | IRQ_RX_DONE_MASK)
-    #
-    # def dumpRegisters(self):
-    #     for i in range(128):
-    #         print("0x{0:02x}: {1:02x}".format(i, self.readRegister(i)))
+
+    def snapshotRegisters(self, buffer = None):
+        # whole register space in one burst. 0x00 is the FIFO, not a register: the
+        # burst starts at 0x01 and buffer[0] is left alone. Without a buffer, the
+        # driver's own is reused (and overwritten by the next call).
+        regs = self._snapshot if buffer is None else buffer
+        self.readBurst(REG_OP_MODE, memoryview(regs)[1:0x80])
+        return regs
+
+    def dumpRegisters(self, regs = None):
+        if regs is None:
+            regs = self.snapshotRegisters()
+        for i in range(1, 0x80):
+            print("0x{0:02x}: {1:02x} {2}".format(i, regs[i], REGISTER_NAMES.get(i, '')))
+        fields = decodeRegisters(regs)
+        for name in sorted(fields):
+            print("{0}: {1}".format(name, fields[name]))
 
     def implicitHeaderMode(self, implicitHeaderMode = False):
         if self._implicitHeaderMode != implicitHeaderMode:  # set value only if different.
@@ -314,14 +964,38 @@ class SX127x:
             config = modem_config_1 | 0x01 if implicitHeaderMode else modem_config_1 & 0xfe
             self.writeRegister(REG_MODEM_CONFIG_1, config)
 
-    def onReceive(self, callback):
+    # Continuous receive. With a PacketRing, packets are stored in it (nothing
+    # allocated) and callback, if any, gets (lora, slot); without, callback gets
+    # (lora, payload) as before. Received packets are handled on DIO0 if
+    # pin_RxDone is wired, otherwise call pollRx() from the main loop. Call
+    # receive() to start listening; the radio goes back to RX after each send.
+    def onReceive(self, callback, ring = None):
         self._onReceive = callback
+        self._rxRing = ring
+        self._listen = callback is not None or ring is not None
         if self.pin_RxDone:
-            if callback:
-                self.writeRegister(REG_DIO_MAPPING_1, 0x00)
-                self.pin_RxDone.set_handler_for_irq_on_rising_edge(handler = self.handleOnReceive)
-            else:
-                self.pin_RxDone.detach_irq()
+            # DIO0 stays with TX_DONE while a packet is on air, _txNext() hands it back
+            if self._listen and self._txCurrent is None:
+                self.writeRegister(REG_DIO_MAPPING_1, DIO0_RX_DONE)
+            # the interrupt stays on without a listener too, for TX_DONE;
+            # handleOnDio0() then ignores anything else
+            self.pin_RxDone.set_handler_for_irq_on_rising_edge(handler = self.handleOnDio0)
+
+    def pollRx(self):
+        # one register read when nothing came in
+        if self._txCurrent is not None and (self._txPhase != TX_BACKOFF or self._sniffInterval is not None):
+            return False
+        if self._sniffInterval is not None:
+            return self._pollSniff()
+        if self.readRegister(REG_IRQ_FLAGS) & IRQ_RX_DONE_MASK:
+            self.handleOnReceive(None)
+            return True
+        return False
+
+    def resetRxStats(self):
+        # delivered: handed over; crcErrors: dropped for a bad CRC; dropped: ring
+        # full (RING_DROP_NEWEST); missed: headers the chip saw that we never handled
+        self.rxStats = {'delivered': 0, 'crcErrors': 0, 'dropped': 0, 'missed': 0}
 
     def receive(self, size = 0):
         self.implicitHeaderMode(size > 0)
@@ -329,21 +1003,157 @@ class SX127x:
             self.writeRegister(REG_PAYLOAD_LENGTH, size & 0xff)
         # The last packet always starts at FIFO_RX_CURRENT_ADDR
         # no need to reset FIFO_ADDR_PTR
+        self._sniffInterval = None
         self.writeRegister(REG_OP_MODE, MODE_LONG_RANGE_MODE | MODE_RX_CONTINUOUS)
 
+    # Sniffing receive: the radio sleeps, wakes up for a CAD every `interval` ms
+    # and only goes to RX (RX_SINGLE, `timeout` symbols to find the preamble)
+    # when the CAD saw activity. Much less radio-on time than RX_CONTINUOUS, but
+    # senders need a preamble that lasts longer than interval plus one CAD (see
+    # setPreambleLength()). Call pollRx() from the main loop, even with DIO0 wired:
+    # it starts the CADs. Received packets go where onReceive() says.
+    def receiveSniff(self, interval = 100, timeout = 16):
+        self.implicitHeaderMode(False)
+        self.writeRegister(REG_SYMB_TIMEOUT_LSB, timeout & 0xff)
+        self._sniffInterval = interval
+        self._sniffPhase = SNIFF_IDLE
+        self._sniffAt = self.clock()
+        self._sniffOn = self._sniffAt
+
+    def sniffing(self):
+        return self._sniffInterval is not None
+
+    def resetSniffStats(self):
+        # cads: CADs run; detected: CADs that saw activity; packets: received
+        # after one; falseAlarms: RX timeouts after one; onMs: radio time in CAD or RX
+        self.sniffStats = {'cads': 0, 'detected': 0, 'packets': 0, 'falseAlarms': 0, 'onMs': 0}
+
+    def _pollSniff(self):
+        phase = self._sniffPhase
+        stats = self.sniffStats
+        if phase == SNIFF_IDLE:
+            now = self.clock()
+            if ticks_diff(now, self._sniffAt) >= 0:
+                self._sniffPhase = SNIFF_CAD
+                self._sniffOn = now
+                stats['cads'] += 1
+                self.startCad()
+            return False
+        if phase == SNIFF_CAD:
+            result = self.cadResult()
+            if result == 0:
+                self._sniffSleep()
+            elif result > 0:
+                stats['detected'] += 1
+                self._sniffPhase = SNIFF_RX
+                if self.pin_RxDone:
+                    self.writeRegister(REG_DIO_MAPPING_1, DIO0_RX_DONE)
+                self.writeRegister(REG_OP_MODE, MODE_LONG_RANGE_MODE | MODE_RX_SINGLE)
+            return False
+        flags = self.readRegister(REG_IRQ_FLAGS)
+        if flags & IRQ_RX_DONE_MASK:
+            stats['packets'] += 1
+            self.handleOnReceive(None)
+            self._sniffSleep()
+            return True
+        if flags & IRQ_RX_TIME_OUT_MASK:
+            self.writeRegister(REG_IRQ_FLAGS, IRQ_RX_TIME_OUT_MASK)
+            stats['falseAlarms'] += 1
+            self._sniffSleep()
+        return False
+
+    def _sniffSleep(self):
+        now = self.clock()
+        self.sniffStats['onMs'] += ticks_diff(now, self._sniffOn)
+        self._sniffPhase = SNIFF_IDLE
+        self._sniffAt = now + self._sniffInterval
+        self.sleep()
+
+    # Channel activity detection: for about one symbol the chip looks for LoRa
+    # chirps with the current frequency, SF and BW, then goes back to standby.
+    def startCad(self):
+        self.writeRegister(REG_IRQ_FLAGS, IRQ_CAD_DONE_MASK | IRQ_CAD_DETECTED_MASK)
+        if self.pin_RxDone:
+            self.writeRegister(REG_DIO_MAPPING_1, DIO0_CAD_DONE)
+        self.writeRegister(REG_OP_MODE, MODE_LONG_RANGE_MODE | MODE_CAD)
+
+    def cadResult(self):
+        # -1: still running, 0: channel clear, 1: activity; clears the flags
+        flags = self.readRegister(REG_IRQ_FLAGS)
+        if not flags & IRQ_CAD_DONE_MASK:
+            return -1
+        self.writeRegister(REG_IRQ_FLAGS, IRQ_CAD_DONE_MASK | IRQ_CAD_DETECTED_MASK)
+        return 1 if flags & IRQ_CAD_DETECTED_MASK else 0
+
+    def channelActive(self):
+        # blocking CAD, a couple of symbols
+        self.startCad()
+        result = self.cadResult()
+        while result < 0:
+            result = self.cadResult()
+        return result == 1
+
     # on RPi, interrupt callback is threaded and racing with main thread,
     # Needs a lock for accessing FIFO.
     # https://sourceforge.net/p/raspberry-gpio-python/wiki/Inputs/
     # http://raspi.tv/2013/how-to-use-interrupts-with-python-on-the-raspberry-pi-and-rpi-gpio-part-2
+    def handleOnDio0(self, event_source):
+        # DIO0 is TX_DONE (or CAD_DONE, listening before talk) while a queued
+        # packet is being sent, RX_DONE (or CAD_DONE, sniffing) otherwise.
+        # Without a listener it is left alone: a blocking channelActive() or
+        # print() reads the flags itself.
+        if self._txCurrent is not None and self._txPhase != TX_BACKOFF:
+            self.handleOnTxDone(event_source)
+        elif self._sniffInterval is not None:
+            self._pollSniff()
+        elif self._listen:
+            self.handleOnReceive(event_source)
+
     def handleOnReceive(self, event_source):
-        self.aquire_lock(True)  # lock until TX_Done
-        # irqFlags = self.getIrqFlags() should be 0x50
-        if (self.getIrqFlags() & IRQ_PAYLOAD_CRC_ERROR_MASK) == 0:
-            if self._onReceive:
-                payload = self.read_payload()
-                self.aquire_lock(False)  # unlock when done reading
-                self._onReceive(self, payload)
-        self.aquire_lock(False)  # unlock in any case.
+        # the bus is held while the packet is read and let go before the
+        # callback runs, which may well talk to another radio on the same bus
+        packet = None
+        self.aquire_lock(True)
+        try:
+            # irqFlags = self.getIrqFlags() should be 0x50
+            irqFlags = self.getIrqFlags()
+            self._countMissed()
+            stats = self.rxStats
+            if irqFlags & IRQ_PAYLOAD_CRC_ERROR_MASK:
+                stats['crcErrors'] += 1
+                self._keepTxHalf()
+            elif self._rxRing is not None:
+                slot = self.receiveInto(self._rxRing)
+                if slot < 0:
+                    stats['dropped'] += 1
+                else:
+                    stats['delivered'] += 1
+                self._keepTxHalf()
+                if self._onReceive:
+                    packet = slot
+            elif self._onReceive:
+                packet = self.read_payload()
+                stats['delivered'] += 1
+                self._keepTxHalf()
+        finally:
+            self.aquire_lock(False)
+        if packet is not None:
+            self._onReceive(self, packet)
+
+    def _keepTxHalf(self):
+        # a frame is staged: make the next packet start at the RX base again
+        if self._staged is not None and self._txCurrent is None and self._sniffInterval is None:
+            self._restartRx()
+
+    def _countMissed(self):
+        # every packet with a valid header bumps the chip's counter, so a jump of
+        # more than one since the last packet we handled means we lost some
+        self.readBurst(REG_RX_HEADER_CNT_VALUE_MSB, self._rxCnt)
+        headers = (self._rxCnt[0] << 8) | self._rxCnt[1]
+        gap = (headers - self._rxHeaders - 1) & 0xffff
+        if gap < 0x8000:
+            self.rxStats['missed'] += gap
+        self._rxHeaders = headers
 
     def receivedPacket(self, size = 0):
         irqFlags = self.getIrqFlags()
@@ -363,38 +1173,161 @@ class SX127x:
             self.writeRegister(REG_OP_MODE, MODE_LONG_RANGE_MODE | MODE_RX_SINGLE)
 
     def read_payload(self):
+        payload = bytearray(self._rxLength())
+        self.readBurst(REG_FIFO, payload)
+        self.collect_garbage()
+        return bytes(payload)
+
+    def readPayloadInto(self, buffer):
+        # like read_payload, into a caller-provided buffer; returns the length
+        # (a packet longer than buffer is cut short). Only a packet that fills
+        # buffer exactly is read without allocating a slice.
+        packetLength = min(self._rxLength(), len(buffer))
+        self.readBurst(REG_FIFO, buffer if packetLength == len(buffer) else memoryview(buffer)[:packetLength])
+        self.collect_garbage()
+        return packetLength
+
+    def receiveInto(self, ring):
+        # store the received packet in the next PacketRing slot, with its metadata;
+        # returns the slot, or -1 if the ring was full and drops new packets.
+        # The FIFO is read into the ring's cached view and SNR is kept in quarter
+        # dB, so there is nothing to collect afterwards: the memory policy is not
+        # applied here.
+        slot = ring.reserve()
+        if slot < 0:
+            return -1
+        length = min(self._rxLength(), ring.slotSize)
+        self.readBurst(REG_FIFO, ring.window(slot, length))
+        ring.commit(slot, length, self.packetRssi(), self._packetSnrQuarter(), self.clock())
+        return slot
+
+    def _rxLength(self):
         # set FIFO address to current RX address
         # fifo_rx_current_addr = self.readRegister(REG_FIFO_RX_CURRENT_ADDR)
         self.writeRegister(REG_FIFO_ADDR_PTR, self.readRegister(REG_FIFO_RX_CURRENT_ADDR))
         # read packet length
-        packetLength = self.readRegister(REG_PAYLOAD_LENGTH) if self._implicitHeaderMode else \
+        return self.readRegister(REG_PAYLOAD_LENGTH) if self._implicitHeaderMode else \
             self.readRegister(REG_RX_NB_BYTES)
-        payload = bytearray()
-        for i in range(packetLength):
-            payload.append(self.readRegister(REG_FIFO))
-        self.collect_garbage()
-        return bytes(payload)
+
+    # Shadow cache: config registers are kept in a small bytearray so that
+    # getters and read-modify-write setters don't go over SPI every time.
+    # Call invalidateShadow() after a hardware reset done behind the driver's back
+    # (init() does it for you), resyncShadow() to reload it from the chip.
+    def enableShadow(self, enable = True, verify = False):
+        self._shadow = bytearray(len(SHADOW_REGS)) if enable else None
+        self._shadowValid = 0
+        # verify mode: every cached read is checked against the chip
+        self._shadowVerify = verify
+
+    def invalidateShadow(self):
+        self._shadowValid = 0
+
+    def resyncShadow(self):
+        if self._shadow is None:
+            return
+        regs = self.snapshotRegisters()
+        for i in range(len(SHADOW_REGS)):
+            self._shadow[i] = regs[SHADOW_REGS[i]]
+        self._shadowValid = (1 << len(SHADOW_REGS)) - 1
+
+    def verifyShadow(self):
+        # returns [(address, shadow, chip), ...] for every cached register that drifted
+        mismatches = []
+        if self._shadow is None:
+            return mismatches
+        regs = self.snapshotRegisters()
+        for i in range(len(SHADOW_REGS)):
+            if self._shadowValid & (1 << i):
+                chip = regs[SHADOW_REGS[i]]
+                if chip != self._shadow[i]:
+                    mismatches.append((SHADOW_REGS[i], self._shadow[i], chip))
+        return mismatches
+
+    def _readChip(self, address):
+        return self.transfer(address & 0x7f)
 
     def readRegister(self, address, byteorder = 'big', signed = False):
-        response = self.transfer(self.pin_ss, address & 0x7f)
-        return int.from_bytes(response, byteorder)
+        slot = _shadowSlot[address & 0x7f] - 1 if self._shadow is not None else -1
+        if slot >= 0 and self._shadowValid & (1 << slot):
+            value = self._shadow[slot]
+            if self._shadowVerify:
+                chip = self._readChip(address)
+                if chip != value:
+                    raise Exception('Shadow mismatch at 0x{0:02x}: {1:02x} != {2:02x}'.format(address, value, chip))
+            return value
+        value = self.transfer(address & 0x7f)
+        if slot >= 0:
+            self._shadow[slot] = value
+            self._shadowValid |= 1 << slot
+        return value
 
     def writeRegister(self, address, value):
-        self.transfer(self.pin_ss, address | 0x80, value)
-
-    def transfer(self, cs, address, value = None):
-        ret = 0
-        cs.value(0)
-        self.spi.write(address)
-        if value:
-            self.spi.write(value)
+        self.transfer(address | 0x80, value)
+        if self._shadow is not None:
+            slot = _shadowSlot[address & 0x7f] - 1
+            if slot >= 0:
+                self._shadow[slot] = value & 0xff
+                self._shadowValid |= 1 << slot
+
+    def readBurst(self, address, buffer):
+        # fill buffer from consecutive reads of address (FIFO pointer auto-increments)
+        self.transferBurst(address & 0x7f, buffer)
+        return buffer
+
+    def writeBurst(self, address, buffer):
+        self.transferBurst(address | 0x80, buffer, True)
+
+    # Every register access goes through transfer() / transferBurst() (address
+    # with the write bit, as on the wire), then the transport.
+    def transfer(self, address, value = None):
+        if value is None:
+            return self.transport.read(address & 0x7f)
+        self.transport.write(address & 0x7f, value)
+        return 0
+
+    def transferBurst(self, address, buffer, write = False):
+        # one transaction for the whole buffer instead of one per byte
+        if write:
+            self.transport.writeBurst(address & 0x7f, buffer)
         else:
-            ret = self.spi.read(1)
-        cs.value(1)
-        return ret
+            self.transport.readBurst(address & 0x7f, buffer)
+
+    def waitIrq(self, timeout = 1000):
+        # for hosts without pin interrupts (Linux, the simulator): block until
+        # DIO0 is up or timeout ms, and handle it here. True if it was up.
+        if self.transport.waitIrq(timeout):
+            self.handleOnDio0(None)
+            return True
+        return False
+
+    # Memory policy: what collect_garbage() does after each packet sent or read
+    # (read_payload, readPayloadInto; not receiveInto, which allocates nothing).
+    # Telemetry goes to memStats and, if given, callback(lora, mem_free, mem_alloc)
+    # after each collection; nothing is printed.
+    def setMemoryPolicy(self, mode = GC_ALWAYS, every = 8, threshold = 16384, callback = None):
+        self._gcMode = mode
+        self._gcEvery = max(every, 1)
+        self._gcThreshold = threshold
+        self._gcCallback = callback
+        self.memStats = {'packets': 0, 'collections': 0, 'lastFree': -1, 'minFree': -1}
 
     def collect_garbage(self):
+        stats = self.memStats
+        stats['packets'] += 1
+        mode = self._gcMode
+        if mode == GC_NEVER:
+            return
+        if mode == GC_EVERY_N and stats['packets'] % self._gcEvery:
+            return
+        if mode == GC_LOW_HEAP and (not hasattr(gc, 'mem_free') or gc.mem_free() >= self._gcThreshold):
+            return
         gc.collect()
+        stats['collections'] += 1
         # if config_lora.IS_MICROPYTHON:
-        if 1:
-            print('[Memory - free: {}   allocated: {}]'.format(gc.mem_free(), gc.mem_alloc()))
+        if hasattr(gc, 'mem_free'):
+            free = gc.mem_free()
+            stats['lastFree'] = free
+            if stats['minFree'] < 0 or free < stats['minFree']:
+                stats['minFree'] = free
+            if self._gcCallback:
+                self._gcCallback(self, free, gc.mem_alloc())
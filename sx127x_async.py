@@ -0,0 +1,212 @@
+# asyncio / uasyncio front end for the SX127x driver: the radio becomes one
+# cooperative task next to the UI, touch handling and logging.
+#
+#   radio = AsyncSX127x(lora)
+#   asyncio.create_task(radio.run())            # the poller
+#   latency = await radio.send(b'PING')          # back once the packet is sent
+#   packet = await radio.receive(timeout=2000)   # bytes, or None after 2 s
+#   async for packet in radio:                   # radio.rssi / radio.snr: its signal
+#       ...
+#
+# Nothing blocks: send() goes through the driver's TX queue and receive() reads
+# from a PacketRing, both filled by the DIO0 interrupt when pin_RxDone is
+# wired. run() wakes every `interval` ms, calls pollTx() (and pollRx() without
+# DIO0, or while sniffing), and wakes the waiting tasks when a packet went out
+# or came in. Waiting tasks cost nothing in between. Interrupt handlers only
+# touch counters, never the asyncio objects.
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+from sx127x import PacketRing, ticks_diff
+
+try:
+    sleep_ms = asyncio.sleep_ms
+except AttributeError:  # CPython
+    def sleep_ms(ms):
+        return asyncio.sleep(ms / 1000)
+
+
+class AsyncSX127x:
+    # ring: where received packets wait for receive(), 8 slots by default;
+    # listen: start RX_CONTINUOUS right away (or call lora.receiveSniff() yourself)
+    def __init__(self, lora, ring = None, interval = 5, listen = True):
+        self.lora = lora
+        self.ring = ring if ring is not None else PacketRing(8)
+        self.interval = interval
+        self.rssi = 0
+        self.snr = 0
+        self.running = False   # run() is looping
+        self._stopped = False  # stop() was called; receive() and the iterator end
+        self._events = 0    # bumped by driver callbacks, possibly from an interrupt
+        self._seen = 0
+        self._event = asyncio.Event()
+        lora.onReceive(self._onPacket, ring=self.ring)
+        if listen:
+            lora.receive()
+
+    def _onPacket(self, lora, slot):
+        self._events += 1
+
+    async def run(self):
+        lora = self.lora
+        self.running = True
+        while not self._stopped:
+            lora.pollTx()
+            if lora.pin_RxDone is None or lora.sniffing():
+                lora.pollRx()
+            if self._events != self._seen:
+                self._seen = self._events
+                self._wake()
+            await sleep_ms(self.interval)
+        self.running = False
+        self._wake()
+
+    def stop(self):
+        # run() returns, receive() and the iterator end. Not the same as
+        # `not running`: run() may just not have had its first turn yet.
+        self._stopped = True
+
+    def _wake(self):
+        # a fresh Event for the next round, then release everyone on the old one
+        event = self._event
+        self._event = asyncio.Event()
+        event.set()
+
+    async def _wait(self, timeout = None):
+        # True when woken, False after timeout ms
+        event = self._event
+        if timeout is None:
+            await event.wait()
+            return True
+        try:
+            await asyncio.wait_for(event.wait(), timeout / 1000)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def send(self, payload, implicitHeader = False):
+        # waits for room in the TX queue, then for the packet to be sent.
+        # Returns the driver's latency in ms, -1 if listen before talk gave up.
+        lora = self.lora
+        result = [None]
+
+        def done(radio, latency):
+            result[0] = latency
+            self._events += 1
+        while lora.txQueueDepth() >= lora.maxTxQueue:
+            await self._wait()
+        lora.send(payload, done, implicitHeader)
+        while result[0] is None:
+            await self._wait()
+        return result[0]
+
+    async def receive(self, timeout = None):
+        # next packet as bytes (signal in self.rssi, self.snr), or None after
+        # timeout ms or once stopped
+        ring = self.ring
+        clock = self.lora.clock
+        start = clock()
+        while True:
+            slot = ring.first()
+            if slot >= 0:
+                payload = bytes(ring.packet(slot))
+                self.rssi = ring.rssi[slot]
+                self.snr = ring.snr[slot] / 4
+                ring.release()
+                return payload
+            if self._stopped:
+                return None
+            if timeout is None:
+                await self._wait()
+            else:
+                left = timeout - ticks_diff(clock(), start)
+                if left <= 0 or not await self._wait(left):
+                    return None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        packet = await self.receive()
+        if packet is None:
+            raise StopAsyncIteration
+        return packet
+
+
+if __name__ == '__main__':
+    # Two simulated radios following the wall clock: one sends PINGs, the other
+    # echoes them, while a third task stands in for the UI.
+    import contextlib
+    import io
+    from sx127x import SX127x
+    from sx127x_sim import SimSX127x, RealClock, link
+
+    async def demo(count = 5):
+        a, b = SimSX127x('a'), SimSX127x('b')
+        link(a, b, clock=RealClock())
+        ra = SX127x(spi=a.spi, pin_ss=a.cs)
+        rb = SX127x(spi=b.spi, pin_ss=b.cs, pin_RxDone=b.dio0)
+        for r in (ra, rb):
+            r.parameters.update(spreading_factor=7)
+            with contextlib.redirect_stdout(io.StringIO()):
+                r.init()
+        ping, echo = AsyncSX127x(ra), AsyncSX127x(rb)
+        tasks = [asyncio.create_task(ping.run()), asyncio.create_task(echo.run())]
+        frames = [0]
+
+        async def ui():
+            while ping.running:
+                frames[0] += 1
+                await sleep_ms(20)
+
+        async def echoer():
+            async for packet in echo:
+                await echo.send(b'ECHO ' + packet)
+
+        tasks.append(asyncio.create_task(ui()))
+        tasks.append(asyncio.create_task(echoer()))
+        for i in range(count):
+            latency = await ping.send('PING #{0}'.format(i))
+            reply = await ping.receive(timeout=1000)
+            print('sent in {0} ms, got {1} RSSI {2} SNR {3}'.format(latency, reply, ping.rssi, ping.snr))
+        ping.stop()
+        echo.stop()
+        for t in tasks:
+            await t
+        print('UI task ran {0} frames meanwhile'.format(frames[0]))
+
+    async def receiveFirst():
+        # receive() right after create_task(run()), before run() had a turn: it
+        # must wait for the packet sent 100 ms later, not give up at once
+        a, b = SimSX127x('a'), SimSX127x('b')
+        link(a, b, clock=RealClock())
+        ra = SX127x(spi=a.spi, pin_ss=a.cs)
+        rb = SX127x(spi=b.spi, pin_ss=b.cs, pin_RxDone=b.dio0)
+        for r in (ra, rb):
+            r.parameters.update(spreading_factor=7)
+            with contextlib.redirect_stdout(io.StringIO()):
+                r.init()
+        sender, radio = AsyncSX127x(ra, listen=False), AsyncSX127x(rb)
+        tasks = [asyncio.create_task(radio.run()), asyncio.create_task(sender.run())]
+
+        async def later():
+            await sleep_ms(100)
+            await sender.send(b'LATE')
+        tasks.append(asyncio.create_task(later()))
+        packet = await radio.receive(timeout=2000)
+        assert packet == b'LATE', packet
+        # the iterator too, and it ends once stopped
+        tasks.append(asyncio.create_task(later()))
+        async for packet in radio:
+            assert packet == b'LATE', packet
+            radio.stop()
+        sender.stop()
+        for t in tasks:
+            await t
+        assert not radio.running and await radio.receive(timeout=10) is None
+        print('receive() right after create_task(run()): got the packet sent 100 ms later')
+
+    asyncio.run(demo())
+    asyncio.run(receiveFirst())
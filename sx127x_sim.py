@@ -0,0 +1,713 @@
+# Register-level SX1276 simulator.
+# Lets sx127x.SX127x run on a plain PC: hand it sim.spi and sim.cs instead of the
+# MicroPython SPI / GPIO objects.
+#
+#   from sx127x import SX127x
+#   from sx127x_sim import SimSX127x, link
+#   a, b = SimSX127x(), SimSX127x()
+#   link(a, b)
+#   ra = SX127x(spi=a.spi, pin_ss=a.cs)
+#   rb = SX127x(spi=b.spi, pin_ss=b.cs, pin_RxDone=b.dio0)
+#
+# or, without the byte-by-byte SPI layer (faster on the host, same counters):
+#   ra = SX127x(transport=SimTransport(a))
+#
+# What is modelled: the LoRa register map with reset values, FIFO pointer
+# auto-increment, op modes, IRQ flags (write 1 to clear), DIO0 rising edges,
+# time-on-air, RX_SINGLE symbol timeout, channel activity detection, path loss /
+# SNR demodulation floor, collisions and random loss. What isn't: FSK mode, frequency hopping, ValidHeader
+# timing (packets land in one go at the end of their airtime).
+#
+# Time is virtual by default: every SPI transaction advances the shared clock by
+# its duration on the bus, so busy-wait loops make progress and benchmarks are
+# deterministic. Pass RealClock() to follow the wall clock instead.
+import math
+import random
+import time
+
+from sx127x import (REG_FIFO, REG_OP_MODE, REG_FRF_MSB, REG_FRF_MID, REG_FRF_LSB,
+                    REG_PA_CONFIG, REG_LNA, REG_FIFO_ADDR_PTR, REG_FIFO_TX_BASE_ADDR,
+                    REG_FIFO_RX_BASE_ADDR, REG_FIFO_RX_CURRENT_ADDR, REG_IRQ_FLAGS,
+                    REG_RX_NB_BYTES, REG_PKT_SNR_VALUE, REG_PKT_RSSI_VALUE,
+                    REG_RSSI_VALUE, REG_MODEM_CONFIG_1, REG_MODEM_CONFIG_2,
+                    REG_PREAMBLE_MSB, REG_PREAMBLE_LSB, REG_PAYLOAD_LENGTH,
+                    REG_MODEM_CONFIG_3, REG_RSSI_WIDEBAND, REG_DETECTION_OPTIMIZE,
+                    REG_DETECTION_THRESHOLD, REG_SYNC_WORD, REG_DIO_MAPPING_1, REG_VERSION,
+                    MODE_SLEEP, MODE_STDBY, MODE_TX,
+                    MODE_RX_CONTINUOUS, MODE_RX_SINGLE, MODE_CAD,
+                    IRQ_CAD_DETECTED_MASK, IRQ_CAD_DONE_MASK,
+                    IRQ_TX_DONE_MASK, IRQ_PAYLOAD_CRC_ERROR_MASK, IRQ_RX_DONE_MASK,
+                    IRQ_RX_TIME_OUT_MASK, BANDWIDTHS, timeOnAir)
+
+REG_SYMB_TIMEOUT_LSB = 0x1f
+REG_FIFO_RX_BYTE_ADDR = 0x25
+
+# minimum SNR (dB) the demodulator needs, SF6..SF12
+SNR_FLOOR = (-5.0, -7.5, -10.0, -12.5, -15.0, -17.5, -20.0)
+NOISE_FIGURE = 6.0
+# preamble symbols the receiver needs to lock: it can join a packet late, as
+# long as that many preamble symbols are still to come
+PREAMBLE_LOCK = 4
+FSTEP = 32E6 / 524288
+
+# LoRa mode reset values, SX1276 datasheet table 41
+_RESET = {REG_OP_MODE: 0x09, REG_FRF_MSB: 0x6c, REG_FRF_MID: 0x80, REG_FRF_LSB: 0x00,
+          REG_PA_CONFIG: 0x4f, 0x0a: 0x09, 0x0b: 0x2b, REG_LNA: 0x20,
+          REG_FIFO_TX_BASE_ADDR: 0x80, REG_MODEM_CONFIG_1: 0x72, REG_MODEM_CONFIG_2: 0x70,
+          REG_SYMB_TIMEOUT_LSB: 0x64, REG_PREAMBLE_LSB: 0x08, REG_PAYLOAD_LENGTH: 0x01,
+          0x23: 0xff, 0x24: 0x00, REG_DETECTION_OPTIMIZE: 0xc3, REG_DETECTION_THRESHOLD: 0x0a,
+          REG_SYNC_WORD: 0x12, REG_VERSION: 0x12}
+# registers the host can't write
+_READ_ONLY = (REG_FIFO_RX_CURRENT_ADDR, REG_RX_NB_BYTES, 0x14, 0x15, 0x16, 0x17, 0x18,
+              REG_PKT_SNR_VALUE, REG_PKT_RSSI_VALUE, REG_RSSI_VALUE, 0x1c, REG_FIFO_RX_BYTE_ADDR,
+              REG_RSSI_WIDEBAND, REG_VERSION)
+
+
+class SimClock:
+    # virtual time in seconds, only moves when told to
+    def __init__(self, start = 0.0):
+        self.t = start
+
+    def now(self):
+        return self.t
+
+    def advance(self, dt):
+        self.t += dt
+
+
+class RealClock:
+    def __init__(self):
+        self.t0 = time.monotonic()
+
+    def now(self):
+        return time.monotonic() - self.t0
+
+    def advance(self, dt):
+        pass
+
+
+class SimPin:
+    # DIO / reset line. Offers both the driver's IRQ interface and value().
+    def __init__(self, onValue = None):
+        self.handler = None
+        self.level = 1
+        self._onValue = onValue
+
+    def set_handler_for_irq_on_rising_edge(self, handler):
+        self.handler = handler
+
+    def detach_irq(self):
+        self.handler = None
+
+    def value(self, level = None):
+        if level is None:
+            return self.level
+        self.level = level
+        if self._onValue:
+            self._onValue(level)
+
+    def fire(self):
+        if self.handler:
+            self.handler(self)
+
+
+class SimCS:
+    def __init__(self, radio):
+        self.radio = radio
+        self.level = 1
+
+    def value(self, level = None):
+        if level is None:
+            return self.level
+        if level == self.level:
+            return
+        self.level = level
+        if level == 0:
+            self.radio._begin()
+        else:
+            self.radio._end()
+
+
+class SimSPI:
+    # Accepts what the driver feeds machine.SPI: ints or buffers.
+    def __init__(self, radio, baudrate = 100000, overhead = 20E-6):
+        self.radio = radio
+        self.baudrate = baudrate
+        self.overhead = overhead  # per transaction: CS toggling, call setup
+        self.resetCounters()
+
+    def resetCounters(self):
+        self.transactions = 0
+        self.bytes = 0
+        self.busTime = 0.0
+
+    def _chip(self):
+        return self.radio
+
+    def write(self, data):
+        chip = self._chip()
+        if isinstance(data, int):
+            chip._byte(data & 0xff)
+            self.bytes += 1
+            return
+        for b in data:
+            chip._byte(b)
+        self.bytes += len(data)
+
+    def read(self, n, write = 0x00):
+        out = bytearray(n)
+        self.readinto(out)
+        return bytes(out)
+
+    def readinto(self, buf, write = 0x00):
+        chip = self._chip()
+        for i in range(len(buf)):
+            buf[i] = chip._byte(write)
+        self.bytes += len(buf)
+
+    def write_readinto(self, wbuf, rbuf):
+        chip = self._chip()
+        for i in range(len(wbuf)):
+            rbuf[i] = chip._byte(wbuf[i])
+        self.bytes += len(wbuf)
+
+
+class SimSharedSPI(SimSPI):
+    # One bus for several SimSX127x, each keeping its own cs: bytes go to the
+    # chip whose CS is low. Two chips selected at once is a bus conflict.
+    def __init__(self, radios, baudrate = 100000, overhead = 20E-6):
+        SimSPI.__init__(self, None, baudrate, overhead)
+        self.radios = list(radios)
+        for r in self.radios:
+            r.spi = self
+
+    def _chip(self):
+        selected = [r for r in self.radios if r.cs.level == 0]
+        if len(selected) != 1:
+            raise Exception('SPI bus: {0} chips selected'.format(len(selected)))
+        return selected[0]
+
+
+class SimLevelPin:
+    # DIO0 read as a level, without interrupts, like linuxspi.LinuxGpio:
+    # SX127x.waitIrq() waits for it and handles it
+    def __init__(self, radio):
+        self.radio = radio
+
+    def value(self):
+        return 1 if self.radio.dio0Level() else 0
+
+    def set_handler_for_irq_on_rising_edge(self, handler):
+        pass
+
+    def detach_irq(self):
+        pass
+
+
+class SimTransport:
+    # In-memory transport for SX127x(transport=...): register accesses go
+    # straight to the chip and a burst is one call, instead of SimSPI's byte by
+    # byte. Transactions, bytes and bus time are still counted on radio.spi.
+    # dio0: give the driver DIO0 as a SimLevelPin, for waitIrq(). For
+    # interrupts instead, pass pin_RxDone=radio.dio0 to the driver.
+    def __init__(self, radio, dio0 = False):
+        self.radio = radio
+        self.dio0 = SimLevelPin(radio) if dio0 else None
+
+    def read(self, address):
+        r = self.radio
+        r._begin()
+        value = r._readReg(address)
+        r._count(2)
+        r._end()
+        return value
+
+    def write(self, address, value):
+        r = self.radio
+        r._begin()
+        r._writeReg(address, value & 0xff)
+        r._count(2)
+        r._end()
+
+    def readBurst(self, address, buffer):
+        r = self.radio
+        n = len(buffer)
+        r._begin()
+        if address == REG_FIFO:
+            p = r.regs[REG_FIFO_ADDR_PTR]
+            if p + n <= 256:
+                buffer[:] = r.fifo[p:p + n]
+            else:
+                for i in range(n):
+                    buffer[i] = r.fifo[(p + i) & 0xff]
+            r.regs[REG_FIFO_ADDR_PTR] = (p + n) & 0xff
+        else:
+            for i in range(n):
+                buffer[i] = r._readReg((address + i) & 0x7f)
+        r._count(1 + n)
+        r._end()
+
+    def writeBurst(self, address, buffer):
+        r = self.radio
+        n = len(buffer)
+        r._begin()
+        if address == REG_FIFO:
+            p = r.regs[REG_FIFO_ADDR_PTR]
+            if p + n <= 256:
+                r.fifo[p:p + n] = buffer
+            else:
+                for i in range(n):
+                    r.fifo[(p + i) & 0xff] = buffer[i]
+            r.regs[REG_FIFO_ADDR_PTR] = (p + n) & 0xff
+        else:
+            for i in range(n):
+                r._writeReg((address + i) & 0x7f, buffer[i])
+        r._count(1 + n)
+        r._end()
+
+    def waitIrq(self, timeout, step = 0.001):
+        # lets simulated time run until DIO0 is up, at most timeout ms, jumping
+        # from one channel event to the next
+        r = self.radio
+        channel = r.channel
+        now = channel.now()
+        end = now + timeout / 1000.0
+        while not r.dio0Level():
+            if now >= end:
+                return False
+            t = channel.nextEvent()
+            t = end if t is None or t > end else t
+            channel.clock.advance(max(t - now, 0.0) or step)
+            channel.update()
+            now = channel.now()
+        return True
+
+
+class SimChannel:
+    # The air between linked radios. Owns the clock and delivers packets at the
+    # end of their airtime to every radio listening with matching settings.
+    def __init__(self, clock = None, pathLoss = 80.0, lossRate = 0.0, crcErrorRate = 0.0, seed = None):
+        self.clock = clock if clock is not None else SimClock()
+        self.radios = []
+        self.pathLoss = pathLoss
+        self._links = {}
+        self.lossRate = lossRate
+        self.crcErrorRate = crcErrorRate
+        self.random = random.Random(seed)
+        self.air = []  # transmissions, oldest first
+        self._updating = False
+        self.resetStats()
+
+    def resetStats(self):
+        self.stats = {'sent': 0, 'delivered': 0, 'collisions': 0, 'lost': 0,
+                      'belowFloor': 0, 'crcErrors': 0, 'deaf': 0}
+
+    def attach(self, radio):
+        if radio.channel is not None and radio in radio.channel.radios:
+            radio.channel.radios.remove(radio)
+        radio.channel = self
+        self.radios.append(radio)
+
+    def setPathLoss(self, a, b, loss):
+        # per-link path loss in dB, symmetric
+        self._links[(id(a), id(b))] = loss
+        self._links[(id(b), id(a))] = loss
+
+    def getPathLoss(self, a, b):
+        return self._links.get((id(a), id(b)), self.pathLoss)
+
+    def now(self):
+        return self.clock.now()
+
+    def busy(self, radio, freq = None):
+        # any transmission on air right now on radio's frequency (for CAD / RSSI)
+        now = self.clock.now()
+        freq = radio.frf() if freq is None else freq
+        for tx in self.air:
+            if tx['start'] <= now < tx['end'] and tx['frf'] == freq and tx['sender'] is not radio:
+                return tx
+        return None
+
+    def update(self):
+        # run every radio's due events in time order
+        if self._updating:
+            return
+        self._updating = True
+        try:
+            now = self.clock.now()
+            while True:
+                first = None
+                for r in self.radios:
+                    t = r._nextEvent()
+                    if t is not None and t <= now and (first is None or t < first[0]):
+                        first = (t, r)
+                if first is None:
+                    break
+                first[1]._runEvent(first[0])
+            # forget transmissions nobody can collide with any more
+            while self.air and self.air[0]['end'] < now - 10.0:
+                self.air.pop(0)
+        finally:
+            self._updating = False
+
+    def nextEvent(self):
+        # time of the earliest event due on any radio, or None
+        first = None
+        for r in self.radios:
+            t = r._nextEvent()
+            if t is not None and (first is None or t < first):
+                first = t
+        return first
+
+    def _startTx(self, radio, payload, start, end):
+        tx = {'sender': radio, 'start': start, 'end': end, 'payload': payload,
+              'frf': radio.frf(), 'sf': radio.sf(), 'bw': radio.bwIndex(),
+              'sync': radio.regs[REG_SYNC_WORD], 'crc': radio.crcOn(),
+              'power': radio.txPower(), 'preamble': radio.preamble()}
+        self.air.append(tx)
+        self.stats['sent'] += 1
+        return tx
+
+    def _deliver(self, tx):
+        for r in self.radios:
+            if r is tx['sender']:
+                continue
+            if not r._canHear(tx):
+                if r.receiving() and r.frf() == tx['frf']:
+                    self.stats['deaf'] += 1
+                continue
+            if self._collided(tx, r):
+                self.stats['collisions'] += 1
+                continue
+            rssi = tx['power'] - self.getPathLoss(tx['sender'], r)
+            snr = rssi - r.noiseFloor()
+            if snr < SNR_FLOOR[tx['sf'] - 6]:
+                self.stats['belowFloor'] += 1
+                continue
+            if self.lossRate and self.random.random() < self.lossRate:
+                self.stats['lost'] += 1
+                continue
+            crcError = tx['crc'] and self.crcErrorRate and self.random.random() < self.crcErrorRate
+            if crcError:
+                self.stats['crcErrors'] += 1
+            else:
+                self.stats['delivered'] += 1
+            r._receive(tx, rssi, snr, crcError)
+
+    def _collided(self, tx, receiver):
+        for other in self.air:
+            if other is tx or other['sender'] is receiver or other['frf'] != tx['frf']:
+                continue
+            if other['start'] < tx['end'] and tx['start'] < other['end']:
+                return True
+        return False
+
+
+def link(*radios, **kwargs):
+    # put radios on one shared channel; kwargs go to SimChannel
+    channel = SimChannel(**kwargs)
+    for r in radios:
+        channel.attach(r)
+    return channel
+
+
+class SimSX127x:
+    def __init__(self, name = 'sim', channel = None, baudrate = 100000):
+        self.name = name
+        self.spi = SimSPI(self, baudrate)
+        self.cs = SimCS(self)
+        self.dio0 = SimPin()
+        self.rst = SimPin(self._onReset)
+        self.channel = None
+        (channel if channel is not None else SimChannel()).attach(self)
+        self.noise = -120.0  # dBm in 125 kHz, only used for RSSI registers
+        self.reset()
+
+    # --- chip state
+
+    def reset(self):
+        self.regs = bytearray(0x80)
+        for a in _RESET:
+            self.regs[a] = _RESET[a]
+        self.fifo = bytearray(256)
+        self._addr = None
+        self._write = False
+        self._txEnd = None
+        self._tx = None
+        self._rxSince = None
+        self._rxTimeout = None
+        self._rxAddr = 0
+        self._cadStart = None
+        self._cadEnd = None
+
+    def _onReset(self, level):
+        if level == 0:
+            self.reset()
+
+    def mode(self):
+        return self.regs[REG_OP_MODE] & 0x07
+
+    def frf(self):
+        return (self.regs[REG_FRF_MSB] << 16) | (self.regs[REG_FRF_MID] << 8) | self.regs[REG_FRF_LSB]
+
+    def frequency(self):
+        return self.frf() * FSTEP
+
+    def sf(self):
+        return min(max(self.regs[REG_MODEM_CONFIG_2] >> 4, 6), 12)
+
+    def bwIndex(self):
+        return min(self.regs[REG_MODEM_CONFIG_1] >> 4, 9)
+
+    def bandwidth(self):
+        return BANDWIDTHS[self.bwIndex()]
+
+    def codingRate(self):
+        return (self.regs[REG_MODEM_CONFIG_1] >> 1) & 0x07
+
+    def implicit(self):
+        return self.regs[REG_MODEM_CONFIG_1] & 0x01
+
+    def crcOn(self):
+        return (self.regs[REG_MODEM_CONFIG_2] >> 2) & 0x01
+
+    def preamble(self):
+        return (self.regs[REG_PREAMBLE_MSB] << 8) | self.regs[REG_PREAMBLE_LSB]
+
+    def ldro(self):
+        return (self.regs[REG_MODEM_CONFIG_3] >> 3) & 0x01
+
+    def txPower(self):
+        pa = self.regs[REG_PA_CONFIG]
+        if pa & 0x80:
+            return 2 + (pa & 0x0f)
+        return 10.8 + 0.6 * ((pa >> 4) & 0x07) - (15 - (pa & 0x0f))
+
+    def noiseFloor(self):
+        return -174 + 10 * math.log10(self.bandwidth()) + NOISE_FIGURE
+
+    def symbolTime(self):
+        return (1 << self.sf()) / self.bandwidth()
+
+    def timeOnAir(self, length):
+        # seconds
+        return timeOnAir(length, self.sf(), self.bwIndex(), self.codingRate() + 4,
+                         self.preamble(), self.crcOn(), self.implicit(), self.ldro()) / 1E6
+
+    def receiving(self):
+        return self.mode() in (MODE_RX_CONTINUOUS, MODE_RX_SINGLE)
+
+    def _rssiOffset(self):
+        return 157 if self.frequency() >= 779E6 else 164
+
+    # --- SPI
+
+    def _begin(self):
+        self.channel.update()
+        self._addr = None
+        self.spi.transactions += 1
+        self._nbytes = 0
+
+    def _end(self):
+        dt = self.spi.overhead + self._nbytes * 8.0 / self.spi.baudrate
+        self.spi.busTime += dt
+        self._addr = None
+        self.channel.clock.advance(dt)
+
+    def _count(self, n):
+        # bytes moved by a SimTransport access
+        self._nbytes += n
+        self.spi.bytes += n
+
+    def _byte(self, b):
+        self._nbytes += 1
+        if self._addr is None:
+            self._write = bool(b & 0x80)
+            self._addr = b & 0x7f
+            return 0
+        addr = self._addr
+        if self._write:
+            self._writeReg(addr, b)
+            out = 0
+        else:
+            out = self._readReg(addr)
+        if addr != REG_FIFO:
+            self._addr = (addr + 1) & 0x7f
+        return out
+
+    def _readReg(self, addr):
+        if addr == REG_FIFO:
+            p = self.regs[REG_FIFO_ADDR_PTR]
+            self.regs[REG_FIFO_ADDR_PTR] = (p + 1) & 0xff
+            return self.fifo[p]
+        if addr == REG_RSSI_VALUE:
+            return self._rssiReg(self._channelRssi())
+        if addr == REG_RSSI_WIDEBAND:
+            return int(self.channel.random.random() * 256) & 0xff
+        return self.regs[addr]
+
+    def _writeReg(self, addr, value):
+        if addr == REG_FIFO:
+            p = self.regs[REG_FIFO_ADDR_PTR]
+            self.fifo[p] = value
+            self.regs[REG_FIFO_ADDR_PTR] = (p + 1) & 0xff
+        elif addr == REG_IRQ_FLAGS:
+            self.regs[addr] &= ~value & 0xff
+        elif addr == REG_OP_MODE:
+            self._setMode(value)
+        elif addr not in _READ_ONLY:
+            self.regs[addr] = value
+
+    def _channelRssi(self):
+        tx = self.channel.busy(self)
+        if tx is None:
+            return self.noise
+        return tx['power'] - self.channel.getPathLoss(tx['sender'], self)
+
+    def dio0Level(self):
+        # DIO0 follows the IRQ flag it is mapped to until that flag is cleared
+        mapping = self.regs[REG_DIO_MAPPING_1] >> 6
+        mask = (IRQ_RX_DONE_MASK, IRQ_TX_DONE_MASK, IRQ_CAD_DONE_MASK, 0)[mapping]
+        return bool(self.regs[REG_IRQ_FLAGS] & mask)
+
+    def _rssiReg(self, rssi):
+        return min(max(int(round(rssi + self._rssiOffset())), 0), 255)
+
+    # --- modes and events
+
+    def _setMode(self, value):
+        old = self.mode()
+        self.regs[REG_OP_MODE] = value
+        mode = value & 0x07
+        now = self.channel.now()
+        if mode == MODE_SLEEP:
+            # header and packet counters are cleared in sleep
+            for a in range(0x14, 0x18):
+                self.regs[a] = 0
+        if mode != MODE_TX and self._tx is not None:
+            # TX aborted: the packet is cut short on air
+            self._tx['end'] = now
+            self._tx = None
+            self._txEnd = None
+        if mode in (MODE_RX_CONTINUOUS, MODE_RX_SINGLE):
+            if old != mode:
+                self._rxSince = now
+                self._rxAddr = self.regs[REG_FIFO_RX_BASE_ADDR]
+            self._rxTimeout = None
+            if mode == MODE_RX_SINGLE:
+                symbols = ((self.regs[REG_MODEM_CONFIG_2] & 0x03) << 8) | self.regs[REG_SYMB_TIMEOUT_LSB]
+                self._rxTimeout = now + symbols * self.symbolTime()
+        else:
+            self._rxSince = None
+            self._rxTimeout = None
+        if mode == MODE_CAD:
+            if old != MODE_CAD:
+                self._cadStart = now
+                self._cadEnd = now + self.cadTime()
+        else:
+            self._cadEnd = None
+        if mode == MODE_TX and old != MODE_TX:
+            n = self.regs[REG_PAYLOAD_LENGTH]
+            base = self.regs[REG_FIFO_TX_BASE_ADDR]
+            payload = bytes(self.fifo[(base + i) & 0xff] for i in range(n))
+            self._txEnd = now + self.timeOnAir(n)
+            self._tx = self.channel._startTx(self, payload, now, self._txEnd)
+
+    def _nextEvent(self):
+        if self._txEnd is not None:
+            return self._txEnd
+        if self._cadEnd is not None:
+            return self._cadEnd
+        return self._rxTimeout
+
+    def _runEvent(self, t):
+        if self._txEnd is not None and t == self._txEnd:
+            tx = self._tx
+            self._tx = None
+            self._txEnd = None
+            self.regs[REG_OP_MODE] = (self.regs[REG_OP_MODE] & 0xf8) | MODE_STDBY
+            self.regs[REG_IRQ_FLAGS] |= IRQ_TX_DONE_MASK
+            self.channel._deliver(tx)
+            if (self.regs[REG_DIO_MAPPING_1] >> 6) == 0x01:
+                self.dio0.fire()
+        elif self._cadEnd is not None and t == self._cadEnd:
+            self._cadEnd = None
+            self.regs[REG_OP_MODE] = (self.regs[REG_OP_MODE] & 0xf8) | MODE_STDBY
+            flags = IRQ_CAD_DONE_MASK
+            if self._activity(self._cadStart, t):
+                flags |= IRQ_CAD_DETECTED_MASK
+            self.regs[REG_IRQ_FLAGS] |= flags
+            if (self.regs[REG_DIO_MAPPING_1] >> 6) == 0x02:
+                self.dio0.fire()
+        elif self._rxTimeout is not None and t == self._rxTimeout:
+            self._rxTimeout = None
+            if self._locked(t):
+                return  # a preamble was caught in time, wait for the packet
+            self.regs[REG_OP_MODE] = (self.regs[REG_OP_MODE] & 0xf8) | MODE_STDBY
+            self._rxSince = None
+            self.regs[REG_IRQ_FLAGS] |= IRQ_RX_TIME_OUT_MASK
+
+    def _locked(self, t):
+        for tx in self.channel.air:
+            if tx['start'] <= t < tx['end'] and self._matches(tx) and self._rxSince <= self._lockBy(tx):
+                return True
+        return False
+
+    def _lockBy(self, tx):
+        # the last moment a receiver can start listening and still catch the preamble
+        return tx['start'] + max(tx['preamble'] - PREAMBLE_LOCK, 0) * self.symbolTime()
+
+    def cadTime(self):
+        # one symbol plus the processing, about (2^SF + 32) / BW
+        return ((1 << self.sf()) + 32) / self.bandwidth()
+
+    def _activity(self, start, end):
+        # CAD: chirps with our frequency, SF and BW on air during the window,
+        # strong enough to demodulate (any sync word)
+        for tx in self.channel.air:
+            if tx['sender'] is self or not (tx['start'] < end and start < tx['end']):
+                continue
+            if tx['frf'] != self.frf() or tx['sf'] != self.sf() or tx['bw'] != self.bwIndex():
+                continue
+            snr = tx['power'] - self.channel.getPathLoss(tx['sender'], self) - self.noiseFloor()
+            if snr >= SNR_FLOOR[tx['sf'] - 6]:
+                return True
+        return False
+
+    def _matches(self, tx):
+        return (tx['frf'] == self.frf() and tx['sf'] == self.sf() and
+                tx['bw'] == self.bwIndex() and tx['sync'] == self.regs[REG_SYNC_WORD])
+
+    def _canHear(self, tx):
+        # listening early enough to catch the preamble, same channel and modulation
+        return (self.receiving() and self._rxSince is not None and
+                self._rxSince <= self._lockBy(tx) and self._matches(tx))
+
+    def _receive(self, tx, rssi, snr, crcError):
+        payload = tx['payload']
+        n = self.regs[REG_PAYLOAD_LENGTH] if self.implicit() else len(payload)
+        addr = self._rxAddr
+        for i in range(n):
+            self.fifo[(addr + i) & 0xff] = payload[i] if i < len(payload) else 0
+        self._rxAddr = (addr + n) & 0xff
+        self.regs[REG_FIFO_RX_CURRENT_ADDR] = addr
+        self.regs[REG_FIFO_RX_BYTE_ADDR] = self._rxAddr
+        self.regs[REG_RX_NB_BYTES] = n
+        self.regs[REG_PKT_SNR_VALUE] = min(max(int(round(snr * 4)), -128), 127) & 0xff
+        self.regs[REG_PKT_RSSI_VALUE] = self._rssiReg(rssi)
+        for a in (0x14, 0x16):  # RxHeaderCnt, RxPacketCnt
+            count = (((self.regs[a] << 8) | self.regs[a + 1]) + 1) & 0xffff
+            if a == 0x16 and crcError:
+                continue
+            self.regs[a] = count >> 8
+            self.regs[a + 1] = count & 0xff
+        flags = IRQ_RX_DONE_MASK
+        if crcError:
+            flags |= IRQ_PAYLOAD_CRC_ERROR_MASK
+        self.regs[REG_IRQ_FLAGS] |= flags
+        if self.mode() == MODE_RX_SINGLE:
+            self.regs[REG_OP_MODE] = (self.regs[REG_OP_MODE] & 0xf8) | MODE_STDBY
+            self._rxSince = None
+            self._rxTimeout = None
+        if (self.regs[REG_DIO_MAPPING_1] >> 6) == 0x00:
+            self.dio0.fire()